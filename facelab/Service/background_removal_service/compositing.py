@@ -0,0 +1,57 @@
+"""
+Background compositing for the background removal service.
+
+Kept free of rembg/onnxruntime (the u2net model is loaded by the
+service's warmup, see removal_engine.py) so the CPU-side image work can be
+benchmarked on its own.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+
+def decode_image(data: bytes, mode: str = "RGB") -> Image.Image:
+    """Decode uploaded/encoded image bytes."""
+    return Image.open(io.BytesIO(data)).convert(mode)
+
+
+def split_rgba(image_rgba: Image.Image):
+    """rembg output -> (RGB foreground array, alpha mask array)."""
+    mask = np.array(image_rgba.split()[-1])
+    foreground = np.array(image_rgba.convert("RGB"))
+    return foreground, mask
+
+
+def blend(foreground, mask, background):
+    """Alpha-blend foreground over background using an 8-bit mask."""
+    mask_normalized = mask.astype(np.float32) / 255.0
+    mask_3d = np.stack([mask_normalized] * 3, axis=2)
+    return (foreground * mask_3d + background * (1 - mask_3d)).astype(np.uint8)
+
+
+def replace_background_color(foreground, mask, background_color):
+    """Replace background with solid color"""
+    h, w = foreground.shape[:2]
+    bg = np.ones((h, w, 3), dtype=np.uint8) * np.array(background_color, dtype=np.uint8)
+    return blend(foreground, mask, bg)
+
+
+def replace_background_image(foreground, mask, bg_image_bytes):
+    """Replace background with another image (Fix Aspect Ratio)"""
+    bg_pil = decode_image(bg_image_bytes)
+
+    # ขนาดของ Foreground (w, h)
+    h, w = foreground.shape[:2]
+    size = (w, h)
+
+    # --- ใช้ ImageOps.fit เพื่อ Crop ให้พอดีโดยภาพไม่เบี้ยว ---
+    bg_pil = ImageOps.fit(bg_pil, size, method=Image.Resampling.LANCZOS, centering=(0.5, 0.5))
+    return blend(foreground, mask, np.array(bg_pil))
+
+
+def blur_background(original_img: Image.Image, foreground, mask, radius: float = 15):
+    """Composite the foreground over a blurred copy of the original photo."""
+    bg_blurred = original_img.filter(ImageFilter.GaussianBlur(radius=radius))
+    return blend(foreground, mask, np.array(bg_blurred))
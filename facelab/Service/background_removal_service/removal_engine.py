@@ -0,0 +1,109 @@
+"""
+Background removal engine: rembg session plus compositing, without FastAPI.
+
+app.py serves it over HTTP; in embedded mode the gateway loads it
+in-process and calls ``run`` with the uploaded bytes directly.
+"""
+
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from common.metrics import model_load, stage
+from compositing import blur_background, decode_image, replace_background_color, replace_background_image, split_rgba
+
+MODES = ("transparent", "color", "image", "blur")
+
+
+def parse_colors(colors: Optional[str]) -> List[tuple]:
+    """"r,g,b|r,g,b" -> RGB tuples (clamped); black when empty or unparsable."""
+    if colors is None or colors.strip() == "":
+        colors = "0,0,0"
+    color_list = []
+    for color_str in colors.split("|"):
+        try:
+            rgb = [int(x.strip()) for x in color_str.split(",")]
+            color_list.append(tuple(max(0, min(255, x)) for x in rgb))
+        except ValueError:
+            pass
+    return color_list or [(0, 0, 0)]
+
+
+def paste_back(original: Image.Image, cutout: Image.Image) -> Image.Image:
+    """Full-resolution RGBA: ``original`` with the cutout's alpha upscaled onto it."""
+    alpha = cutout.getchannel("A").resize(original.size, Image.BILINEAR)
+    result = original.convert("RGBA")
+    result.putalpha(alpha)
+    return result
+
+
+class BackgroundRemover:
+    """A loaded rembg session and the four output modes."""
+
+    def __init__(self, remove, session):
+        self._remove = remove
+        self.session = session
+
+    def cutout(self, image: Image.Image) -> Image.Image:
+        """RGBA cutout of ``image`` (rembg takes and returns PIL, no PNG round trip)."""
+        with stage("inference"):
+            result = self._remove(image, session=self.session)
+        if result is None:
+            raise RuntimeError("rembg returned None")
+        return result
+
+    def run(self, input_bytes: bytes, mode: str = "color", colors: Optional[str] = None,
+            bg_bytes: Optional[bytes] = None,
+            original_bytes: Optional[bytes] = None) -> Tuple[List[Tuple[str, Image.Image]], List[dict]]:
+        """
+        Remove the background and composite. Returns ``[(name, image)]``
+        (name is the file suffix: transparent, bg_image, blur, color_<i>)
+        and the ``colors_used`` labels. Raises ``ValueError`` for bad input.
+
+        ``original_bytes`` is the full-resolution upload when ``input_bytes``
+        was downscaled at ingestion: the mask is computed on the small
+        image and pasted back onto the original.
+        """
+        if mode == "image" and not bg_bytes:
+            raise ValueError("Background image is required for image mode")
+        with stage("decode"):
+            original = decode_image(input_bytes)
+        result_rgba = self.cutout(original)
+        if original_bytes is not None:
+            with stage("decode"):
+                original = decode_image(original_bytes)
+            with stage("paste_back"):
+                result_rgba = paste_back(original, result_rgba)
+
+        if mode == "transparent":
+            return [("transparent", result_rgba)], [{"label": "Transparent"}]
+
+        with stage("compositing"):
+            foreground, mask = split_rgba(result_rgba)
+        if mode == "image":
+            with stage("compositing"):
+                result_arr = replace_background_image(foreground, mask, bg_bytes)
+            return [("bg_image", Image.fromarray(result_arr))], [{"label": "Custom Image"}]
+        if mode == "blur":
+            with stage("compositing"):
+                result_arr = blur_background(original, foreground, mask, radius=15)
+            return [("blur", Image.fromarray(result_arr))], [{"label": "Blur Effect"}]
+
+        # Solid colour (default)
+        color_list = parse_colors(colors)
+        outputs = []
+        for i, bg_color in enumerate(color_list):
+            with stage("compositing"):
+                result_arr = replace_background_color(foreground, mask, bg_color)
+            outputs.append((f"color_{i}", Image.fromarray(result_arr)))
+        return outputs, [{"r": c[0], "g": c[1], "b": c[2]} for c in color_list]
+
+
+def load_remover(model: str = "u2net") -> BackgroundRemover:
+    """Import rembg/onnxruntime, build the session and run it once so it is hot."""
+    from rembg import new_session, remove
+
+    with model_load(model):
+        session = new_session(model)
+        remove(Image.new("RGB", (64, 64)), session=session)  # first run initialises onnxruntime
+    return BackgroundRemover(remove, session)
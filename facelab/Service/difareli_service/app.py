@@ -1,36 +1,39 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import UploadFile, File, HTTPException
 from fastapi.responses import FileResponse
 from pathlib import Path
-import uuid
-
-app = FastAPI(title="DiFaReLi Service")
+import sys
 
 BASE = Path(__file__).resolve().parent
-STORE = (BASE / "../../shared_storage").resolve()
-UPLOAD = STORE / "uploads"
-OUTPUT = STORE / "outputs" / "difareli"
-UPLOAD.mkdir(parents=True, exist_ok=True)
-OUTPUT.mkdir(parents=True, exist_ok=True)
+sys.path.insert(0, str(BASE.parents[1]))  # facelab/ for the shared `common` package
+from common.metrics import stage
+from common.runtime import ServiceRuntime
+
+# App, /health, /ready, metrics, upload limits, job queue and per-job
+# storage come from the shared runtime. Uploads are managed by the SimSwap
+# service; this service owns its outputs.
+runtime = ServiceRuntime("difareli", "DiFaReLi Service", outputs_mb=1024)
+app = runtime.app
+
+
+# No model is wired in yet: /run answers 501 until run_relight is
+# implemented. Then register its loader with
+# runtime.add_model("difareli", load_relighter) so /ready waits for it, fetch
+# it here with runtime.model("difareli") and set RELIGHT_AVAILABLE.
+RELIGHT_AVAILABLE = False
+
+
+def run_relight(img_path: Path, ref_path: Path, output_dir: Path):
+    with stage("inference"):
+        raise NotImplementedError("DiFaReLi relighting is not wired in yet")
 
-def save_upload(f: UploadFile, path: Path):
-    path.write_bytes(f.file.read())
 
 @app.post("/run")
 def run(img: UploadFile = File(...), ref: UploadFile = File(...)):
-    job = uuid.uuid4().hex[:10]
-    img_path = UPLOAD / f"{job}_img.png"
-    ref_path = UPLOAD / f"{job}_ref.png"
-    save_upload(img, img_path)
-    save_upload(ref, ref_path)
-
-    try:
-        # run_relight(str(img_path), str(ref_path), str(OUTPUT))
-        pass
-    except Exception as e:
-        raise HTTPException(500, f"DiFaReLi failed: {e}")
-
-    out_img = max(OUTPUT.glob("*.*"), key=lambda p: p.stat().st_mtime, default=None)
-    if out_img is None:
-        raise HTTPException(500, "No output produced")
-
+    if not RELIGHT_AVAILABLE:
+        raise HTTPException(501, "DiFaReLi relighting is not implemented yet")
+    with runtime.job() as job:
+        img_path = job.save_upload(img, "img.png")
+        ref_path = job.save_upload(ref, "ref.png")
+        runtime.run(run_relight, img_path, ref_path, job.output_dir)
+        out_img = job.newest_output()
     return FileResponse(str(out_img))
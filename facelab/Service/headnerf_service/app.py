@@ -5,22 +5,20 @@ This service provides REST API endpoints for HeadNeRF head generation.
 Run with: uvicorn app:app --host 0.0.0.0 --port 8003 --reload
 """
 
-from fastapi import FastAPI, HTTPException, Query, UploadFile, File
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request, UploadFile, File
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
-import torch
-import cv2
-import numpy as np
+import logging
 import os
 import sys
-from glob import glob
 from pathlib import Path
 import uuid
-import base64
-import shutil
-from io import BytesIO
+import asyncio
+import queue
+import time
 
 # Set working directory to headnerf folder
 BASE = Path(__file__).resolve().parent
@@ -28,17 +26,51 @@ HEADNERF_ROOT = BASE / "headnerf"
 os.chdir(str(HEADNERF_ROOT))
 sys.path.insert(0, str(HEADNERF_ROOT))
 
-# Imports from headnerf
-from Utils.HeadNeRFUtils import HeadNeRFUtils
+sys.path.insert(0, str(BASE))
+sys.path.insert(0, str(BASE.parents[1]))  # facelab/ for the shared `common` package
+from common.resources import configure_torch
+from common.runtime import ServiceRuntime
+from common.storage import StorageArea
+
+# -----------------------------
+# Config & Storage
+# -----------------------------
+MODEL_PATH = "TrainedModels/model_Reso64.pth"
+FITTING_MODEL_PATH = "TrainedModels/model_Reso32HR.pth"
+TEMP_DIR = HEADNERF_ROOT / "temp_fitting"
+FITTED_SAMPLES_DIR = HEADNERF_ROOT / "LatentCodeSamples" / "fitted"
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
+FITTED_SAMPLES_DIR.mkdir(parents=True, exist_ok=True)
 
 # -----------------------------
 # FastAPI App
 # -----------------------------
-app = FastAPI(
-    title="HeadNeRF Service",
-    description="Real-time NeRF-based Parametric Head Model API",
-    version="1.0.0"
+# Shared runtime: metrics, tracing, profiling, upload limits, /health,
+# /ready and storage. Created before numpy/cv2/torch load (thread pools are
+# sized then). Renders stay on the request threadpool rather than the
+# runtime's worker pool: the latent cache lock already serialises them per
+# chunk, and a sweep must not hold the only worker while interactive renders
+# wait. Fits have their own worker (FittingEngine).
+runtime = ServiceRuntime(
+    "headnerf",
+    "HeadNeRF Service",
+    outputs_mb=1024,
+    app=FastAPI(
+        title="HeadNeRF Service",
+        description="Real-time NeRF-based Parametric Head Model API",
+        version="1.0.0"
+    ),
+    # Fit work dirs, the fit artefact cache and archived work dirs are
+    # bounded; fitted latent codes (FITTED_SAMPLES_DIR) are kept.
+    areas=[
+        StorageArea.from_env("fit_workdirs", TEMP_DIR, max_mb=2048, ttl_hours=24),
+        StorageArea.from_env("fit_cache", TEMP_DIR / "cache", max_mb=4096, ttl_hours=24 * 7),
+        StorageArea.from_env("fit_archive", TEMP_DIR / "archive", max_mb=2048, ttl_hours=72),
+    ],
 )
+app = runtime.app
+storage = runtime.storage
+OUTPUT = runtime.output_dir
 
 # CORS
 app.add_middleware(
@@ -49,23 +81,78 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# -----------------------------
-# Config & Storage
-# -----------------------------
-MODEL_PATH = "TrainedModels/model_Reso64.pth"
-FITTING_MODEL_PATH = "TrainedModels/model_Reso32HR.pth"
-STORE = (BASE / "../../shared_storage").resolve()
-OUTPUT = STORE / "outputs" / "headnerf"
-TEMP_DIR = HEADNERF_ROOT / "temp_fitting"
-FITTED_SAMPLES_DIR = HEADNERF_ROOT / "LatentCodeSamples" / "fitted"
-OUTPUT.mkdir(parents=True, exist_ok=True)
-TEMP_DIR.mkdir(parents=True, exist_ok=True)
-FITTED_SAMPLES_DIR.mkdir(parents=True, exist_ok=True)
+import cv2
+import numpy as np
 
-# Global model instance
+from common.metrics import QUEUE_DEPTH, STAGE_SECONDS, model_load, stage
+from common.tracing import record
+from common.http_cache import file_response
+from common.readiness import NotReady
+from common.uploads import ingest_bytes
+from fitting_engine import FittingEngine
+from imaging import image_to_base64
+from render_sessions import LatentCodeCache, SessionStore, RenderSession, SOURCE, TARGET
+from quality_levels import DEFAULT_LEVELS, QualityLevel, QualityLevels
+from sample_registry import SampleRegistry
+from sweep import FORMATS, PARAM_NAMES, encode_frames, interpolate_keyframes
+
+# The fit worker reports progress and failures through `logging`
+logging.basicConfig(level=os.environ.get("FACELAB_LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+DEFAULT_SESSION = "default"
+MAX_SESSIONS = int(os.environ.get("HEADNERF_MAX_SESSIONS", "256"))
+SESSION_TTL = float(os.environ.get("HEADNERF_SESSION_TTL", "3600"))
+LATENT_CACHE_SIZE = int(os.environ.get("HEADNERF_LATENT_CACHE_SIZE", "512"))
+THUMBNAIL_SIZE = 128
+LATENCY_BUDGET_MS = float(os.environ.get("HEADNERF_LATENCY_BUDGET_MS", "150"))
+MAX_SWEEP_FRAMES = int(os.environ.get("HEADNERF_MAX_SWEEP_FRAMES", "240"))
+SWEEP_CHUNK_FRAMES = int(os.environ.get("HEADNERF_SWEEP_CHUNK_FRAMES", "4"))  # frames per hold of the model lock
+FIT_QUEUE_SIZE = int(os.environ.get("HEADNERF_FIT_QUEUE_SIZE", "8"))
+FIT_WORKDIR_POLICY = os.environ.get("HEADNERF_FIT_WORKDIR", "delete")  # delete | archive | keep
+FIT_CACHE = os.environ.get("HEADNERF_FIT_CACHE", "1") != "0"  # reuse stage artefacts by image hash
+
+# Global model instance (shared network; per-client state lives in sessions),
+# loaded by the warmup thread after startup so the port binds immediately
 headnerf_model = None
-current_source = None
-current_target = None
+latent_cache = None
+sessions = None
+default_source = None
+default_target = None
+
+
+def _forget_latent(path: Path):
+    """Drop cached model state for a latent code that changed on disk."""
+    if latent_cache is not None:
+        latent_cache.discard(str(path))
+
+
+# Latent code index (original samples shadow fitted ones with the same name)
+_MODEL_BASE_NAME = os.path.basename(MODEL_PATH)[:-4]
+sample_registry = SampleRegistry(
+    [
+        (HEADNERF_ROOT / "LatentCodeSamples" / _MODEL_BASE_NAME, f"LatentCodeSamples/{_MODEL_BASE_NAME}"),
+        (FITTED_SAMPLES_DIR, "LatentCodeSamples/fitted"),
+    ],
+    on_change=_forget_latent,
+)
+
+# Progressive rendering: cheap levels while sliders move, top level when idle
+quality_levels = QualityLevels(os.environ.get("HEADNERF_QUALITY_LEVELS", DEFAULT_LEVELS), HEADNERF_ROOT)
+
+# Fitting runs on its own worker thread with resident stage models
+fitting_engine = FittingEngine(
+    HEADNERF_ROOT,
+    FITTING_MODEL_PATH,
+    FITTED_SAMPLES_DIR,
+    TEMP_DIR,
+    gpu_id=0,
+    max_queue=FIT_QUEUE_SIZE,
+    workdir_policy=FIT_WORKDIR_POLICY,
+    cache_enabled=FIT_CACHE,
+    on_fitted=sample_registry.add,
+)
+QUEUE_DEPTH.set_function(fitting_engine.queue_depth, service="headnerf", queue="fit")
 
 
 # -----------------------------
@@ -88,18 +175,31 @@ class RenderResponse(BaseModel):
     error: Optional[str] = None
 
 
+class SweepRequest(BaseModel):
+    keyframes: List[RenderParams]
+    frames: int = 36
+    format: str = "webp"
+    fps: int = 12
+
+
 class SampleInfo(BaseModel):
     name: str
     path: str
+    size: Optional[int] = None
+    preview_url: Optional[str] = None
 
 
 # -----------------------------
 # Helper Functions
 # -----------------------------
-def get_model():
-    """Get or initialize HeadNeRF model."""
-    global headnerf_model, current_source, current_target
-    
+def load_model():
+    """Load the default HeadNeRF model, latent cache and session store."""
+    global headnerf_model, latent_cache, sessions, default_source, default_target
+
+    # Imports torch; kept out of module import so the service starts fast
+    from Utils.HeadNeRFUtils import HeadNeRFUtils
+    configure_torch()
+
     if headnerf_model is None:
         model_path = HEADNERF_ROOT / MODEL_PATH
         if not model_path.exists():
@@ -109,137 +209,224 @@ def get_model():
             )
         
         print(f"Loading HeadNeRF model from {model_path}...")
-        headnerf_model = HeadNeRFUtils(str(model_path))
+        with model_load("headnerf"):
+            model = HeadNeRFUtils(str(model_path))
+        cache = LatentCodeCache(model, max_entries=LATENT_CACHE_SIZE)
         
         # Load default codes
-        base_name = os.path.basename(MODEL_PATH)[:-4]
-        samples = get_available_samples_internal()
+        _, samples = sample_registry.page(0, 2)
         
         if len(samples) >= 2:
-            headnerf_model.update_code_1(str(HEADNERF_ROOT / samples[0]["path"]))
-            headnerf_model.update_code_2(str(HEADNERF_ROOT / samples[1]["path"]))
-            current_source = samples[0]["name"]
-            current_target = samples[1]["name"]
+            default_source = samples[0].name
+            default_target = samples[1].name
+            cache.get(SOURCE, default_source, str(samples[0].abs_path))
+            cache.get(TARGET, default_target, str(samples[1].abs_path))
         
+        latent_cache = cache
+        for level in quality_levels.levels:
+            if level.model_path == MODEL_PATH:
+                level.cache = cache
+        sessions = SessionStore(new_session, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL)
+        headnerf_model = model
         print("HeadNeRF model loaded!")
     
     return headnerf_model
 
 
-def get_available_samples_internal() -> List[dict]:
-    """Get list of available latent code samples (including fitted ones)."""
-    base_name = os.path.basename(MODEL_PATH)[:-4]
-    samples = []
-    
-    # Original samples
-    samples_dir = HEADNERF_ROOT / f"LatentCodeSamples/{base_name}"
-    if samples_dir.exists():
-        for s in sorted(glob(str(samples_dir / "*.pth"))):
-            samples.append({
-                "name": os.path.basename(s), 
-                "path": f"LatentCodeSamples/{base_name}/{os.path.basename(s)}"
-            })
-    
-    # Fitted samples
-    if FITTED_SAMPLES_DIR.exists():
-        for s in sorted(glob(str(FITTED_SAMPLES_DIR / "*.pth"))):
-            samples.append({
-                "name": os.path.basename(s),
-                "path": f"LatentCodeSamples/fitted/{os.path.basename(s)}"
-            })
-    
-    return samples
+def get_model():
+    """Get the HeadNeRF model (503 while the warmup thread is still loading it)."""
+    return runtime.model("headnerf")
+
+
+def new_session(session_id: str) -> RenderSession:
+    """Create a render session starting from the default source/target."""
+    if default_source is None or default_target is None:
+        raise HTTPException(500, "No latent code samples available")
+    return RenderSession(
+        session_id,
+        load_slot(SOURCE, default_source),
+        load_slot(TARGET, default_target),
+    )
+
+
+def get_session(session_id: Optional[str]) -> RenderSession:
+    """Get (or create) the render session for a client."""
+    get_model()
+    return sessions.get(session_id or DEFAULT_SESSION)
+
+
+def resolve_sample_path(sample_name: str) -> Path:
+    """Find a latent code by name (original samples first, then fitted)."""
+    entry = sample_registry.get(sample_name)
+    if entry is None:
+        raise HTTPException(404, f"Sample not found: {sample_name}")
+    return entry.abs_path
+
+
+def load_slot(slot: str, sample_name: str):
+    """Load a latent code into the shared cache (from disk only on first use)."""
+    return latent_cache.get(slot, sample_name, str(resolve_sample_path(sample_name)))
+
+
+def get_level(quality: Optional[str]) -> Optional[QualityLevel]:
+    """Resolve a quality name ('auto', a level name, or None for the default model)."""
+    if not quality:
+        return None
+    if quality == "auto":
+        return quality_levels.pick(LATENCY_BUDGET_MS)
+    level = quality_levels.get(quality)
+    if level is None:
+        names = [lv.name for lv in quality_levels.levels]
+        raise HTTPException(400, f"Unknown quality '{quality}', expected one of {names + ['auto']}")
+    return level
+
+
+def get_level_cache(level: QualityLevel) -> LatentCodeCache:
+    """Latent cache for a quality level, loading its model on first use."""
+    get_model()
+
+    def build(model_path: str) -> LatentCodeCache:
+        from Utils.HeadNeRFUtils import HeadNeRFUtils
 
+        if not Path(model_path).exists():
+            raise HTTPException(500, f"Model not found for quality '{level.name}': {level.model_path}")
+        print(f"Loading HeadNeRF model for quality '{level.name}' from {model_path}...")
+        with model_load(f"headnerf_{level.name}"):
+            model = HeadNeRFUtils(model_path)
+        return LatentCodeCache(model, max_entries=LATENT_CACHE_SIZE)
 
-def image_to_base64(img: np.ndarray) -> str:
-    """Convert numpy image to base64 string."""
-    _, buffer = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-    return base64.b64encode(buffer).decode('utf-8')
+    return quality_levels.load(level, build)
+
+
+def make_thumbnail(entry) -> bytes:
+    """Render a small JPEG preview for a sample."""
+    get_model()
+    preview = load_slot(SOURCE, entry.name).preview
+    h, w = preview.shape[:2]
+    scale = THUMBNAIL_SIZE / max(h, w)
+    small = cv2.resize(preview, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode('.jpg', cv2.cvtColor(small, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return buffer.tobytes()
+
+
+def _observe_fit_stages(timings: dict):
+    """Feed a finished fit's per-stage timings into the stage histogram."""
+    for name, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, service="headnerf", stage=f"fit_{name}")
 
 
 # -----------------------------
 # API Endpoints
 # -----------------------------
-@app.get("/health")
-def health():
-    """Health check endpoint."""
-    return {"status": "ok", "service": "headnerf"}
+@app.get("/quality_levels")
+def list_quality_levels():
+    """Configured progressive-render levels (cheapest first) and their render times."""
+    return {
+        "budget_ms": LATENCY_BUDGET_MS,
+        "levels": [lv.info() for lv in quality_levels.levels],
+    }
 
 
 @app.get("/samples", response_model=List[SampleInfo])
-def list_samples():
-    """List available latent code samples."""
-    samples = get_available_samples_internal()
-    return [SampleInfo(**s) for s in samples]
+def list_samples(
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000)
+):
+    """
+    List available latent code samples.
+    
+    Served from the in-memory index; use offset/limit to page through large
+    libraries. The total count is returned in the X-Total-Count header.
+    """
+    runtime.model("samples")  # 503 until the index has been built
+    total, entries = sample_registry.page(offset, limit)
+    response.headers["X-Total-Count"] = str(total)
+    return [
+        SampleInfo(**e.to_dict(), preview_url=f"/samples/{e.name}/preview")
+        for e in entries
+    ]
+
+
+@app.get("/samples/{sample_name}/preview")
+def sample_preview(sample_name: str):
+    """Cached JPEG thumbnail of a sample."""
+    data = sample_registry.thumbnail(sample_name, make_thumbnail)
+    if data is None:
+        raise HTTPException(404, f"Sample not found: {sample_name}")
+    return Response(content=data, media_type="image/jpeg")
 
 
 @app.get("/current")
-def get_current_codes():
-    """Get currently loaded source and target codes."""
+def get_current_codes(session_id: Optional[str] = None):
+    """Get currently loaded source and target codes for a session."""
+    session = sessions.peek(session_id or DEFAULT_SESSION) if sessions else None
+    if session is None:
+        return {"source": default_source, "target": default_target}
     return {
-        "source": current_source,
-        "target": current_target
+        "source": session.source.name,
+        "target": session.target.name
     }
 
 
 @app.post("/set_source")
-def set_source(sample_name: str = Query(..., description="Sample filename")):
-    """Set the source latent code."""
-    global current_source
-    
-    model = get_model()
-    base_name = os.path.basename(MODEL_PATH)[:-4]
-    
-    # Check original samples first, then fitted
-    code_path = HEADNERF_ROOT / f"LatentCodeSamples/{base_name}/{sample_name}"
-    if not code_path.exists():
-        code_path = FITTED_SAMPLES_DIR / sample_name
-    
-    if not code_path.exists():
-        raise HTTPException(404, f"Sample not found: {sample_name}")
-    
-    model.update_code_1(str(code_path))
-    current_source = sample_name
+def set_source(
+    sample_name: str = Query(..., description="Sample filename"),
+    session_id: Optional[str] = None
+):
+    """Set the source latent code for a session."""
+    session = get_session(session_id)
+    session.source = load_slot(SOURCE, sample_name)
     
     # Return preview
-    img = model.source_img
     return {
         "ok": True,
         "sample": sample_name,
-        "preview_base64": image_to_base64(img)
+        "preview_base64": image_to_base64(session.source.preview)
     }
 
 
 @app.post("/set_target")
-def set_target(sample_name: str = Query(..., description="Sample filename")):
-    """Set the target latent code."""
-    global current_target
-    
-    model = get_model()
-    base_name = os.path.basename(MODEL_PATH)[:-4]
-    
-    # Check original samples first, then fitted
-    code_path = HEADNERF_ROOT / f"LatentCodeSamples/{base_name}/{sample_name}"
-    if not code_path.exists():
-        code_path = FITTED_SAMPLES_DIR / sample_name
-    
-    if not code_path.exists():
-        raise HTTPException(404, f"Sample not found: {sample_name}")
-    
-    model.update_code_2(str(code_path))
-    current_target = sample_name
+def set_target(
+    sample_name: str = Query(..., description="Sample filename"),
+    session_id: Optional[str] = None
+):
+    """Set the target latent code for a session."""
+    session = get_session(session_id)
+    session.target = load_slot(TARGET, sample_name)
     
     # Return preview
-    img = model.target_img
     return {
         "ok": True,
         "sample": sample_name,
-        "preview_base64": image_to_base64(img)
+        "preview_base64": image_to_base64(session.target.preview)
     }
 
 
+def render_session(session: RenderSession, identity, expression, albedo,
+                   illumination, pitch, yaw, roll,
+                   level: Optional[QualityLevel] = None) -> np.ndarray:
+    """Render with a session's source/target on the shared network (or a quality level's)."""
+    params = (identity, expression, albedo, illumination, pitch, yaw, roll)
+    cache = latent_cache if level is None else get_level_cache(level)
+    
+    start = time.perf_counter()
+    if cache is latent_cache:
+        with stage("inference"):
+            img = cache.render(session.source, session.target, *params)
+    else:
+        source = cache.get(SOURCE, session.source.name, str(resolve_sample_path(session.source.name)))
+        target = cache.get(TARGET, session.target.name, str(resolve_sample_path(session.target.name)))
+        with stage("inference"):
+            img = cache.render(source, target, *params)
+    
+    if level is not None:
+        level.record((time.perf_counter() - start) * 1000)
+    return img
+
+
 @app.post("/render", response_model=RenderResponse)
-def render(params: RenderParams, return_file: bool = False):
+def render(params: RenderParams, return_file: bool = False, session_id: Optional[str] = None):
     """
     Render an image with the given parameters.
     
@@ -247,12 +434,14 @@ def render(params: RenderParams, return_file: bool = False):
     - identity, expression, albedo, illumination: 0-1 blend between source and target
     - pitch, yaw, roll: -1 to 1 rotation angles
     - return_file: If True, return file URL instead of base64
+    - session_id: render with this session's source/target
     """
     try:
-        model = get_model()
+        session = get_session(session_id)
         
         # Generate image
-        img = model.gen_image(
+        img = render_session(
+            session,
             params.identity,
             params.expression,
             params.albedo,
@@ -266,7 +455,8 @@ def render(params: RenderParams, return_file: bool = False):
             # Save to file and return URL
             filename = f"render_{uuid.uuid4().hex[:8]}.png"
             output_path = OUTPUT / filename
-            cv2.imwrite(str(output_path), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+            with stage("encode_write"):
+                cv2.imwrite(str(output_path), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
             
             return RenderResponse(
                 ok=True,
@@ -274,11 +464,15 @@ def render(params: RenderParams, return_file: bool = False):
             )
         else:
             # Return base64 (faster for real-time)
+            with stage("encode"):
+                image_b64 = image_to_base64(img)
             return RenderResponse(
                 ok=True,
-                image_base64=image_to_base64(img)
+                image_base64=image_b64
             )
             
+    except (HTTPException, NotReady):
+        raise  # 503 + Retry-After while warming up, so callers back off
     except Exception as e:
         return RenderResponse(ok=False, error=str(e))
 
@@ -291,212 +485,176 @@ def render_quick(
     illumination: float = 0.0,
     pitch: float = 0.0,
     yaw: float = 0.0,
-    roll: float = 0.0
+    roll: float = 0.0,
+    session_id: Optional[str] = None,
+    quality: Optional[str] = None
 ):
     """
     Quick render endpoint for real-time updates.
     Returns base64 encoded image for fast client-side display.
+    
+    quality selects a render level for progressive rendering: a cheap level
+    (e.g. 'preview') while sliders move, the top level once they stop, or
+    'auto' for the best level within the latency budget. Omit it to render
+    with the default model.
     """
     try:
-        model = get_model()
+        session = get_session(session_id)
+        level = get_level(quality)
         
-        img = model.gen_image(
-            identity, expression, albedo, illumination,
-            pitch, yaw, roll
+        img = render_session(
+            session, identity, expression, albedo, illumination,
+            pitch, yaw, roll, level=level
         )
         
+        fmt = level.image_format if level is not None else "png"
+        with stage("encode"):
+            image_b64 = image_to_base64(img, fmt)
         return {
             "ok": True,
-            "image": image_to_base64(img)
+            "image": image_b64,
+            "format": fmt,
+            "quality": level.name if level is not None else None
         }
         
+    except (HTTPException, NotReady):
+        raise  # 503 + Retry-After while warming up, so callers back off
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 
 
+@app.post("/render_sweep")
+def render_sweep(req: SweepRequest, session_id: Optional[str] = None):
+    """
+    Render a parameter sweep (e.g. a yaw turntable) in one call.
+    
+    Keyframes are spaced evenly over `frames` frames and linearly
+    interpolated. Frames are rendered in small chunks on the shared network
+    (interactive renders from other sessions run in between) and returned as an animated WebP, an MP4 or a zip of PNGs. Render
+    throughput is reported in the X-Render-FPS header.
+    
+    Example turntable: {"keyframes": [{"yaw": -1}, {"yaw": 1}], "frames": 36}
+    """
+    if not req.keyframes:
+        raise HTTPException(400, "At least one keyframe is required")
+    if not 1 <= req.frames <= MAX_SWEEP_FRAMES:
+        raise HTTPException(400, f"frames must be between 1 and {MAX_SWEEP_FRAMES}")
+    if req.format not in FORMATS:
+        raise HTTPException(400, f"format must be one of {sorted(FORMATS)}")
+    
+    session = get_session(session_id)
+    path = interpolate_keyframes([k.dict() for k in req.keyframes], req.frames)
+    
+    start = time.perf_counter()
+    with stage("inference"):
+        frames = latent_cache.render_many(
+            session.source, session.target,
+            [[p[name] for name in PARAM_NAMES] for p in path],
+            chunk_size=SWEEP_CHUNK_FRAMES
+        )
+    render_seconds = time.perf_counter() - start
+    
+    with stage("encode"):
+        data, media_type, ext = encode_frames(frames, req.format, req.fps)
+    render_fps = len(frames) / render_seconds if render_seconds > 0 else 0.0
+    
+    return Response(
+        content=data,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="headnerf_sweep.{ext}"',
+            "X-Frame-Count": str(len(frames)),
+            "X-Render-FPS": f"{render_fps:.2f}",
+            "X-Total-Seconds": f"{time.perf_counter() - start:.3f}",
+        }
+    )
+
+
 @app.get("/outputs/{filename}")
-def get_output(filename: str):
-    """Serve rendered output files."""
+def get_output(filename: str, request: Request):
+    """Serve rendered output files (immutable: ETag, Range, ?w= thumbnails)."""
     path = OUTPUT / filename
-    if not path.exists():
+    if not path.is_file():
         raise HTTPException(404, "File not found")
-    return FileResponse(str(path))
+    storage.touch(path)
+    return file_response(request, path)
 
 
 @app.post("/fit")
-async def fit_image(image: UploadFile = File(...)):
+async def fit_image(image: UploadFile = File(...), wait: bool = True):
     """
     Fit an uploaded face image to get a HeadNeRF latent code.
     
-    Full pipeline:
+    Full pipeline (runs on the fitting worker, models stay resident):
     1. Generate head mask
     2. Detect facial landmarks
     3. Fit 3DMM model
     4. Fit HeadNeRF
     5. Save latent code
     
+    Parameters:
+    - wait: if False, return a job_id immediately and poll /fit/jobs/{job_id}
+    
     Returns:
     - ok: bool
     - fitted_name: filename of saved latent code
     - result_image: base64 encoded comparison image
+    - cached: True if the image was fitted before and the stored code was reused
+    - timings: seconds spent per stage (finished stages from earlier attempts are skipped)
     """
-    job_id = uuid.uuid4().hex[:8]
-    work_dir = TEMP_DIR / job_id
-    work_dir.mkdir(parents=True, exist_ok=True)
+    image.file.seek(0)
+    # Byte cap (413) and max-megapixel downscale; fitting works on a 512px crop anyway
+    with stage("ingest"):
+        contents = (await run_in_threadpool(ingest_bytes, image.file)).data
+    if not contents:
+        raise HTTPException(400, "Uploaded file is empty")
     
     try:
-        # Save uploaded image
-        img_path = work_dir / f"img_{job_id}.png"
-        image.file.seek(0)
-        contents = await image.read()
-        img_path.write_bytes(contents)
-        
-        # Step 1: Generate head mask
-        sys.path.insert(0, str(HEADNERF_ROOT / "DataProcess"))
-        from DataProcess.Gen_HeadMask import GenHeadMask
-        from DataProcess.correct_head_mask import correct_hair_mask
-        
-        mask_gen = GenHeadMask(gpu_id=0)
-        
-        bgr_img = cv2.imread(str(img_path))
-        img_rgb = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
-        
-        # Manual transform to avoid numpy version conflicts
-        # Equivalent to: ToTensor() + Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
-        img_float = img_rgb.astype(np.float32) / 255.0
-        # Normalize
-        mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
-        std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
-        img_normalized = (img_float - mean) / std
-        # HWC -> CHW and to tensor (use torch.tensor to avoid numpy conflicts)
-        img_chw = img_normalized.transpose(2, 0, 1).copy()
-        img_tensor = torch.tensor(img_chw, dtype=torch.float32)
-        img_tensor = img_tensor.unsqueeze(0).to(mask_gen.device)
-        
-        with torch.set_grad_enabled(False):
-            pred_res = mask_gen.net(img_tensor)
-            out = pred_res[0]
-        
-        res = out.squeeze(0).cpu().numpy().argmax(0)
-        res = np.ascontiguousarray(res, dtype=np.uint8)
-        lut = np.ascontiguousarray(mask_gen.lut)
-        res = cv2.LUT(res, lut)
-        res = correct_hair_mask(res)
-        res[res != 0] = 255
-        
-        mask_path = work_dir / f"img_{job_id}_mask.png"
-        cv2.imwrite(str(mask_path), res)
-        
-        # Step 2: Generate landmarks
-        import face_alignment
-        fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False)
-        
-        # Reconstruct numpy array to avoid numpy version conflict
-        # Convert to list then back to new numpy array
-        img_for_fa = np.array(img_rgb.tolist(), dtype=np.uint8)
-        lm_result = fa.get_landmarks(img_for_fa)
-        if lm_result is None:
-            raise ValueError("Could not detect face in image")
-        
-        lm_path = work_dir / f"img_{job_id}_lm2d.txt"
-        preds = lm_result[0]
-        with open(lm_path, "w") as f:
-            for pt in preds:
-                f.write(f"{pt[0]}\n")
-                f.write(f"{pt[1]}\n")
-        
-        # Step 3: Fit 3DMM
-        # Note: This requires pytorch3d which may not be installed
-        try:
-            sys.path.insert(0, str(HEADNERF_ROOT / "Fitting3DMM"))
-            from Fitting3DMM.FittingNL3DMM import FittingNL3DMM
-        except ModuleNotFoundError as e:
-            missing_module = str(e).split("'")[1] if "'" in str(e) else str(e)
-            return {
-                "ok": False, 
-                "error": f"Missing dependency: {missing_module}. HeadNeRF fitting requires pytorch3d. Please install with: pip install pytorch3d or use pre-fitted samples instead."
-            }
-        
-        fitter_3dmm = FittingNL3DMM(
-            img_size=512,
-            intermediate_size=256,
-            gpu_id=0,
-            batch_size=1,
-            img_dir=str(work_dir)
-        )
-        fitter_3dmm.main_process()
-        
-        # Find 3DMM result
-        pkl_files = list(work_dir.glob("*_nl3dmm.pkl"))
-        if not pkl_files:
-            raise FileNotFoundError("3DMM fitting failed")
-        para_3dmm_path = pkl_files[0]
-        
-        # Step 4: Fit HeadNeRF
-        from FittingSingleImage import FittingImage
-        
-        output_dir = work_dir / "output"
-        output_dir.mkdir(exist_ok=True)
-        
-        fitter = FittingImage(str(HEADNERF_ROOT / FITTING_MODEL_PATH), str(output_dir), gpu_id=0)
-        fitter.fitting_single_images(
-            img_path=str(img_path),
-            mask_path=str(mask_path),
-            para_3dmm_path=str(para_3dmm_path),
-            tar_code_path=None,
-            save_root=str(output_dir)
-        )
-        
-        # Find latent code
-        pth_files = list(output_dir.glob("LatentCodes_*.pth"))
-        if not pth_files:
-            raise FileNotFoundError("HeadNeRF fitting failed")
-        
-        latent_code_path = pth_files[0]
-        
-        # Copy to fitted samples
-        fitted_name = f"fitted_{job_id}.pth"
-        fitted_path = FITTED_SAMPLES_DIR / fitted_name
-        shutil.copy(latent_code_path, fitted_path)
-        
-        # Get result image
-        result_image_b64 = None
-        result_images = list(output_dir.glob("FittingRes_*.png"))
-        if result_images:
-            result_img = cv2.imread(str(result_images[0]))
-            _, buffer = cv2.imencode('.png', result_img)
-            result_image_b64 = base64.b64encode(buffer).decode('utf-8')
-        
-        return {
-            "ok": True,
-            "fitted_name": fitted_name,
-            "result_image": result_image_b64
-        }
-        
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return {"ok": False, "error": str(e)}
+        job = fitting_engine.submit(contents)
+    except queue.Full:
+        raise HTTPException(503, "Fitting queue is full, try again later")
+    job.future.add_done_callback(lambda _: _observe_fit_stages(job.timings))
+    
+    if not wait:
+        return {"ok": True, "job_id": job.job_id, "status": job.status}
     
-    finally:
-        # Optional: cleanup
-        # shutil.rmtree(work_dir, ignore_errors=True)
-        pass
+    # Await without blocking the event loop so renders keep flowing
+    result = await asyncio.wrap_future(job.future)
+    for name, seconds in job.timings.items():
+        record(f"fit_{name}", seconds)
+    return result
+
+
+@app.get("/fit/jobs/{job_id}")
+def fit_job_status(job_id: str):
+    """Status, current stage and per-stage timings of a fit job."""
+    job = fitting_engine.get_job(job_id)
+    if job is None:
+        raise HTTPException(404, f"Unknown job: {job_id}")
+    return job.info()
 
 
 # -----------------------------
 # Startup Event
 # -----------------------------
+def scan_samples() -> SampleRegistry:
+    """Index latent codes (the model's default source/target come from the index)."""
+    sample_registry.scan()
+    print(f"Indexed {len(sample_registry)} latent code samples")
+    return sample_registry
+
+
 @app.on_event("startup")
 async def startup_event():
-    """Pre-load model on startup."""
-    try:
-        get_model()
-        print("✅ HeadNeRF model pre-loaded successfully!")
-    except Exception as e:
-        print(f"⚠️ Failed to pre-load model: {e}")
-        print("Model will be loaded on first request.")
+    """Start the fit worker; samples are indexed and the model loaded in the background."""
+    fitting_engine.start()
+
+
+# Warmup components load in order: samples are indexed before the model.
+# If loading fails, the next request retries it.
+runtime.add_model("samples", scan_samples)
+runtime.add_model("headnerf", load_model)
 
 
 # -----------------------------
@@ -0,0 +1,461 @@
+"""
+HeadNeRF fitting engine.
+
+Runs the image -> latent code pipeline (head mask, landmarks, 3DMM fit,
+HeadNeRF fit) on a dedicated worker thread. The model used by each stage
+is built on first use and kept resident, so only the first fit pays for
+model construction.
+
+Stage artefacts (mask, landmarks, 3DMM parameters, latent code) are kept
+in ``temp_fitting/cache/<image hash>``: uploading the same image again
+returns the stored latent code, and a fit that failed part-way resumes
+from the last finished stage. Once a fit succeeds the work directory
+policy applies to the cache entry as well: "delete" and "archive" strip it
+down to what a cache hit serves (result record and result image), "keep"
+leaves every stage artefact in place.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import cv2
+import numpy as np
+
+from imaging import normalize_for_mask
+
+logger = logging.getLogger(__name__)
+
+WORKDIR_POLICIES = ("delete", "archive", "keep")
+
+
+class FittingError(Exception):
+    """A fitting stage failed with a message meant for the client."""
+
+
+class FitJob:
+    """One queued fit request."""
+
+    def __init__(self, job_id: str, image_bytes: bytes):
+        self.job_id = job_id
+        self.image_bytes = image_bytes
+        self.future: Future = Future()
+        self.status = "queued"
+        self.stage: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.created = time.time()
+
+    def info(self) -> dict:
+        info = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "stage": self.stage,
+            "timings": self.timings,
+        }
+        if self.future.done():
+            info["result"] = self.future.result()
+        return info
+
+
+class FittingEngine:
+    """Keeps fitting models resident and processes fit jobs one at a time."""
+
+    def __init__(self, headnerf_root: Path, fitting_model_path: str, fitted_dir: Path,
+                 temp_dir: Path, gpu_id: int = 0, max_queue: int = 8,
+                 workdir_policy: str = "delete", cache_enabled: bool = True,
+                 on_fitted: Optional[Callable[[Path], None]] = None):
+        if workdir_policy not in WORKDIR_POLICIES:
+            raise ValueError(f"workdir_policy must be one of {WORKDIR_POLICIES}")
+        self.headnerf_root = Path(headnerf_root)
+        self.fitting_model_path = fitting_model_path
+        self.fitted_dir = Path(fitted_dir)
+        self.temp_dir = Path(temp_dir)
+        self.archive_dir = self.temp_dir / "archive"
+        self.gpu_id = gpu_id
+        self.workdir_policy = workdir_policy
+        self.cache_enabled = cache_enabled
+        self.cache_dir = self.temp_dir / "cache"
+        self.on_fitted = on_fitted
+
+        self._queue: "queue.Queue[FitJob]" = queue.Queue(maxsize=max_queue)
+        self._jobs: Dict[str, FitJob] = {}
+        self._max_finished = 256
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        # Resident stage models (built lazily on the worker thread)
+        self._mask_gen = None
+        self._correct_hair_mask = None
+        self._face_align = None
+        self._fitter_3dmm = None
+        self._fitter_nerf = None
+
+    # -----------------------------
+    # Queue / worker
+    # -----------------------------
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="headnerf-fit", daemon=True)
+                self._thread.start()
+
+    def submit(self, image_bytes: bytes) -> FitJob:
+        """Queue a fit. Raises ``queue.Full`` when the backlog is at capacity."""
+        self.start()
+        job = FitJob(uuid.uuid4().hex[:8], image_bytes)
+        self._queue.put_nowait(job)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        return job
+
+    def get_job(self, job_id: str) -> Optional[FitJob]:
+        return self._jobs.get(job_id)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.future.done()]
+        for job in sorted(finished, key=lambda j: j.created)[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job.job_id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            try:
+                result = self._run(job)
+            except Exception as e:
+                logger.exception("HeadNeRF fit %s crashed", job.job_id)
+                result = {"ok": False, "error": str(e)}
+            finally:
+                job.image_bytes = b""
+            result["job_id"] = job.job_id
+            result["timings"] = job.timings
+            job.status = "done" if result.get("ok") else "failed"
+            job.stage = None
+            job.future.set_result(result)
+            logger.info("HeadNeRF fit %s %s: %s", job.job_id, job.status,
+                        ", ".join(f"{k}={v:.2f}s" for k, v in job.timings.items()))
+            self._queue.task_done()
+
+    def _stage(self, job: FitJob, name: str):
+        job.stage = name
+        return _StageTimer(job.timings, name)
+
+    # -----------------------------
+    # Resident models
+    # -----------------------------
+    def _get_mask_gen(self, job: FitJob):
+        if self._mask_gen is None:
+            with self._stage(job, "load_mask_model"):
+                sys.path.insert(0, str(self.headnerf_root / "DataProcess"))
+                from DataProcess.Gen_HeadMask import GenHeadMask
+                from DataProcess.correct_head_mask import correct_hair_mask
+                self._mask_gen = GenHeadMask(gpu_id=self.gpu_id)
+                self._correct_hair_mask = correct_hair_mask
+        return self._mask_gen
+
+    def _get_face_align(self, job: FitJob):
+        if self._face_align is None:
+            with self._stage(job, "load_landmark_model"):
+                import face_alignment
+                self._face_align = face_alignment.FaceAlignment(
+                    face_alignment.LandmarksType.TWO_D, flip_input=False
+                )
+        return self._face_align
+
+    def _get_fitter_3dmm(self, job: FitJob, work_dir: Path):
+        if self._fitter_3dmm is not None and hasattr(self._fitter_3dmm, "load_datasets"):
+            # Point the resident fitter at this job's images
+            self._fitter_3dmm.img_dir = str(work_dir)
+            self._fitter_3dmm.load_datasets()
+            return self._fitter_3dmm
+        # Without a reload hook the fitter reads img_dir when it is built, so
+        # reusing it would fit the first job's images again: build a new one
+
+        # Note: This requires pytorch3d which may not be installed
+        try:
+            sys.path.insert(0, str(self.headnerf_root / "Fitting3DMM"))
+            from Fitting3DMM.FittingNL3DMM import FittingNL3DMM
+        except ModuleNotFoundError as e:
+            missing_module = str(e).split("'")[1] if "'" in str(e) else str(e)
+            raise FittingError(
+                f"Missing dependency: {missing_module}. HeadNeRF fitting requires pytorch3d. "
+                "Please install with: pip install pytorch3d or use pre-fitted samples instead."
+            )
+
+        with self._stage(job, "load_3dmm_model"):
+            self._fitter_3dmm = FittingNL3DMM(
+                img_size=512,
+                intermediate_size=256,
+                gpu_id=self.gpu_id,
+                batch_size=1,
+                img_dir=str(work_dir)
+            )
+        return self._fitter_3dmm
+
+    def _get_fitter_nerf(self, job: FitJob, output_dir: Path):
+        if self._fitter_nerf is None:
+            with self._stage(job, "load_headnerf_model"):
+                from FittingSingleImage import FittingImage
+                self._fitter_nerf = FittingImage(
+                    str(self.headnerf_root / self.fitting_model_path), str(output_dir), gpu_id=self.gpu_id
+                )
+        return self._fitter_nerf
+
+    # -----------------------------
+    # Pipeline
+    # -----------------------------
+    def _cache_key(self, image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()[:16]
+
+    def _cached_result(self, work_dir: Path) -> Optional[dict]:
+        """Return the stored result for a finished fit if its latent code still exists."""
+        result_path = work_dir / "result.json"
+        if not result_path.exists():
+            return None
+        try:
+            result = json.loads(result_path.read_text())
+        except ValueError:
+            return None
+        if not (self.fitted_dir / result.get("fitted_name", "")).exists():
+            return None
+        result["result_image"] = self._result_image(work_dir / "output")
+        return result
+
+    def _result_image(self, output_dir: Path) -> Optional[str]:
+        result_images = list(output_dir.glob("FittingRes_*.png"))
+        if not result_images:
+            return None
+        result_img = cv2.imread(str(result_images[0]))
+        _, buffer = cv2.imencode('.png', result_img)
+        return base64.b64encode(buffer).decode('utf-8')
+
+    def _invalidate_after(self, work_dir: Path, stage: str):
+        """Remove artefacts of the stages that follow ``stage``."""
+        order = ["mask", "landmarks", "fit_3dmm", "fit_headnerf"]
+        later = order[order.index(stage) + 1:]
+        if "fit_3dmm" in later:
+            for p in work_dir.glob("*_nl3dmm.pkl"):
+                p.unlink()
+        if "fit_headnerf" in later or stage == "fit_headnerf":
+            shutil.rmtree(work_dir / "output", ignore_errors=True)
+        (work_dir / "result.json").unlink(missing_ok=True)
+
+    def _run(self, job: FitJob) -> dict:
+        if self.cache_enabled:
+            # Stage artefacts live in a directory named after the image hash,
+            # so a repeat upload finds them and skips finished stages
+            key = self._cache_key(job.image_bytes)
+            work_dir = self.cache_dir / key
+            cached = self._cached_result(work_dir)
+            if cached is not None:
+                # Bump atime only: the storage sweeper treats it as a use (LRU) without resetting the TTL
+                os.utime(work_dir, (time.time(), work_dir.stat().st_mtime))
+                cached["cached"] = True
+                return cached
+        else:
+            key = job.job_id
+            work_dir = self.temp_dir / job.job_id
+        work_dir.mkdir(parents=True, exist_ok=True)
+        ok = False
+
+        # The HeadNeRF stage depends on the fitting model; refit if it changed
+        meta_path = work_dir / "meta.json"
+        meta = {"fitting_model": self.fitting_model_path}
+        if meta_path.exists() and json.loads(meta_path.read_text()) != meta:
+            self._invalidate_after(work_dir, "fit_headnerf")
+        meta_path.write_text(json.dumps(meta))
+
+        try:
+            # Save uploaded image
+            img_path = work_dir / f"img_{key}.png"
+            if not img_path.exists():
+                with self._stage(job, "save_upload"):
+                    img_path.write_bytes(job.image_bytes)
+
+            img_rgb = None
+
+            def load_rgb():
+                bgr_img = cv2.imread(str(img_path))
+                if bgr_img is None:
+                    raise FittingError("Could not read image")
+                return cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+
+            # Step 1: Generate head mask
+            mask_path = work_dir / f"img_{key}_mask.png"
+            if not mask_path.exists():
+                mask_gen = self._get_mask_gen(job)
+                import torch  # deferred with the stage models, keeps service startup fast
+
+                with self._stage(job, "mask"):
+                    img_rgb = load_rgb()
+
+                    # Normalised CHW in numpy, then torch.tensor (avoids numpy conflicts)
+                    img_chw = normalize_for_mask(img_rgb)
+                    img_tensor = torch.tensor(img_chw, dtype=torch.float32)
+                    img_tensor = img_tensor.unsqueeze(0).to(mask_gen.device)
+
+                    with torch.set_grad_enabled(False):
+                        pred_res = mask_gen.net(img_tensor)
+                        out = pred_res[0]
+
+                    res = out.squeeze(0).cpu().numpy().argmax(0)
+                    res = np.ascontiguousarray(res, dtype=np.uint8)
+                    lut = np.ascontiguousarray(mask_gen.lut)
+                    res = cv2.LUT(res, lut)
+                    res = self._correct_hair_mask(res)
+                    res[res != 0] = 255
+
+                    self._invalidate_after(work_dir, "mask")
+                    cv2.imwrite(str(mask_path), res)
+
+            # Step 2: Generate landmarks
+            lm_path = work_dir / f"img_{key}_lm2d.txt"
+            if not lm_path.exists():
+                fa = self._get_face_align(job)
+                with self._stage(job, "landmarks"):
+                    if img_rgb is None:
+                        img_rgb = load_rgb()
+                    # Reconstruct numpy array to avoid numpy version conflict
+                    # Convert to list then back to new numpy array
+                    img_for_fa = np.array(img_rgb.tolist(), dtype=np.uint8)
+                    lm_result = fa.get_landmarks(img_for_fa)
+                    if lm_result is None:
+                        raise FittingError("Could not detect face in image")
+
+                    self._invalidate_after(work_dir, "landmarks")
+                    preds = lm_result[0]
+                    with open(lm_path, "w") as f:
+                        for pt in preds:
+                            f.write(f"{pt[0]}\n")
+                            f.write(f"{pt[1]}\n")
+
+            # Step 3: Fit 3DMM
+            pkl_files = list(work_dir.glob("*_nl3dmm.pkl"))
+            if not pkl_files:
+                fitter_3dmm = self._get_fitter_3dmm(job, work_dir)
+                with self._stage(job, "fit_3dmm"):
+                    self._invalidate_after(work_dir, "fit_3dmm")
+                    fitter_3dmm.main_process()
+
+                    # Find 3DMM result
+                    pkl_files = list(work_dir.glob("*_nl3dmm.pkl"))
+                    if not pkl_files:
+                        raise FittingError("3DMM fitting failed")
+            para_3dmm_path = pkl_files[0]
+
+            # Step 4: Fit HeadNeRF
+            output_dir = work_dir / "output"
+            pth_files = list(output_dir.glob("LatentCodes_*.pth"))
+            if not pth_files:
+                output_dir.mkdir(exist_ok=True)
+                fitter = self._get_fitter_nerf(job, output_dir)
+                with self._stage(job, "fit_headnerf"):
+                    fitter.fitting_single_images(
+                        img_path=str(img_path),
+                        mask_path=str(mask_path),
+                        para_3dmm_path=str(para_3dmm_path),
+                        tar_code_path=None,
+                        save_root=str(output_dir)
+                    )
+
+                    # Find latent code
+                    pth_files = list(output_dir.glob("LatentCodes_*.pth"))
+                    if not pth_files:
+                        raise FittingError("HeadNeRF fitting failed")
+            latent_code_path = pth_files[0]
+
+            # Step 5: Copy to fitted samples
+            with self._stage(job, "save_result"):
+                fitted_name = f"fitted_{key[:12] if self.cache_enabled else key}.pth"
+                fitted_path = self.fitted_dir / fitted_name
+                shutil.copy(latent_code_path, fitted_path)
+                if self.on_fitted:
+                    self.on_fitted(fitted_path)
+                (work_dir / "result.json").write_text(json.dumps({"ok": True, "fitted_name": fitted_name}))
+                result_image_b64 = self._result_image(output_dir)
+
+            ok = True
+            return {
+                "ok": True,
+                "fitted_name": fitted_name,
+                "result_image": result_image_b64,
+                "cached": False
+            }
+
+        except FittingError as e:
+            return {"ok": False, "error": str(e)}
+
+        finally:
+            with self._stage(job, "cleanup"):
+                if self.cache_enabled:
+                    self._retain_cached(work_dir, ok)
+                else:
+                    self._cleanup(work_dir, ok)
+
+    def _archive(self, work_dir: Path, ok: bool) -> bool:
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        suffix = "" if ok else "_failed"
+        try:
+            shutil.make_archive(str(self.archive_dir / f"{work_dir.name}{suffix}"), "zip", str(work_dir))
+        except Exception as e:
+            logger.warning("Failed to archive %s: %s", work_dir, e)
+            return False
+        return True
+
+    def _cleanup(self, work_dir: Path, ok: bool):
+        """Apply the work directory policy (failed jobs are archived unless policy is delete)."""
+        if self.workdir_policy == "keep":
+            return
+        if self.workdir_policy == "archive" and not self._archive(work_dir, ok):
+            return
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _retain_cached(self, work_dir: Path, ok: bool):
+        """
+        Apply the work directory policy to a cache entry. A finished fit keeps
+        only what a cache hit serves (result.json, meta.json, the result
+        image); failed fits keep their stage artefacts so a retry resumes.
+        """
+        if not ok or self.workdir_policy == "keep":
+            return
+        if self.workdir_policy == "archive" and not self._archive(work_dir, ok):
+            return
+        output_dir = work_dir / "output"
+        for p in list(work_dir.iterdir()) + (list(output_dir.iterdir()) if output_dir.is_dir() else []):
+            if p == output_dir or p.name in ("result.json", "meta.json") or p.name.startswith("FittingRes_"):
+                continue
+            if p.is_dir():
+                shutil.rmtree(p, ignore_errors=True)
+            else:
+                p.unlink(missing_ok=True)
+
+
+class _StageTimer:
+    """Context manager that records elapsed seconds into ``timings[name]``."""
+
+    def __init__(self, timings: Dict[str, float], name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings[self.name] = round(time.perf_counter() - self.start, 4)
+        return False
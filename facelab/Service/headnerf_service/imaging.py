@@ -0,0 +1,34 @@
+"""
+Image encode / normalisation helpers for the HeadNeRF service.
+
+No torch or HeadNeRF imports, so these hot paths can be benchmarked
+without the model stack.
+"""
+
+import base64
+
+import cv2
+import numpy as np
+
+# ImageNet statistics used by the head-mask network
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def image_to_base64(img: np.ndarray, fmt: str = "png") -> str:
+    """Convert numpy image to base64 string (png, or jpg for cheap previews)."""
+    params = [cv2.IMWRITE_JPEG_QUALITY, 85] if fmt == "jpg" else []
+    _, buffer = cv2.imencode(f'.{fmt}', cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+def normalize_for_mask(img_rgb: np.ndarray) -> np.ndarray:
+    """
+    RGB uint8 HWC -> normalised float32 CHW for the mask network.
+
+    Equivalent to ToTensor() + Normalize(IMAGENET_MEAN, IMAGENET_STD), done
+    in numpy to avoid torchvision/numpy version conflicts.
+    """
+    img_float = img_rgb.astype(np.float32) / 255.0
+    img_normalized = (img_float - IMAGENET_MEAN) / IMAGENET_STD
+    return img_normalized.transpose(2, 0, 1).copy()
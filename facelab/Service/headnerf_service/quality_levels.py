@@ -0,0 +1,84 @@
+"""
+Render quality levels for progressive HeadNeRF rendering.
+
+Each level pairs a trained model with an output encoding. Interactive
+clients render at a cheap level while a slider moves and request the
+top level once it stops. Render times are tracked per level so ``auto``
+can pick the best level that fits a latency budget.
+"""
+
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Default levels, cheapest first: name -> (model path, image format)
+DEFAULT_LEVELS = "preview=TrainedModels/model_Reso32.pth:jpg,full=TrainedModels/model_Reso64.pth:png"
+
+
+class QualityLevel:
+    """One model checkpoint plus its render-time statistics."""
+
+    def __init__(self, name: str, model_path: str, image_format: str = "png"):
+        self.name = name
+        self.model_path = model_path
+        self.image_format = image_format
+        self.cache = None  # LatentCodeCache once the model is loaded
+        self.render_ms: Optional[float] = None  # exponential moving average
+
+    def record(self, ms: float, alpha: float = 0.2):
+        self.render_ms = ms if self.render_ms is None else (1 - alpha) * self.render_ms + alpha * ms
+
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model_path,
+            "format": self.image_format,
+            "loaded": self.cache is not None,
+            "render_ms": None if self.render_ms is None else round(self.render_ms, 1),
+        }
+
+
+class QualityLevels:
+    """Ordered (cheapest first) set of quality levels with lazy model loading."""
+
+    def __init__(self, spec: str, root: Path):
+        self.root = Path(root)
+        self.levels: List[QualityLevel] = []
+        for item in filter(None, (x.strip() for x in spec.split(","))):
+            name, _, rest = item.partition("=")
+            model_path, _, fmt = rest.partition(":")
+            self.levels.append(QualityLevel(name.strip(), model_path.strip(), (fmt or "png").strip()))
+        if not self.levels:
+            raise ValueError("At least one quality level is required")
+        self._by_name: Dict[str, QualityLevel] = {lv.name: lv for lv in self.levels}
+        self._lock = threading.Lock()
+
+    @property
+    def top(self) -> QualityLevel:
+        return self.levels[-1]
+
+    def get(self, name: str) -> Optional[QualityLevel]:
+        return self._by_name.get(name)
+
+    def available(self) -> List[QualityLevel]:
+        """Levels whose checkpoint exists on disk."""
+        return [lv for lv in self.levels if (self.root / lv.model_path).exists()]
+
+    def load(self, level: QualityLevel, build: Callable[[str], object]):
+        """Build the level's cache (once) with ``build(absolute_model_path)``."""
+        if level.cache is None:
+            with self._lock:
+                if level.cache is None:
+                    level.cache = build(str(self.root / level.model_path))
+        return level.cache
+
+    def pick(self, budget_ms: float) -> QualityLevel:
+        """Highest available level whose measured render time fits the budget."""
+        levels = self.available() or [self.top]
+        best = levels[0]
+        for level in levels:
+            if level.render_ms is None or level.render_ms <= budget_ms:
+                best = level
+            else:
+                break
+        return best
@@ -0,0 +1,165 @@
+"""
+Session-scoped render state for the HeadNeRF service.
+
+One HeadNeRF network is shared by every client. Each client gets a
+``RenderSession`` holding its own source/target latent state, and the
+``LatentCodeCache`` makes sure every latent code is read from disk only
+once no matter how many sessions use it.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+SOURCE = "source"
+TARGET = "target"
+
+# HeadNeRFUtils attribute that holds the preview image for each slot
+_PREVIEW_ATTR = {SOURCE: "source_img", TARGET: "target_img"}
+
+
+class SlotState:
+    """Model attributes written by ``update_code_1/2`` for one latent code."""
+
+    def __init__(self, name: str, attrs: Dict[str, object], preview):
+        self.name = name
+        self.attrs = attrs
+        self.preview = preview
+
+
+class LatentCodeCache:
+    """
+    Loads latent codes into the shared model once and remembers the result.
+
+    ``HeadNeRFUtils`` keeps the source/target codes as attributes on the
+    model object. Loading a code through ``update_code_1/2`` and recording
+    which attributes changed gives a snapshot that can be re-applied later
+    without touching the disk again.
+    """
+
+    def __init__(self, model, max_entries: int = 512):
+        self.model = model
+        self.max_entries = max_entries
+        # Guards the shared network: state swap + forward pass are atomic
+        self.lock = threading.RLock()
+        self._states: "OrderedDict[Tuple[str, str], SlotState]" = OrderedDict()
+        self.loads = 0
+        self.hits = 0
+
+    def _loader(self, slot: str) -> Callable[[str], None]:
+        return self.model.update_code_1 if slot == SOURCE else self.model.update_code_2
+
+    def _capture(self, slot: str, name: str, path: str) -> SlotState:
+        before = dict(vars(self.model))
+        self._loader(slot)(path)
+        after = vars(self.model)
+        attrs = {
+            k: v for k, v in after.items()
+            if k not in before or before[k] is not v
+        }
+        return SlotState(name, attrs, getattr(self.model, _PREVIEW_ATTR[slot], None))
+
+    def get(self, slot: str, name: str, path: str) -> SlotState:
+        """Return the cached state for ``path`` in ``slot``, loading it on first use."""
+        key = (slot, str(path))
+        with self.lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                self.hits += 1
+                return state
+
+            state = self._capture(slot, name, str(path))
+            self.loads += 1
+            self._states[key] = state
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+            return state
+
+    def discard(self, path: str):
+        """Forget any cached state for ``path`` (e.g. the file was replaced)."""
+        with self.lock:
+            for key in [k for k in self._states if k[1] == str(path)]:
+                del self._states[key]
+
+    def _apply(self, source: SlotState, target: SlotState):
+        for k, v in source.attrs.items():
+            setattr(self.model, k, v)
+        for k, v in target.attrs.items():
+            setattr(self.model, k, v)
+
+    def render(self, source: SlotState, target: SlotState, *params):
+        """Apply a session's source/target state and run ``gen_image``."""
+        with self.lock:
+            self._apply(source, target)
+            return self.model.gen_image(*params)
+
+    def render_many(self, source: SlotState, target: SlotState, params_list, chunk_size: int = 4):
+        """
+        Render several frames, ``chunk_size`` at a time under one state swap.
+        The lock is released between chunks so other sessions' interactive
+        renders interleave with a long sweep instead of waiting for all of it.
+        """
+        params_list = list(params_list)
+        chunk_size = max(1, chunk_size)
+        frames = []
+        for i in range(0, len(params_list), chunk_size):
+            with self.lock:
+                self._apply(source, target)
+                frames.extend(self.model.gen_image(*params) for params in params_list[i:i + chunk_size])
+        return frames
+
+    def stats(self) -> dict:
+        return {"entries": len(self._states), "loads": self.loads, "hits": self.hits}
+
+
+class RenderSession:
+    """Source/target selection for a single client."""
+
+    def __init__(self, session_id: str, source: SlotState, target: SlotState):
+        self.session_id = session_id
+        self.source = source
+        self.target = target
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """LRU map of session id -> ``RenderSession`` with idle expiry."""
+
+    def __init__(self, factory: Callable[[str], RenderSession],
+                 max_sessions: int = 256, ttl: float = 3600.0):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, RenderSession]" = OrderedDict()
+
+    def get(self, session_id: str) -> RenderSession:
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self.factory(session_id)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def peek(self, session_id: str) -> Optional[RenderSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _expire(self, now: float):
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_used <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,182 @@
+"""
+In-memory index of HeadNeRF latent code samples.
+
+The registry scans the sample directories once at startup and afterwards
+only rescans a directory when its mtime changes, so listing samples does
+not touch the filesystem per request. Preview thumbnails are rendered on
+first request and kept with the entry.
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class SampleEntry:
+    """One latent code file."""
+
+    __slots__ = ("name", "path", "abs_path", "size", "mtime", "thumbnail")
+
+    def __init__(self, name: str, path: str, abs_path: Path, size: int, mtime: float):
+        self.name = name
+        self.path = path
+        self.abs_path = abs_path
+        self.size = size
+        self.mtime = mtime
+        self.thumbnail: Optional[bytes] = None
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "path": self.path, "size": self.size}
+
+
+class SampleRegistry:
+    """
+    Index of ``*.pth`` latent codes across several directories.
+
+    ``dirs`` is a list of ``(directory, relative_prefix)`` pairs in priority
+    order; a name found in an earlier directory shadows later ones, matching
+    how samples were resolved before.
+    """
+
+    def __init__(self, dirs: List[Tuple[Path, str]], refresh_interval: float = 2.0,
+                 on_change: Optional[Callable[[Path], None]] = None):
+        self.dirs = [(Path(d), prefix) for d, prefix in dirs]
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self._lock = threading.RLock()
+        self._by_dir: Dict[Path, Dict[str, SampleEntry]] = {d: {} for d, _ in self.dirs}
+        self._dir_mtime: Dict[Path, float] = {}
+        self._entries: Dict[str, SampleEntry] = {}
+        self._order: List[SampleEntry] = []
+        self._last_check = 0.0
+
+    # -----------------------------
+    # Indexing
+    # -----------------------------
+    def scan(self):
+        """Index every directory (called once at startup)."""
+        with self._lock:
+            for directory, prefix in self.dirs:
+                self._scan_dir(directory, prefix)
+            self._rebuild()
+            self._last_check = time.monotonic()
+
+    def refresh(self, force: bool = False):
+        """Rescan directories whose mtime changed since the last check."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.refresh_interval:
+            return
+        with self._lock:
+            self._last_check = now
+            changed = False
+            for directory, prefix in self.dirs:
+                try:
+                    mtime = directory.stat().st_mtime
+                except FileNotFoundError:
+                    mtime = None
+                if mtime != self._dir_mtime.get(directory):
+                    changed |= self._scan_dir(directory, prefix)
+            if changed:
+                self._rebuild()
+
+    def add(self, path: Path) -> Optional[SampleEntry]:
+        """Add or update a single file without rescanning its directory."""
+        path = Path(path)
+        with self._lock:
+            for directory, prefix in self.dirs:
+                if path.parent.resolve() == directory.resolve():
+                    entries = self._by_dir[directory]
+                    old = entries.get(path.name)
+                    entry = self._make_entry(path, prefix)
+                    if entry is None:
+                        return None
+                    entries[path.name] = entry
+                    if old is not None and self.on_change:
+                        self.on_change(old.abs_path)
+                    self._rebuild()
+                    return entry
+        return None
+
+    def _make_entry(self, path: Path, prefix: str) -> Optional[SampleEntry]:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return SampleEntry(path.name, f"{prefix}/{path.name}", path, st.st_size, st.st_mtime)
+
+    def _scan_dir(self, directory: Path, prefix: str) -> bool:
+        """Sync one directory's entries with disk. Returns True if anything changed."""
+        entries = self._by_dir[directory]
+        try:
+            self._dir_mtime[directory] = directory.stat().st_mtime
+            found = {}
+            with os.scandir(directory) as it:
+                for de in it:
+                    if de.is_file() and de.name.endswith(".pth"):
+                        st = de.stat()
+                        found[de.name] = (st.st_size, st.st_mtime)
+        except FileNotFoundError:
+            self._dir_mtime[directory] = None
+            found = {}
+
+        changed = False
+        for name in list(entries):
+            if name not in found:
+                old = entries.pop(name)
+                changed = True
+                if self.on_change:
+                    self.on_change(old.abs_path)
+        for name, (size, mtime) in found.items():
+            old = entries.get(name)
+            if old is not None and old.size == size and old.mtime == mtime:
+                continue
+            entries[name] = SampleEntry(name, f"{prefix}/{name}", directory / name, size, mtime)
+            changed = True
+            if old is not None and self.on_change:
+                self.on_change(old.abs_path)
+        return changed
+
+    def _rebuild(self):
+        order = []
+        by_name = {}
+        for directory, _ in self.dirs:
+            for name in sorted(self._by_dir[directory]):
+                if name in by_name:
+                    continue
+                entry = self._by_dir[directory][name]
+                by_name[name] = entry
+                order.append(entry)
+        self._entries = by_name
+        self._order = order
+
+    # -----------------------------
+    # Queries
+    # -----------------------------
+    def get(self, name: str) -> Optional[SampleEntry]:
+        entry = self._entries.get(name)
+        if entry is None:
+            # Unknown names may be files dropped in since the last check
+            self.refresh(force=True)
+            entry = self._entries.get(name)
+        return entry
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[SampleEntry]]:
+        """Return ``(total, entries)`` for a slice of the ordered index."""
+        self.refresh()
+        order = self._order
+        end = len(order) if limit is None else offset + limit
+        return len(order), order[offset:end]
+
+    def __len__(self):
+        return len(self._order)
+
+    def thumbnail(self, name: str, make: Callable[[SampleEntry], bytes]) -> Optional[bytes]:
+        """Return the cached preview for ``name``, building it with ``make`` on first use."""
+        entry = self.get(name)
+        if entry is None:
+            return None
+        if entry.thumbnail is None:
+            entry.thumbnail = make(entry)
+        return entry.thumbnail
@@ -0,0 +1,82 @@
+"""
+Parameter sweeps for HeadNeRF (turntables, expression/identity blends).
+
+A sweep is a list of keyframes spaced evenly along the timeline; frames
+in between are linearly interpolated. Rendered frames are packed into an
+animated WebP, an MP4 or a zip of PNGs.
+"""
+
+import io
+import os
+import tempfile
+import zipfile
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+PARAM_NAMES = ("identity", "expression", "albedo", "illumination", "pitch", "yaw", "roll")
+
+FORMATS = {
+    "webp": ("image/webp", "webp"),
+    "mp4": ("video/mp4", "mp4"),
+    "zip": ("application/zip", "zip"),
+}
+
+
+def interpolate_keyframes(keyframes: List[Dict[str, float]], frames: int) -> List[Dict[str, float]]:
+    """Return ``frames`` parameter dicts interpolated across evenly spaced keyframes."""
+    if not keyframes:
+        raise ValueError("At least one keyframe is required")
+    if frames < 1:
+        raise ValueError("frames must be >= 1")
+
+    keys = np.array([[float(k.get(p, 0.0)) for p in PARAM_NAMES] for k in keyframes], dtype=np.float64)
+    if len(keys) == 1 or frames == 1:
+        values = np.repeat(keys[:1], frames, axis=0)
+    else:
+        key_t = np.linspace(0.0, 1.0, len(keys))
+        frame_t = np.linspace(0.0, 1.0, frames)
+        values = np.stack([np.interp(frame_t, key_t, keys[:, i]) for i in range(len(PARAM_NAMES))], axis=1)
+
+    return [dict(zip(PARAM_NAMES, row.tolist())) for row in values]
+
+
+def encode_frames(frames: List[np.ndarray], fmt: str, fps: int) -> Tuple[bytes, str, str]:
+    """Encode RGB frames. Returns ``(data, media_type, extension)``."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format: {fmt}")
+    media_type, ext = FORMATS[fmt]
+
+    if fmt == "zip":
+        buf = io.BytesIO()
+        # PNGs are already compressed; storing avoids a second deflate pass
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+            for i, frame in enumerate(frames):
+                _, png = cv2.imencode('.png', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                zf.writestr(f"frame_{i:04d}.png", png.tobytes())
+        return buf.getvalue(), media_type, ext
+
+    if fmt == "webp":
+        from PIL import Image
+        images = [Image.fromarray(f) for f in frames]
+        buf = io.BytesIO()
+        images[0].save(
+            buf, format="WEBP", save_all=True, append_images=images[1:],
+            duration=int(1000 / max(1, fps)), loop=0, quality=90
+        )
+        return buf.getvalue(), media_type, ext
+
+    # mp4: OpenCV's writer needs a real file
+    h, w = frames[0].shape[:2]
+    fd, tmp_path = tempfile.mkstemp(suffix=".mp4")
+    os.close(fd)
+    try:
+        writer = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+        for frame in frames:
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        writer.release()
+        with open(tmp_path, "rb") as f:
+            return f.read(), media_type, ext
+    finally:
+        os.remove(tmp_path)
@@ -1,6 +1,6 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from typing import List
-from fastapi.responses import FileResponse
+from fastapi import UploadFile, File, HTTPException, Form, Request
+from typing import List, Optional
+from fastapi.responses import FileResponse, Response
 import uuid
 from pathlib import Path
 import sys
@@ -11,172 +11,181 @@ import os
 os.chdir(str(SIMSWAP_ROOT))
 
 sys.path.insert(0, str(SIMSWAP_ROOT))
+sys.path.insert(0, str(BASE.parents[1]))  # facelab/ for the shared `common` package
+
+from common.metrics import stage
+from common.http_cache import file_response
+from common.readiness import NotReady
+from common.runtime import ServiceRuntime, read_upload
+
+# Heavy SimSwap modules (torch, insightface) are imported by the warmup
+# thread, so the port binds immediately and the app still starts when the
+# ML dependencies aren't installed.
+sys.path.insert(0, str(BASE))
+from swap_engine import MATCH_THRESHOLD, decode_bgr, encode_png_b64, load_face_detector, load_matcher, load_swapper
+
+# Shared runtime: app, /health, /ready, metrics, upload limits, the swap
+# queue and per-job directories. This service owns the shared uploads dir.
+# Two swap workers match the gateway's per-replica SimSwap concurrency.
+runtime = ServiceRuntime("simswap", "SimSwap Service", workers=2, max_queue=16,
+                         outputs_mb=1024, uploads_mb=4096)
+app = runtime.app
+storage = runtime.storage
+UPLOAD = runtime.upload_dir
+
+
+# -----------------------------
+# Warmup
+# -----------------------------
+runtime.add_model("swap", lambda: load_swapper(SIMSWAP_ROOT))
+# Optional: without insightface the swap fallback still serves /run
+runtime.add_model("face_detector", lambda: load_face_detector(SIMSWAP_ROOT), required=False)
+# ArcFace for mapping="auto" / /match_faces
+runtime.add_model("matcher", lambda: load_matcher(SIMSWAP_ROOT), required=False)
+
+
+def match_faces_in(src_paths: List[Path], dst_path: Path, threshold: float = MATCH_THRESHOLD) -> dict:
+    """Identity matching of the sources against every face in the target (runs on a worker)."""
+    import cv2
+
+    detector = runtime.model("face_detector")
+    matcher = runtime.model("matcher")
+    with stage("decode"):
+        sources = [cv2.imread(str(p), cv2.IMREAD_COLOR) for p in src_paths]
+        target = cv2.imread(str(dst_path), cv2.IMREAD_COLOR)
+    if target is None or any(img is None for img in sources):
+        raise ValueError("Could not read image")
+    return matcher.match_images(detector, sources, target, threshold)
+
+
+# Each swap gets its own job directory: the SimSwap scripts write fixed
+# result file names, so concurrent swaps must not share an output dir.
+#
+# preview=true swaps onto a shrunk target and answers with a small JPEG
+# (X-Job-Id header); the job keeps its inputs, and POST /upgrade/{job_id}
+# runs the full-resolution swap on them without another upload. The
+# gateway passes its own job_id so it can route the upgrade back here.
+def preview_response(swapper, job, src_paths: List[Path], dst_path: Path, multi: bool, mapping: str = ""):
+    job.save_meta({"src": [p.name for p in src_paths], "dst": dst_path.name, "multi": multi, "mapping": mapping})
+    data = runtime.run(swapper.preview, src_paths, dst_path, job.dir / "preview", multi, mapping,
+                       label="SimSwap (preview)")
+    return Response(data, media_type="image/jpeg", headers={"X-Job-Id": job.job_id})
 
-from test_wholeimage_swapsingle import run_swap
-
-# Defer importing heavy SimSwap modules until a request is received
-# to allow the FastAPI app to start even if ML dependencies aren't installed.
-
-app = FastAPI(title="SimSwap Service")
-
-BASE = Path(__file__).resolve().parent
-STORE = (BASE / "../../shared_storage").resolve()
-UPLOAD = STORE / "uploads"
-OUTPUT = STORE / "outputs" / "simswap"
-UPLOAD.mkdir(parents=True, exist_ok=True)
-OUTPUT.mkdir(parents=True, exist_ok=True)
-
-def save_upload(f: UploadFile, path: Path):
-    try:
-        f.file.seek(0)
-    except Exception:
-        pass
-    data = f.file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail="Uploaded file is empty")
-    path.write_bytes(data)
 
 @app.post("/run")
-def run(src: UploadFile = File(...), dst: UploadFile = File(...)):
-    # Import here to avoid heavy imports at startup
-    try:
-        from SimSwap.test_wholeimage_swapsingle import run_swap
-    except Exception as e:
-        # Provide a lightweight fallback so the gateway UI can be tested
-        # without heavy ML dependencies. The fallback simply copies the
-        # target image to the output folder as a placeholder result.
-        import shutil, os
-        def run_swap(src, dst, output_dir, crop_size=224, use_mask=False, no_simswaplogo=True):
-            os.makedirs(output_dir, exist_ok=True)
-            out_path = os.path.join(output_dir, 'result_whole_swapsingle.jpg')
-            try:
-                shutil.copyfile(dst, out_path)
-            except Exception:
-                # last-resort: copy src
-                try:
-                    shutil.copyfile(src, out_path)
-                except Exception:
-                    raise
-            return out_path
-        # attach original exception for visibility in logs
-        print(f"SimSwap import failed, using fallback run_swap: {e}")
-    job = uuid.uuid4().hex[:10]
-    src_path = UPLOAD / f"{job}_src.png"
-    dst_path = UPLOAD / f"{job}_dst.png"
-    save_upload(src, src_path)
-    save_upload(dst, dst_path)
-    arc_path = str(SIMSWAP_ROOT / "arcface_model" / "arcface_checkpoint.tar")
-
-    try:
-        run_swap(str(src_path), str(dst_path), str(OUTPUT), crop_size=224, arc_path=arc_path)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"SimSwap failed: {e}")
-
-
-    # สมมติว่า output ล่าสุดคือ result.png (คุณปรับให้ตรงของจริงได้)
-    # ถ้าของคุณชื่อไม่แน่นอน ให้ทำฟังก์ชันหาไฟล์ล่าสุด
-    out_img = max(OUTPUT.glob("*.*"), key=lambda p: p.stat().st_mtime, default=None)
-    if out_img is None:
-        raise HTTPException(500, "No output produced")
-
+def run(src: UploadFile = File(...), dst: UploadFile = File(...),
+        preview: bool = Form(False), job_id: Optional[str] = Form(None)):
+    swapper = runtime.model("swap")
+    with runtime.job(job_id) as job:
+        src_path = job.save_upload(src, "src.png")
+        dst_path = job.save_upload(dst, "dst.png")
+        if preview:
+            return preview_response(swapper, job, [src_path], dst_path, multi=False)
+        out_img = runtime.run(swapper.swap, src_path, dst_path, job.output_dir, label="SimSwap")
     return FileResponse(str(out_img))
 
 
 @app.post("/run_multi")
-def run_multi(src: List[UploadFile] = File(...), dst: UploadFile = File(...), mapping: str = Form("")):
-    try:
-        from SimSwap.test_wholeimage_swapmulti import run_swap
-    except Exception as e:
-        import shutil, os
-        def run_swap(src, dst, output_dir, crop_size=224, use_mask=False, no_simswaplogo=True, mapping=""):
-            os.makedirs(output_dir, exist_ok=True)
-            out_path = os.path.join(output_dir, 'result_whole_swapmulti.jpg')
-            try:
-                shutil.copyfile(dst, out_path)
-            except Exception:
-                try:
-                    shutil.copyfile(src, out_path)
-                except Exception:
-                    raise
-            return out_path
-        print(f"SimSwap import failed, using fallback run_swap (multi): {e}")
-
-    job = uuid.uuid4().hex[:10]
-    src_paths = []
-    for i, f in enumerate(src):
-        p = UPLOAD / f"{job}_src{i}.png"
-        save_upload(f, p)
-        src_paths.append(str(p))
-    dst_path = UPLOAD / f"{job}_dst.png"
-    save_upload(dst, dst_path)
-    arc_path = str(SIMSWAP_ROOT / "arcface_model" / "arcface_checkpoint.tar")
-
-    try:
-        # pass multiple source paths joined with ';' — test_wholeimage_swapmulti supports this
-        pic_a_arg = ';'.join(src_paths)
-        run_swap(pic_a_arg, str(dst_path), str(OUTPUT), crop_size=224, arc_path=arc_path, mapping=mapping)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"SimSwap (multi) failed: {e}")
-
-    out_img = max(OUTPUT.glob("*.*"), key=lambda p: p.stat().st_mtime, default=None)
+def run_multi(src: List[UploadFile] = File(...), dst: UploadFile = File(...), mapping: str = Form(""),
+              preview: bool = Form(False), job_id: Optional[str] = Form(None)):
+    swapper = runtime.model("swap")
+    with runtime.job(job_id) as job:
+        src_paths = [job.save_upload(f, f"src{i}.png") for i, f in enumerate(src)]
+        dst_path = job.save_upload(dst, "dst.png")
+        if mapping.strip().lower() == "auto":
+            # Pair sources with target faces by identity instead of a hand-written mapping
+            mapping = runtime.run(match_faces_in, src_paths, dst_path, label="Face matching")["mapping"]
+            if not mapping:
+                raise HTTPException(422, "No source matched a face in the target")
+        if preview:
+            response = preview_response(swapper, job, src_paths, dst_path, multi=True, mapping=mapping)
+        else:
+            out_img = runtime.run(swapper.swap_multi, src_paths, dst_path, job.output_dir,
+                                  mapping=mapping, label="SimSwap (multi)")
+            response = FileResponse(str(out_img))
+    response.headers["X-Face-Mapping"] = mapping
+    return response
+
+
+@app.post("/match_faces")
+def match_faces(src: List[UploadFile] = File(...), dst: UploadFile = File(...),
+                threshold: float = Form(MATCH_THRESHOLD)):
+    """
+    Pair every source face with a face in ``dst`` by ArcFace identity: one
+    batched embedding pass, a similarity matrix and an optimal one-to-one
+    assignment (pairs below ``threshold`` are left out). Returns the
+    "target:source" ``mapping`` for /run_multi plus per-pair scores.
+    """
+    with runtime.job() as job:
+        src_paths = [job.save_upload(f, f"src{i}.png") for i, f in enumerate(src)]
+        dst_path = job.save_upload(dst, "dst.png")
+        result = runtime.run(match_faces_in, src_paths, dst_path, threshold, label="Face matching")
+        job.discard()  # nothing to keep
+    return result
+
+
+@app.post("/upgrade/{job_id}")
+def upgrade(job_id: str):
+    """Full-resolution result of a previewed job (computed once, then served from the job dir)."""
+    job = runtime.open_job(job_id)
+    out_img = job.latest_output()
     if out_img is None:
-        raise HTTPException(500, "No output produced")
-
+        meta = job.load_meta()
+        swapper = runtime.model("swap")
+        out_img = runtime.run(swapper.run, [job.input_dir / n for n in meta["src"]], job.input_dir / meta["dst"],
+                              job.output_dir, meta["multi"], meta["mapping"], label="SimSwap")
     return FileResponse(str(out_img))
 
 
 @app.post("/detect_faces")
-def detect_faces(dst: UploadFile = File(...)):
-    # Save the uploaded file
+def detect_faces(dst: UploadFile = File(...), inline: bool = Form(False)):
+    """
+    Detect faces in ``dst``. Every face has its box [x1, y1, x2, y2] (pixels
+    of ``image_size``) and score. With ``inline`` the crops come back in this
+    response as base64 PNGs ("image"), so a group photo costs one round
+    trip; otherwise they are saved under /uploads ("file_path").
+    """
     job = uuid.uuid4().hex[:10]
-    dst_path = UPLOAD / f"{job}_dst_detect.png"
-    save_upload(dst, dst_path)
+    data = read_upload(dst)
 
     try:
         # Use SimSwap's face detection logic
         import cv2
-        import numpy as np
-        # Initialize Face_detect_crop locally or use shared
-        try:
-            from SimSwap.insightface_func.face_detect_crop_multi import Face_detect_crop
-        except ImportError:
-             print("SimSwap import failed inside detect_faces")
-             raise
-
-        # Assuming model paths are relative to SIMSWAP_ROOT
-        app_detect = Face_detect_crop(name='antelopeV2', root=str(SIMSWAP_ROOT / 'insightface_func/models'))
-        app_detect.prepare(ctx_id=0, det_thresh=0.6, det_size=(640,640))
-        
-        img = cv2.imread(str(dst_path))
+        detector = runtime.model("face_detector")  # 503 while loading
+
+        img = decode_bgr(data)
         if img is None:
             raise HTTPException(400, "Could not read image")
-            
-        crop_size = 224
-        img_align_crop_list, _ = app_detect.get(img, crop_size)
-        
-        if not img_align_crop_list:
+
+        faces = detector.faces(img)
+        if not faces:
             return {"faces": []}
 
         face_list = []
-        for i, face_img in enumerate(img_align_crop_list):
-            face_filename = f"{job}_face_{i}.png"
-            face_path = UPLOAD / face_filename
-            cv2.imwrite(str(face_path), face_img)
-            
-            face_list.append({
-                "index": i,
-                "file_path": f"/uploads/{face_filename}"
-            })
-            
-        return {"faces": face_list, "job_id": job}
-        
+        for i, face in enumerate(faces):
+            entry = {"index": i, "box": face["box"], "score": face["score"]}
+            if inline:
+                entry["image"] = encode_png_b64(face["crop"])
+            else:
+                face_filename = f"{job}_face_{i}.png"
+                with stage("encode_write"):
+                    cv2.imwrite(str(UPLOAD / face_filename), face["crop"])
+                entry["file_path"] = f"/uploads/{face_filename}"
+            face_list.append(entry)
+
+        return {"faces": face_list, "job_id": job, "image_size": [img.shape[1], img.shape[0]]}
+
+    except (HTTPException, NotReady):
+        raise
     except Exception as e:
         print(f"Error detecting faces: {e}")
         raise HTTPException(500, f"Face detection failed: {e}")
 
 @app.get("/uploads/{filename}")
-def get_upload(filename: str):
+def get_upload(filename: str, request: Request):
+    """Serve an uploaded file / face crop (immutable: ETag, Range, ?w= thumbnails)."""
     path = UPLOAD / filename
-    if not path.exists():
+    if not path.is_file():
         raise HTTPException(404, "File not found")
-    return FileResponse(str(path))
+    storage.touch(path)
+    return file_response(request, path)
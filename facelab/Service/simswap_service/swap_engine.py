@@ -0,0 +1,349 @@
+"""
+SimSwap engine: face swap entry points and the face detector, without FastAPI.
+
+app.py serves it over HTTP; in embedded mode the gateway loads it
+in-process. The SimSwap scripts work on files, so inputs are paths; the
+detector takes decoded BGR arrays. Model files are passed to the scripts
+as absolute paths under the SimSwap checkout, so a host process does not
+need to chdir into it.
+"""
+
+import inspect
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import List
+
+from common.metrics import model_load, stage
+from common.resources import configure_torch
+
+CROP_SIZE = 224
+# Cosine similarity below which a source is not paired with a target face
+MATCH_THRESHOLD = float(os.environ.get("FACELAB_MATCH_THRESHOLD", "0.3"))
+# Preview swaps run on a target shrunk to this longer side and return a JPEG
+PREVIEW_SIDE = int(os.environ.get("FACELAB_PREVIEW_SIDE", "512"))
+PREVIEW_QUALITY = int(os.environ.get("FACELAB_PREVIEW_QUALITY", "80"))
+
+
+def _fallback_swap(output_name: str, error: Exception):
+    """
+    Lightweight stand-in so the gateway UI can be tested without heavy ML
+    dependencies: copies the target image to the output folder.
+    """
+    print(f"SimSwap import failed, using fallback run_swap ({output_name}): {error}")
+
+    def run_swap(src, dst, output_dir, crop_size=CROP_SIZE, use_mask=False, no_simswaplogo=True, **kwargs):
+        os.makedirs(output_dir, exist_ok=True)
+        out_path = os.path.join(output_dir, output_name)
+        try:
+            shutil.copyfile(dst, out_path)
+        except Exception:
+            # last-resort: copy src
+            shutil.copyfile(src.split(';')[0], out_path)
+        return out_path
+    return run_swap
+
+
+def _result_path(returned, output_dir: Path) -> Path:
+    """The file a run_swap call produced (its return value, else the newest output)."""
+    if isinstance(returned, (str, os.PathLike)) and Path(returned).is_file():
+        return Path(returned)
+    out_img = max(Path(output_dir).glob("*.*"), key=lambda p: p.stat().st_mtime, default=None)
+    if out_img is None:
+        raise RuntimeError("No output produced")
+    return out_img
+
+
+def checkpoint_paths(root: Path) -> dict:
+    """SimSwap's model files (relative to its checkout by default), resolved absolutely."""
+    root = Path(root).resolve()
+    return {
+        "arc_path": str(root / "arcface_model" / "arcface_checkpoint.tar"),
+        "checkpoints_dir": str(root / "checkpoints"),
+        "parsing_model_path": str(root / "parsing_model" / "checkpoint" / "79999_iter.pth"),
+        "insightface_root": str(root / "insightface_func" / "models"),
+    }
+
+
+def _accepted(fn, kwargs: dict) -> dict:
+    """The subset of ``kwargs`` that ``fn`` takes (all of them if it has ``**kwargs``)."""
+    try:
+        params = inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return kwargs
+    if any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values()):
+        return kwargs
+    return {k: v for k, v in kwargs.items() if k in params}
+
+
+class Swapper:
+    """The single/multi swap entry points (real or fallback) for one SimSwap checkout."""
+
+    def __init__(self, root: Path, single, multi):
+        self.root = Path(root)
+        paths = checkpoint_paths(self.root)
+        self.arc_path = paths["arc_path"]
+        # arc_path is always passed; the other model paths where run_swap takes them
+        self._single_paths = {**_accepted(single, paths), "arc_path": self.arc_path}
+        self._multi_paths = {**_accepted(multi, paths), "arc_path": self.arc_path}
+        self._single = single
+        self._multi = multi
+
+    def swap(self, src_path: Path, dst_path: Path, output_dir: Path) -> Path:
+        with stage("inference"):
+            returned = self._single(str(src_path), str(dst_path), str(output_dir),
+                                    crop_size=CROP_SIZE, **self._single_paths)
+        return _result_path(returned, output_dir)
+
+    def swap_multi(self, src_paths: List[Path], dst_path: Path, output_dir: Path, mapping: str = "") -> Path:
+        # multiple source paths joined with ';' — test_wholeimage_swapmulti supports this
+        pic_a_arg = ';'.join(str(p) for p in src_paths)
+        with stage("inference"):
+            returned = self._multi(pic_a_arg, str(dst_path), str(output_dir),
+                                   crop_size=CROP_SIZE, mapping=mapping, **self._multi_paths)
+        return _result_path(returned, output_dir)
+
+    def run(self, src_paths: List[Path], dst_path: Path, output_dir: Path,
+            multi: bool = False, mapping: str = "") -> Path:
+        """``swap`` or ``swap_multi``, as stored with a job."""
+        if multi:
+            return self.swap_multi(src_paths, dst_path, output_dir, mapping=mapping)
+        return self.swap(src_paths[0], dst_path, output_dir)
+
+    def preview(self, src_paths: List[Path], dst_path: Path, output_dir: Path,
+                multi: bool = False, mapping: str = "") -> bytes:
+        """
+        Quick look: the same swap on a copy of the target shrunk to
+        PREVIEW_SIDE (so detection and paste-back run on far fewer pixels),
+        returned as a small JPEG. The inputs stay in place for the
+        full-resolution ``run``.
+        """
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        small = shrink_image(dst_path, dst_path.with_name(f"{dst_path.stem}.preview{dst_path.suffix}"), PREVIEW_SIDE)
+        return jpeg_bytes(self.run(src_paths, small, output_dir, multi, mapping))
+
+
+class FaceDetector:
+    """antelopeV2 detector built once and shared (calls are serialised)."""
+
+    def __init__(self, detector, face_align):
+        self._detector = detector
+        self._align = face_align
+        self._lock = threading.Lock()
+
+    def faces(self, img, crop_size: int = CROP_SIZE) -> List[dict]:
+        """
+        Faces in a BGR image: ``[{"crop", "box", "score"}]`` with the aligned
+        BGR crop, the detection box ``[x1, y1, x2, y2]`` in image pixels and
+        the detector score. Same detection and alignment as
+        ``Face_detect_crop.get``, which only returns the crops.
+        """
+        import cv2
+
+        det = self._detector
+        with stage("detection"), self._lock:
+            bboxes, kpss = det.det_model.detect(img, threshold=det.det_thresh, max_num=0, metric='default')
+        faces = []
+        if bboxes.shape[0] == 0 or kpss is None:
+            return faces
+        with stage("alignment"):
+            for bbox, kps in zip(bboxes, kpss):
+                M, _ = self._align.estimate_norm(kps, crop_size, mode=det.mode)
+                faces.append({
+                    "crop": cv2.warpAffine(img, M, (crop_size, crop_size), borderValue=0.0),
+                    "box": [round(float(v), 1) for v in bbox[:4]],
+                    "score": round(float(bbox[4]), 4),
+                })
+        return faces
+
+
+def load_swapper(root: Path) -> Swapper:
+    """Import the single/multi swap entry points (or their fallbacks)."""
+    with model_load("simswap"):
+        try:
+            from SimSwap.test_wholeimage_swapsingle import run_swap as single
+        except Exception as e:
+            single = _fallback_swap('result_whole_swapsingle.jpg', e)
+        try:
+            from SimSwap.test_wholeimage_swapmulti import run_swap as multi
+        except Exception as e:
+            multi = _fallback_swap('result_whole_swapmulti.jpg', e)
+        if "torch" in sys.modules:
+            configure_torch()
+    return Swapper(root, single, multi)
+
+
+def assign_faces(similarity, threshold: float = MATCH_THRESHOLD) -> List[tuple]:
+    """
+    Optimal one-to-one pairing of targets (rows) with sources (columns)
+    maximising total cosine similarity; pairs below ``threshold`` are
+    dropped. Returns ``[(target, source, similarity)]`` sorted by target.
+    """
+    import numpy as np
+
+    similarity = np.asarray(similarity, dtype=np.float32)
+    if similarity.size == 0:
+        return []
+    try:
+        from scipy.optimize import linear_sum_assignment
+
+        rows, cols = linear_sum_assignment(-similarity)
+    except ImportError:  # greedy on the sorted matrix: optimal unless pairs compete closely
+        rows, cols, used_r, used_c = [], [], set(), set()
+        for flat in np.argsort(-similarity, axis=None):
+            r, c = divmod(int(flat), similarity.shape[1])
+            if r not in used_r and c not in used_c:
+                used_r.add(r)
+                used_c.add(c)
+                rows.append(r)
+                cols.append(c)
+    pairs = [(int(r), int(c), float(similarity[r, c])) for r, c in zip(rows, cols)
+             if similarity[r, c] >= threshold]
+    return sorted(pairs)
+
+
+class IdentityMatcher:
+    """
+    ArcFace identities for aligned face crops, in one batched forward pass,
+    and the target/source assignment built from them. Uses the same
+    network and preprocessing as the swap (ImageNet normalisation, 112 px).
+    """
+
+    def __init__(self, arcface, device):
+        self._arcface = arcface
+        self._device = device
+        self._lock = threading.Lock()
+
+    def embed(self, crops: list):
+        """BGR crops (N, 224, 224, 3) -> L2-normalised identities (N, 512) as numpy."""
+        import numpy as np
+        import torch
+        import torch.nn.functional as F
+
+        if not crops:
+            return np.zeros((0, 512), dtype=np.float32)
+        batch = np.stack([c[:, :, ::-1] for c in crops]).astype(np.float32) / 255.0  # BGR -> RGB
+        mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+        std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+        batch = torch.from_numpy(((batch - mean) / std).transpose(0, 3, 1, 2).copy()).to(self._device)
+        with stage("embedding"), self._lock, torch.no_grad():
+            ids = self._arcface(F.interpolate(batch, size=(112, 112)))
+            ids = F.normalize(ids, p=2, dim=1)
+        return ids.cpu().numpy()
+
+    def match(self, source_crops: list, target_crops: list, threshold: float = MATCH_THRESHOLD) -> dict:
+        """
+        Pair target faces with sources: one embedding pass over all crops,
+        one similarity matrix, one assignment. ``mapping`` is the
+        "target:source,..." string run_multi takes.
+        """
+        ids = self.embed(list(source_crops) + list(target_crops))
+        src_ids, dst_ids = ids[:len(source_crops)], ids[len(source_crops):]
+        with stage("matching"):
+            similarity = dst_ids @ src_ids.T
+            pairs = assign_faces(similarity, threshold)
+        matched = {t for t, _, _ in pairs}
+        return {
+            "mapping": ",".join(f"{t}:{s}" for t, s, _ in pairs),
+            "pairs": [{"target": t, "source": s, "score": round(sim, 4)} for t, s, sim in pairs],
+            "unmatched_targets": [t for t in range(len(target_crops)) if t not in matched],
+            "similarity": [[round(float(v), 4) for v in row] for row in similarity],
+        }
+
+    def match_images(self, detector: "FaceDetector", source_imgs: list, target_img,
+                     threshold: float = MATCH_THRESHOLD) -> dict:
+        """``match`` on decoded BGR images: each source's best-scoring face against every target face."""
+        source_crops = []
+        for i, img in enumerate(source_imgs):
+            faces = detector.faces(img)
+            if not faces:
+                raise ValueError(f"No face found in source {i}")
+            source_crops.append(max(faces, key=lambda f: f["score"])["crop"])
+        target_faces = detector.faces(target_img)
+        if not target_faces:
+            raise ValueError("No face found in the target image")
+        result = self.match(source_crops, [f["crop"] for f in target_faces], threshold)
+        for pair in result["pairs"]:
+            pair["box"] = target_faces[pair["target"]]["box"]
+        return result
+
+
+def load_matcher(root: Path) -> IdentityMatcher:
+    """Load SimSwap's ArcFace checkpoint (a pickled module, needs the SimSwap root on sys.path)."""
+    import torch
+
+    configure_torch()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    with model_load("arcface"):
+        path = str(Path(root) / "arcface_model" / "arcface_checkpoint.tar")
+        try:
+            arcface = torch.load(path, map_location=device, weights_only=False)
+        except TypeError:  # torch < 1.13 has no weights_only
+            arcface = torch.load(path, map_location=device)
+        arcface = arcface.to(device).eval()
+    return IdentityMatcher(arcface, device)
+
+
+def load_face_detector(root: Path, det_thresh: float = 0.6, det_size=(640, 640)) -> FaceDetector:
+    """Build the antelopeV2 detector (model files under ``root``)."""
+    from SimSwap.insightface_func import face_detect_crop_multi
+
+    with model_load("face_detector"):
+        detector = face_detect_crop_multi.Face_detect_crop(name='antelopeV2', root=str(Path(root) / 'insightface_func/models'))
+        detector.prepare(ctx_id=0, det_thresh=det_thresh, det_size=det_size)
+    # the alignment module the detector's own get() uses
+    return FaceDetector(detector, face_detect_crop_multi.face_align)
+
+
+def shrink_image(src: Path, dest: Path, max_side: int) -> Path:
+    """``src`` resized so its longer side is at most ``max_side`` (``src`` itself if already small)."""
+    import cv2
+
+    img = cv2.imread(str(src), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not read image")
+    h, w = img.shape[:2]
+    if max(h, w) <= max_side:
+        return Path(src)
+    scale = max_side / max(h, w)
+    with stage("preview_resize"):
+        small = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(str(dest), small)
+    return Path(dest)
+
+
+def jpeg_bytes(path: Path, quality: int = PREVIEW_QUALITY) -> bytes:
+    """An image file re-encoded as JPEG."""
+    import cv2
+
+    img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+        raise RuntimeError(f"Could not read swap result {path}")
+    with stage("encode"):
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+def encode_png_b64(img) -> str:
+    """BGR array -> base64 PNG (for inline crops)."""
+    import base64
+    import cv2
+
+    with stage("encode"):
+        ok, buf = cv2.imencode(".png", img)
+    if not ok:
+        raise RuntimeError("PNG encoding failed")
+    return base64.b64encode(buf.tobytes()).decode("ascii")
+
+
+def decode_bgr(data: bytes):
+    """Encoded image bytes -> BGR array (None if undecodable)."""
+    import cv2
+    import numpy as np
+
+    with stage("decode"):
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
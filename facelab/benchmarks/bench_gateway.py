@@ -0,0 +1,356 @@
+"""
+Gateway load benchmark.
+
+Starts the stub model services (stub_services.py) and the real gateway on
+local ports, drives the gateway's /api/* routes with a fixed number of
+concurrent clients and reports throughput, latency percentiles and the
+gateway's memory use. No GPU or model weights are needed, so any gateway
+change can be checked for regressions on an ordinary Linux box.
+
+Examples:
+    python bench_gateway.py
+    python bench_gateway.py --scenarios simswap,headnerf_render --concurrency 1,8,32 --requests 400
+    python bench_gateway.py --image-size 1024 --json results.json
+    python bench_gateway.py --gateway-url http://127.0.0.1:8000   # benchmark an already running stack
+
+Stub latencies are set with --simswap-ms / --bg-removal-ms / --headnerf-ms.
+429 responses from admission control are counted separately from errors.
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from stub_services import make_png
+
+BENCH_DIR = Path(__file__).resolve().parent
+FACELAB_DIR = BENCH_DIR.parent
+GATEWAY_DIR = FACELAB_DIR / "gateway"
+
+# Directories the gateway writes results into (cleaned up after a run)
+OUTPUT_DIRS = [GATEWAY_DIR / "static", GATEWAY_DIR / "static" / "faces", FACELAB_DIR / "shared_storage" / "uploads"]
+
+STUBS = {
+    "simswap": ("simswap_app", "SIMSWAP_REPLICAS"),
+    "background_removal": ("bg_removal_app", "BG_REMOVAL_REPLICAS"),
+    "headnerf": ("headnerf_app", "HEADNERF_REPLICAS"),
+}
+
+
+# -----------------------------
+# Scenarios
+# -----------------------------
+class Payload:
+    """Upload images for one run (deterministic, generated once)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.src = make_png(size, size, 11)
+        self.dst = make_png(size, size, 12)
+
+
+def _simswap(s: requests.Session, base: str, p: Payload, worker: int):
+    files = {"src": ("src.png", p.src, "image/png"), "dst": ("dst.png", p.dst, "image/png")}
+    return s.post(f"{base}/api/simswap", files=files, timeout=600)
+
+
+def _simswap_multi_detect(s, base, p, worker):
+    return s.post(f"{base}/api/simswap_multi_detect", files={"dst": ("dst.png", p.dst, "image/png")}, timeout=600)
+
+
+def _simswap_multi_upload(s, base, p, worker):
+    files = [
+        ("src", ("a.png", p.src, "image/png")),
+        ("src", ("b.png", p.src, "image/png")),
+        ("dst", ("dst.png", p.dst, "image/png")),
+    ]
+    return s.post(f"{base}/api/simswap_multi_upload", files=files, data={"mapping": "0:0,1:1"}, timeout=600)
+
+
+def _background_removal(s, base, p, worker):
+    files = {"image": ("image.png", p.src, "image/png")}
+    data = {"mode": "color", "colors": "255,255,255|0,0,0"}
+    return s.post(f"{base}/api/background_removal", files=files, data=data, timeout=600)
+
+
+def _headnerf_render(s, base, p, worker):
+    params = {"yaw": (worker % 20) / 10 - 1, "session_id": f"bench-{worker}", "quality": "full"}
+    return s.get(f"{base}/api/headnerf/render", params=params, timeout=60)
+
+
+def _headnerf_samples(s, base, p, worker):
+    return s.get(f"{base}/api/headnerf/samples", params={"offset": 0, "limit": 12}, timeout=60)
+
+
+def _headnerf_sweep(s, base, p, worker):
+    body = {"keyframes": [{"yaw": -1}, {"yaw": 1}], "frames": 12, "format": "webp"}
+    return s.post(f"{base}/api/headnerf/sweep", json=body, params={"session_id": f"bench-{worker}"}, timeout=600)
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "simswap": _simswap,
+    "simswap_multi_detect": _simswap_multi_detect,
+    "simswap_multi_upload": _simswap_multi_upload,
+    "background_removal": _background_removal,
+    "headnerf_render": _headnerf_render,
+    "headnerf_samples": _headnerf_samples,
+    "headnerf_sweep": _headnerf_sweep,
+}
+
+
+# -----------------------------
+# Processes
+# -----------------------------
+def _uvicorn(app: str, port: int, app_dir: Path, env: dict, factory: bool = False) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port),
+           "--app-dir", str(app_dir), "--log-level", "warning"]
+    if factory:
+        cmd.append("--factory")
+    return subprocess.Popen(cmd, cwd=str(app_dir), env=env)
+
+
+def _wait_healthy(url: str, proc: Optional[subprocess.Popen], timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {proc.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy within {timeout:.0f}s")
+
+
+class Stack:
+    """Stub services plus a gateway pointed at them."""
+
+    def __init__(self, args, image_size: int):
+        self.args = args
+        self.image_size = image_size
+        self.procs: List[subprocess.Popen] = []
+        self.gateway: Optional[subprocess.Popen] = None
+
+    def __enter__(self):
+        env = dict(os.environ)
+        env.update({
+            "STUB_SIMSWAP_MS": str(self.args.simswap_ms),
+            "STUB_BG_REMOVAL_MS": str(self.args.bg_removal_ms),
+            "STUB_HEADNERF_MS": str(self.args.headnerf_ms),
+            "STUB_IMAGE_SIZE": str(self.image_size),
+        })
+        gateway_env = dict(env)
+        try:
+            for i, (name, (factory, env_key)) in enumerate(STUBS.items()):
+                port = self.args.base_port + 1 + i
+                self.procs.append(_uvicorn(f"stub_services:{factory}", port, BENCH_DIR, env, factory=True))
+                gateway_env[env_key] = f"http://127.0.0.1:{port}"
+            for proc, port in zip(self.procs, range(self.args.base_port + 1, self.args.base_port + 1 + len(STUBS))):
+                _wait_healthy(f"http://127.0.0.1:{port}", proc)
+            self.gateway = _uvicorn("app:app", self.args.base_port, GATEWAY_DIR, gateway_env)
+            self.procs.append(self.gateway)
+            _wait_healthy(self.url, self.gateway)
+        except Exception:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.args.base_port}"
+
+    def __exit__(self, *exc):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def rss_mb(pid: Optional[int]) -> Dict[str, Optional[float]]:
+    """Current and peak resident set size of a process (Linux /proc)."""
+    result = {"rss_mb": None, "peak_rss_mb": None}
+    if pid is None:
+        return result
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                result["rss_mb"] = int(line.split()[1]) / 1024
+            elif line.startswith("VmHWM:"):
+                result["peak_rss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return result
+
+
+# -----------------------------
+# Load driver
+# -----------------------------
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    k = math.ceil(pct / 100 * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, k))]
+
+
+def run_scenario(name: str, base: str, payload: Payload, concurrency: int,
+                 total: int, warmup: int, gateway_pid: Optional[int]) -> dict:
+    fn = SCENARIOS[name]
+    local = threading.local()
+
+    def session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    for i in range(warmup):
+        fn(session(), base, payload, i)
+
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    errors = 0
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(worker_id: int):
+        nonlocal errors
+        s = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                status = fn(s, base, payload, worker_id).status_code
+            except requests.RequestException:
+                status = None
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status is None:
+                    errors += 1
+                else:
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status == 200:
+                        latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for f in [pool.submit(worker, w) for w in range(concurrency)]:
+            f.result()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ok = statuses.get(200, 0)
+    rejected = statuses.get(429, 0)
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "image_size": payload.size,
+        "requests": total,
+        "ok": ok,
+        "rejected_429": rejected,
+        "errors": errors + sum(n for code, n in statuses.items() if code not in (200, 429)),
+        "throughput_rps": ok / wall if wall > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": (sum(latencies) / len(latencies) * 1000) if latencies else float("nan"),
+        **rss_mb(gateway_pid),
+    }
+
+
+def _fmt(v, width, prec=1):
+    if v is None:
+        return "-".rjust(width)
+    if isinstance(v, float):
+        return f"{v:{width}.{prec}f}"
+    return str(v).rjust(width)
+
+
+def print_table(results: List[dict]):
+    header = (f"{'scenario':<22}{'conc':>5}{'size':>6}{'ok':>7}{'429':>6}{'err':>5}"
+              f"{'req/s':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'rssMB':>8}{'peakMB':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<22}{_fmt(r['concurrency'], 5)}{_fmt(r['image_size'], 6)}"
+              f"{_fmt(r['ok'], 7)}{_fmt(r['rejected_429'], 6)}{_fmt(r['errors'], 5)}"
+              f"{_fmt(r['throughput_rps'], 9)}{_fmt(r['p50_ms'], 9)}{_fmt(r['p95_ms'], 9)}"
+              f"{_fmt(r['p99_ms'], 9)}{_fmt(r['rss_mb'], 8)}{_fmt(r['peak_rss_mb'], 8)}")
+
+
+def _snapshot_outputs() -> set:
+    return {p for d in OUTPUT_DIRS if d.is_dir() for p in d.iterdir() if p.is_file()}
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8", help="comma-separated client counts")
+    parser.add_argument("--image-size", default="512", help="comma-separated upload image edge sizes (px)")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario/level")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests before each scenario")
+    parser.add_argument("--simswap-ms", type=float, default=80)
+    parser.add_argument("--bg-removal-ms", type=float, default=40)
+    parser.add_argument("--headnerf-ms", type=float, default=25)
+    parser.add_argument("--base-port", type=int, default=18000, help="gateway port; stubs use the next three")
+    parser.add_argument("--gateway-url", help="benchmark a running gateway instead of starting the stack")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {unknown}")
+    args.image_size = _int_list(args.image_size)
+
+    before = _snapshot_outputs()
+    results = []
+    try:
+        with (nullcontext() if args.gateway_url else Stack(args, args.image_size[0])) as stack:
+            base = args.gateway_url.rstrip("/") if args.gateway_url else stack.url
+            pid = stack.gateway.pid if stack is not None else None
+            for size in args.image_size:
+                payload = Payload(size)
+                for name in scenarios:
+                    for conc in _int_list(args.concurrency):
+                        print(f"running {name} (concurrency={conc}, image={size}px) ...", flush=True)
+                        results.append(run_scenario(name, base, payload, conc, args.requests, args.warmup, pid))
+    finally:
+        # Don't leave benchmark results behind in the gateway's static/upload dirs
+        for path in _snapshot_outputs() - before:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    print()
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+        print(f"\nwrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
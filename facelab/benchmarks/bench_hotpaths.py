@@ -0,0 +1,258 @@
+"""
+Micro-benchmarks for the CPU-side image hot paths.
+
+Covers the non-model work the services do per request:
+  - background removal compositing (solid colour, custom image, blur)
+  - upload save and decode
+  - HeadNeRF image_to_base64 (png/jpg) and the mask-network input normalisation
+
+Each case runs on synthetic images from 0.3 to 24 megapixels and reports
+median time and peak traced memory (numpy/Python heap via tracemalloc),
+both per megapixel. Results are compared with a stored baseline and the
+script exits non-zero when a case regresses beyond the threshold.
+
+Examples:
+    python bench_hotpaths.py                      # compare with baselines/hotpaths.json
+    python bench_hotpaths.py --sizes 0.3,2 --cases compositing
+    python bench_hotpaths.py --update-baseline    # record this machine's numbers
+
+Baselines are machine specific: record them on the machine that runs the
+check. A case with no baseline entry fails the check (an empty baseline
+would otherwise pass everything); pass --allow-missing for ad-hoc runs.
+"""
+
+import argparse
+import io
+import json
+import math
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+BENCH_DIR = Path(__file__).resolve().parent
+SERVICE_DIR = BENCH_DIR.parent / "Service"
+DEFAULT_BASELINE = BENCH_DIR / "baselines" / "hotpaths.json"
+DEFAULT_SIZES = "0.3,2,8,24"
+
+sys.path.insert(0, str(SERVICE_DIR / "background_removal_service"))
+import compositing
+
+try:
+    sys.path.insert(0, str(SERVICE_DIR / "headnerf_service"))
+    import imaging
+except ImportError as e:  # cv2 missing in this environment
+    imaging = None
+    print(f"skipping HeadNeRF cases: {e}")
+
+
+# -----------------------------
+# Inputs
+# -----------------------------
+class Inputs:
+    """Deterministic synthetic inputs for one image size."""
+
+    def __init__(self, megapixels: float, workdir: Path):
+        self.megapixels = megapixels
+        w = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+        h = int(w * 3 / 4)
+        self.size = (w, h)
+        self.workdir = workdir
+
+        rng = np.random.default_rng(0)
+        yy, xx = np.mgrid[0:h, 0:w]
+        base = np.stack([xx * 255 // max(1, w - 1), yy * 255 // max(1, h - 1), (xx + yy) % 256], axis=2)
+        self.rgb = np.clip(base + rng.integers(-12, 12, base.shape), 0, 255).astype(np.uint8)
+        del base, yy, xx
+
+        # Soft elliptical "person" mask
+        cy, cx = h / 2, w / 2
+        yy, xx = np.ogrid[0:h, 0:w]
+        d = ((yy - cy) / (h * 0.4)) ** 2 + ((xx - cx) / (w * 0.3)) ** 2
+        self.mask = (np.clip(1.5 - d, 0, 1) * 255).astype(np.uint8)
+
+        self.rgba = Image.fromarray(np.dstack([self.rgb, self.mask]), "RGBA")
+        self.image = Image.fromarray(self.rgb)
+        self.png_bytes = _encode(self.image, "PNG")
+        self.jpeg_bytes = _encode(self.image, "JPEG")
+        self.bg_jpeg_bytes = _encode(Image.fromarray(self.rgb[::-1, ::-1].copy()), "JPEG")
+
+
+def _encode(img: Image.Image, fmt: str) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, quality=90)
+    return buf.getvalue()
+
+
+# -----------------------------
+# Cases
+# -----------------------------
+def _cases() -> Dict[str, Callable[[Inputs], Callable[[], object]]]:
+    """name -> setup(inputs) returning the zero-argument call to measure."""
+    cases = {
+        "compositing.color": lambda i: lambda: compositing.replace_background_color(i.rgb, i.mask, (255, 255, 255)),
+        "compositing.image": lambda i: lambda: compositing.replace_background_image(i.rgb, i.mask, i.bg_jpeg_bytes),
+        "compositing.blur": lambda i: lambda: compositing.blur_background(i.image, i.rgb, i.mask, radius=15),
+        "compositing.split_rgba": lambda i: lambda: compositing.split_rgba(i.rgba),
+        "upload.decode_png": lambda i: lambda: compositing.decode_image(i.png_bytes),
+        "upload.decode_jpeg": lambda i: lambda: compositing.decode_image(i.jpeg_bytes),
+        "upload.save": lambda i: lambda: (i.workdir / "upload.bin").write_bytes(i.jpeg_bytes),
+    }
+    if imaging is not None:
+        cases.update({
+            "headnerf.base64_png": lambda i: lambda: imaging.image_to_base64(i.rgb, "png"),
+            "headnerf.base64_jpg": lambda i: lambda: imaging.image_to_base64(i.rgb, "jpg"),
+            "headnerf.normalize": lambda i: lambda: imaging.normalize_for_mask(i.rgb),
+        })
+    return cases
+
+
+def measure(fn: Callable[[], object], min_time: float, max_runs: int) -> Tuple[float, float]:
+    """Median seconds per call, and peak traced bytes of one call."""
+    fn()  # warm-up
+    times = []
+    started = time.perf_counter()
+    while len(times) < 3 or (time.perf_counter() - started < min_time and len(times) < max_runs):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+# -----------------------------
+# Baseline comparison
+# -----------------------------
+def load_baseline(path: Path) -> dict:
+    if not path.exists():
+        return {"results": {}}
+    return json.loads(path.read_text())
+
+
+def compare(results: Dict[str, dict], baseline: dict, time_threshold: float,
+            memory_threshold: float) -> List[str]:
+    """Describe every case that regressed beyond the thresholds."""
+    regressions = []
+    for key, r in results.items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            r["vs_baseline"] = "new"
+            continue
+        time_ratio = r["ms_per_mp"] / base["ms_per_mp"] if base["ms_per_mp"] else 1.0
+        mem_ratio = r["peak_mb_per_mp"] / base["peak_mb_per_mp"] if base["peak_mb_per_mp"] else 1.0
+        r["vs_baseline"] = f"time x{time_ratio:.2f}, mem x{mem_ratio:.2f}"
+        if time_ratio > 1 + time_threshold:
+            regressions.append(f"{key}: {r['ms_per_mp']:.2f} ms/MP vs baseline {base['ms_per_mp']:.2f} "
+                               f"(+{(time_ratio - 1) * 100:.0f}%)")
+        if mem_ratio > 1 + memory_threshold:
+            regressions.append(f"{key}: {r['peak_mb_per_mp']:.2f} MB/MP vs baseline {base['peak_mb_per_mp']:.2f} "
+                               f"(+{(mem_ratio - 1) * 100:.0f}%)")
+    return regressions
+
+
+def print_table(results: Dict[str, dict]):
+    header = f"{'case':<32}{'MP':>6}{'ms':>11}{'ms/MP':>9}{'peakMB':>9}{'MB/MP':>8}  vs baseline"
+    print(header)
+    print("-" * len(header))
+    for key, r in results.items():
+        print(f"{r['case']:<32}{r['megapixels']:>6.1f}{r['ms']:>11.2f}{r['ms_per_mp']:>9.2f}"
+              f"{r['peak_mb']:>9.1f}{r['peak_mb_per_mp']:>8.2f}  {r.get('vs_baseline', '')}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated image sizes in megapixels")
+    parser.add_argument("--cases", default="", help="only run cases whose name contains one of these (comma-separated)")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to keep repeating each case")
+    parser.add_argument("--max-runs", type=int, default=50)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed time regression (0.25 = +25%%)")
+    parser.add_argument("--memory-threshold", type=float, default=0.10, help="allowed peak memory regression")
+    parser.add_argument("--update-baseline", action="store_true", help="write these results as the new baseline")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="don't fail on cases that have no baseline entry yet")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args(argv)
+
+    sizes = [float(x) for x in args.sizes.split(",") if x.strip()]
+    filters = [f.strip() for f in args.cases.split(",") if f.strip()]
+    cases = {n: c for n, c in _cases().items() if not filters or any(f in n for f in filters)}
+
+    results: Dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mp in sizes:
+            inputs = Inputs(mp, Path(tmp))
+            actual_mp = inputs.size[0] * inputs.size[1] / 1e6
+            for name, setup in cases.items():
+                print(f"running {name} @ {mp:g} MP ...", flush=True)
+                seconds, peak = measure(setup(inputs), args.min_time, args.max_runs)
+                results[f"{name}@{mp:g}MP"] = {
+                    "case": name,
+                    "megapixels": mp,
+                    "ms": seconds * 1000,
+                    "ms_per_mp": seconds * 1000 / actual_mp,
+                    "peak_mb": peak / 2**20,
+                    "peak_mb_per_mp": peak / 2**20 / actual_mp,
+                }
+            del inputs
+
+    baseline = load_baseline(args.baseline)
+    regressions = [] if args.update_baseline else compare(
+        results, baseline, args.threshold, args.memory_threshold)
+
+    print()
+    print_table(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        merged = dict(baseline.get("results", {}))
+        merged.update({k: {"ms_per_mp": round(r["ms_per_mp"], 4), "peak_mb_per_mp": round(r["peak_mb_per_mp"], 4)}
+                       for k, r in results.items()})
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({
+            "recorded": datetime.now().isoformat(timespec="seconds"),
+            "machine": f"{platform.node()} {platform.machine()} {platform.processor()}".strip(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "results": dict(sorted(merged.items())),
+        }, indent=2) + "\n")
+        print(f"\nbaseline written to {args.baseline}")
+        return 0
+
+    failed = False
+    missing = [k for k, r in results.items() if r.get("vs_baseline") == "new"]
+    if missing:
+        print(f"\n{'WARNING' if args.allow_missing else 'ERROR'}: {len(missing)} case(s) have no baseline entry "
+              f"in {args.baseline} and were not checked:")
+        for key in missing:
+            print(f"  {key}")
+        print("record them with --update-baseline on the machine that runs this check")
+        failed = not args.allow_missing
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond threshold:")
+        for line in regressions:
+            print(f"  {line}")
+        failed = True
+    if failed:
+        return 1
+    print("\nno regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Throughput versus thread allocation for co-located services.
+
+Runs N service-like processes side by side on one core budget. Each
+process runs W worker threads that repeat a CPU-bound kernel, and the
+libraries use either their default thread pools (every pool sized to the
+whole machine, which is the oversubscribed baseline) or the partitioned
+allocation from common/resources.py (each process gets its share of the
+cores, split among its workers). Reports total kernel throughput per
+configuration, relative to the library defaults.
+
+Kernels (whichever libraries are installed):
+    matmul   numpy float32 matrix multiply (BLAS threads)
+    opencv   cv2 Gaussian blur + resize of a 4 MP image (OpenCV threads)
+    torch    3x3 convolution on a 1x32x256x256 tensor (torch intra-op threads)
+
+Examples:
+    python bench_threads.py
+    python bench_threads.py --services 4 --workers 1,2,4 --kernels opencv,torch --duration 10
+    python bench_threads.py --cpus 16 --affinity --json threads.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))  # facelab/ for the shared `common` package
+from common.resources import ResourcePlan, partition, usable_cpus
+
+KERNELS = ("matmul", "opencv", "torch")
+
+
+# -----------------------------
+# Child process: one "service"
+# -----------------------------
+def _kernel(name: str):
+    """Build the kernel after the thread settings are in place; returns a no-arg callable."""
+    if name == "matmul":
+        import numpy as np
+
+        a = np.random.default_rng(0).random((768, 768), dtype=np.float32)
+        return lambda: a @ a
+    if name == "opencv":
+        import cv2
+        import numpy as np
+
+        img = np.random.default_rng(0).integers(0, 255, (1536, 2560, 3), dtype=np.uint8)
+        return lambda: cv2.resize(cv2.GaussianBlur(img, (0, 0), 3), (1280, 768), interpolation=cv2.INTER_AREA)
+    if name == "torch":
+        import torch
+
+        conv = torch.nn.Conv2d(32, 32, 3, padding=1).eval()
+        x = torch.randn(1, 32, 256, 256)
+
+        def run():
+            with torch.no_grad():
+                conv(x)
+        return run
+    raise ValueError(f"unknown kernel {name}")
+
+
+def child(args) -> int:
+    cpus = [int(c) for c in args.child_cpus.split(",")]
+    plan: Optional[ResourcePlan] = None
+    if args.child_threads:  # partitioned; 0 = library defaults
+        plan = ResourcePlan("bench", cpus, args.child_workers, threads=args.child_threads, affinity=args.affinity)
+        plan.apply_env()
+        plan.pin()
+    try:
+        kernel = _kernel(args.child_kernel)
+    except ImportError as e:
+        print(json.dumps({"skipped": str(e)}))
+        return 0
+    if plan is not None:
+        plan.configure_loaded()
+
+    kernel()  # warm up (lazy pool creation, first-call allocations)
+    counts = [0] * args.child_workers
+    start_at = time.time() + 0.2
+    deadline = start_at + args.duration
+
+    def worker(i):
+        while time.time() < start_at:
+            time.sleep(0.001)
+        while time.time() < deadline:
+            kernel()
+            counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.child_workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(json.dumps({"ops": sum(counts), "seconds": args.duration}))
+    return 0
+
+
+# -----------------------------
+# Driver
+# -----------------------------
+def run_config(kernel: str, slices: List[List[int]], workers: int, partitioned: bool,
+               duration: float, affinity: bool) -> Optional[dict]:
+    """Start one process per slice at once; total ops/s across them."""
+    procs = []
+    for cpus in slices:
+        threads = max(1, len(cpus) // workers) if partitioned else 0
+        cmd = [sys.executable, __file__, "--child-kernel", kernel, "--child-cpus", ",".join(map(str, cpus)),
+               "--child-workers", str(workers), "--child-threads", str(threads), "--duration", str(duration)]
+        if affinity:
+            cmd.append("--affinity")
+        env = dict(os.environ)
+        if not partitioned:
+            for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "OPENCV_FOR_THREADS_NUM"):
+                env.pop(var, None)
+        procs.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, env=env))
+    total = 0.0
+    for p in procs:
+        out, _ = p.communicate()
+        try:
+            result = json.loads(out.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            return None
+        if "skipped" in result:
+            print(f"  {kernel}: skipped ({result['skipped']})")
+            return None
+        total += result["ops"] / result["seconds"]
+    return {
+        "kernel": kernel,
+        "services": len(slices),
+        "workers": workers,
+        "threads": max(1, len(slices[0]) // workers) if partitioned else "default",
+        "ops_per_s": total,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kernels", default=",".join(KERNELS), help="comma-separated kernels")
+    parser.add_argument("--services", type=int, default=4, help="co-located processes sharing the cores")
+    parser.add_argument("--workers", default="1,2", help="comma-separated worker threads per process")
+    parser.add_argument("--cpus", type=int, default=0, help="core budget (default: all usable cores)")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per configuration")
+    parser.add_argument("--affinity", action="store_true", help="pin partitioned processes to their cores")
+    parser.add_argument("--json", help="also write results to this file")
+    # child mode (internal)
+    parser.add_argument("--child-kernel", help=argparse.SUPPRESS)
+    parser.add_argument("--child-cpus", help=argparse.SUPPRESS)
+    parser.add_argument("--child-workers", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--child-threads", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child_kernel:
+        return child(args)
+
+    cpus = usable_cpus()
+    if args.cpus:
+        cpus = cpus[:args.cpus]
+    names = [f"service{i}" for i in range(args.services)]
+    slices = list(partition(cpus, {n: 1.0 for n in names}, names).values())
+    print(f"{len(cpus)} cores, {args.services} co-located processes, {args.duration:g}s per configuration\n")
+
+    results: List[dict] = []
+    for kernel in [k.strip() for k in args.kernels.split(",") if k.strip()]:
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            baseline = None
+            for partitioned in (False, True):
+                print(f"running {kernel}, {workers} worker(s), {'partitioned' if partitioned else 'defaults'} ...",
+                      flush=True)
+                r = run_config(kernel, slices, workers, partitioned, args.duration, args.affinity)
+                if r is None:
+                    break
+                baseline = baseline or r["ops_per_s"]
+                r["vs_default"] = r["ops_per_s"] / baseline if baseline else 1.0
+                results.append(r)
+
+    print()
+    header = f"{'kernel':<8}{'services':>9}{'workers':>8}{'threads':>9}{'ops/s':>11}{'vs default':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['kernel']:<8}{r['services']:>9}{r['workers']:>8}{str(r['threads']):>9}"
+              f"{r['ops_per_s']:>11.1f}{r['vs_default']:>11.2f}x")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"cpus": len(cpus), "results": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""
+Stand-in model services for gateway benchmarks.
+
+Each app implements the endpoints the gateway calls on the real service
+(same paths, parameters and response shapes) but replaces the model with
+a fixed sleep and returns deterministic PNGs, so the gateway can be load
+tested on a machine without GPUs or model weights.
+
+Run one directly with:
+    uvicorn stub_services:simswap_app --factory --port 8001
+    uvicorn stub_services:bg_removal_app --factory --port 8002
+    uvicorn stub_services:headnerf_app --factory --port 8003
+
+Latency and output size come from the environment:
+    STUB_SIMSWAP_MS, STUB_BG_REMOVAL_MS, STUB_HEADNERF_MS, STUB_FIT_MS
+    STUB_IMAGE_SIZE (square output edge in pixels)
+"""
+
+import base64
+import os
+import struct
+import sys
+import time
+import uuid
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import Body, FastAPI, File, Form, HTTPException, Query, Response, UploadFile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # facelab/ for the shared `common` package
+from common.metrics import install_metrics, stage
+from common.tracing import install_tracing
+
+SIMSWAP_MS = float(os.environ.get("STUB_SIMSWAP_MS", "80"))
+BG_REMOVAL_MS = float(os.environ.get("STUB_BG_REMOVAL_MS", "40"))
+HEADNERF_MS = float(os.environ.get("STUB_HEADNERF_MS", "25"))
+FIT_MS = float(os.environ.get("STUB_FIT_MS", "500"))
+IMAGE_SIZE = int(os.environ.get("STUB_IMAGE_SIZE", "512"))
+
+
+# -----------------------------
+# Deterministic images
+# -----------------------------
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+@lru_cache(maxsize=32)
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """RGB gradient PNG; the same arguments always give the same bytes."""
+    rows = []
+    for y in range(height):
+        row = bytearray(b"\x00")  # filter type: none
+        g = (y * 255 // max(1, height - 1) + seed * 37) & 0xFF
+        for x in range(width):
+            row += bytes(((x * 255 // max(1, width - 1) + seed * 91) & 0xFF, g, (x ^ y ^ seed) & 0xFF))
+        rows.append(bytes(row))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header)
+            + _png_chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + _png_chunk(b"IEND", b""))
+
+
+def fake_inference(ms: float):
+    """Stand in for model time (sync routes, so this occupies a worker thread like the real models)."""
+    with stage("inference"):
+        time.sleep(ms / 1000.0)
+
+
+def _new_app(title: str, service: str) -> FastAPI:
+    app = FastAPI(title=title)
+    install_metrics(app, service)
+    install_tracing(app, service)
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "service": service, "stub": True}
+
+    return app
+
+
+def _png_response(seed: int = 0, size: Optional[int] = None) -> Response:
+    size = size or IMAGE_SIZE
+    return Response(content=make_png(size, size, seed), media_type="image/png")
+
+
+# -----------------------------
+# SimSwap stub
+# -----------------------------
+def simswap_app() -> FastAPI:
+    """SimSwap stand-in (``uvicorn stub_services:simswap_app --factory``)."""
+    app = _new_app("SimSwap Service (stub)", "simswap")
+
+    @app.post("/run")
+    def simswap_run(src: UploadFile = File(...), dst: UploadFile = File(...)):
+        with stage("upload_read"):
+            src.file.read()
+            dst.file.read()
+        fake_inference(SIMSWAP_MS)
+        return _png_response(1)
+
+    @app.post("/run_multi")
+    def simswap_run_multi(src: List[UploadFile] = File(...), dst: UploadFile = File(...), mapping: str = Form("")):
+        with stage("upload_read"):
+            for f in src:
+                f.file.read()
+            dst.file.read()
+        fake_inference(SIMSWAP_MS * max(1, len(src)))
+        return _png_response(2)
+
+    @app.post("/detect_faces")
+    def simswap_detect_faces(dst: UploadFile = File(...), inline: bool = Form(False)):
+        with stage("upload_read"):
+            dst.file.read()
+        fake_inference(SIMSWAP_MS / 2)
+        job = uuid.uuid4().hex[:10]
+        faces = []
+        for i in range(2):
+            face = {"index": i, "box": [i * 240.0, 40.0, i * 240.0 + 224.0, 264.0], "score": 0.99}
+            if inline:
+                face["image"] = base64.b64encode(make_png(224, 224, 3)).decode("ascii")
+            else:
+                face["file_path"] = f"/uploads/{job}_face_{i}.png"
+            faces.append(face)
+        return {"faces": faces, "job_id": job, "image_size": [IMAGE_SIZE, IMAGE_SIZE]}
+
+    @app.get("/uploads/{filename}")
+    def simswap_upload(filename: str):
+        return _png_response(3, 224)
+
+    return app
+
+
+# -----------------------------
+# Background removal stub
+# -----------------------------
+def bg_removal_app() -> FastAPI:
+    """Background removal stand-in (``uvicorn stub_services:bg_removal_app --factory``)."""
+    app = _new_app("Background Removal Service (stub)", "background_removal")
+
+    @app.post("/run")
+    def bg_removal_run(
+        image: UploadFile = File(...),
+        bg_image: UploadFile = File(None),
+        colors: str = Form(None),
+        mode: str = Form("color")
+    ):
+        with stage("upload_read"):
+            image.file.read()
+            if bg_image:
+                bg_image.file.read()
+        fake_inference(BG_REMOVAL_MS)
+        job_id = uuid.uuid4().hex[:10]
+        count = len(colors.split("|")) if (mode == "color" and colors) else 1
+        return {
+            "ok": True,
+            "job_id": job_id,
+            "results": [f"/static/background_removal/{job_id}_{i}.png" for i in range(count)],
+            "colors_used": [],
+            "mode": mode,
+        }
+
+    @app.get("/static/background_removal/{filename}")
+    def bg_removal_result(filename: str):
+        return _png_response(4)
+
+    return app
+
+
+# -----------------------------
+# HeadNeRF stub
+# -----------------------------
+def headnerf_app() -> FastAPI:
+    """HeadNeRF stand-in (``uvicorn stub_services:headnerf_app --factory``)."""
+    app = _new_app("HeadNeRF Service (stub)", "headnerf")
+    samples = [f"sample_{i:03d}.pth" for i in range(24)]
+
+    @app.get("/samples")
+    def headnerf_samples(response: Response, offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=1)):
+        page = samples[offset:offset + limit if limit else None]
+        response.headers["X-Total-Count"] = str(len(samples))
+        return [
+            {"name": n, "path": f"LatentCodeSamples/stub/{n}", "size": 4096, "preview_url": f"/samples/{n}/preview"}
+            for n in page
+        ]
+
+    @app.get("/samples/{sample_name}/preview")
+    def headnerf_preview(sample_name: str):
+        return Response(content=make_png(128, 128, 5), media_type="image/jpeg")
+
+    @app.get("/current")
+    def headnerf_current(session_id: Optional[str] = None):
+        return {"source": samples[0], "target": samples[1]}
+
+    @app.post("/set_source")
+    @app.post("/set_target")
+    def headnerf_set_slot(sample_name: str = Query(...), session_id: Optional[str] = None):
+        if sample_name not in samples:
+            raise HTTPException(404, f"Sample not found: {sample_name}")
+        fake_inference(HEADNERF_MS)
+        return {"ok": True, "sample": sample_name, "preview_base64": base64.b64encode(make_png(256, 256, 6)).decode()}
+
+    @app.get("/render_quick")
+    def headnerf_render_quick(session_id: Optional[str] = None, quality: Optional[str] = None):
+        fake_inference(HEADNERF_MS if quality != "preview" else HEADNERF_MS / 4)
+        size = 256 if quality == "preview" else IMAGE_SIZE
+        with stage("encode"):
+            image = base64.b64encode(make_png(size, size, 7)).decode()
+        return {"ok": True, "image": image, "format": "png", "quality": quality}
+
+    @app.get("/quality_levels")
+    def headnerf_quality_levels():
+        return {"budget_ms": 150, "levels": [
+            {"name": "preview", "model": "stub", "format": "png", "loaded": True, "render_ms": HEADNERF_MS / 4},
+            {"name": "full", "model": "stub", "format": "png", "loaded": True, "render_ms": HEADNERF_MS},
+        ]}
+
+    @app.post("/render_sweep")
+    def headnerf_render_sweep(body: dict = Body(...), session_id: Optional[str] = None):
+        frames = int(body.get("frames", 36))
+        fake_inference(HEADNERF_MS * frames)
+        return Response(
+            content=make_png(IMAGE_SIZE, IMAGE_SIZE, 8) * max(1, frames // 8),
+            media_type="image/webp",
+            headers={"X-Frame-Count": str(frames), "Content-Disposition": 'attachment; filename="headnerf_sweep.webp"'},
+        )
+
+    @app.post("/fit")
+    def headnerf_fit(image: UploadFile = File(...), wait: bool = True):
+        with stage("upload_read"):
+            image.file.read()
+        job_id = uuid.uuid4().hex[:8]
+        if not wait:
+            return {"ok": True, "job_id": job_id, "status": "queued"}
+        fake_inference(FIT_MS)
+        return {"ok": True, "job_id": job_id, "fitted_name": f"fitted_{job_id}.pth", "cached": False, "timings": {}}
+
+    @app.get("/fit/jobs/{job_id}")
+    def headnerf_fit_job(job_id: str):
+        return {"job_id": job_id, "status": "done", "stage": None, "timings": {}}
+
+    return app
@@ -0,0 +1 @@
+"""Shared helpers used by the gateway and every model service (stdlib + FastAPI only)."""
@@ -0,0 +1,176 @@
+"""
+Cache-friendly delivery of result files.
+
+Result files are written once under random job names and never change,
+so they are served with a strong content-hash ETag and
+``Cache-Control: public, max-age=31536000, immutable``. Conditional GETs
+(``If-None-Match``) get a 304, and single byte ranges (``Range``, with
+``If-Range``) get a 206, so browsers and any CDN in front of the gateway
+stop re-downloading multi-megabyte PNGs.
+
+``?w=<width>`` on an image returns a JPEG thumbnail that is generated once
+and stored next to the original (``<name>.w256.jpg``), so the storage
+manager evicts it like any other artefact. Thumbnails need Pillow; without
+it the original is served.
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+THUMBNAIL_WIDTHS = (128, 256, 512)
+THUMBNAIL_QUALITY = 80
+_IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_THUMB_NAME = re.compile(r"\.w\d+\.jpg$")
+
+
+class _ETagCache:
+    """Content hashes keyed by (path, size, mtime) so each file is hashed once."""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path, st: os.stat_result) -> str:
+        key = (str(path), st.st_size, st.st_mtime_ns)
+        with self._lock:
+            etag = self._entries.get(key)
+            if etag is not None:
+                self._entries.move_to_end(key)
+                return etag
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        etag = f'"{digest.hexdigest()[:32]}"'
+        with self._lock:
+            self._entries[key] = etag
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+
+_etags = _ETagCache()
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _parse_range(header: str, size: int):
+    """Single byte range -> (start, end) inclusive; None to ignore; ValueError if unsatisfiable."""
+    m = _RANGE.match(header.strip())
+    if m is None:
+        return None  # multiple or malformed ranges: serve the whole file
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
+
+def thumbnail(path: Path, width: int) -> Optional[Path]:
+    """Path of a cached JPEG thumbnail of ``path`` (created on first use); None if unavailable."""
+    if width not in THUMBNAIL_WIDTHS or path.suffix.lower() not in _IMAGE_SUFFIXES:
+        return None
+    if _THUMB_NAME.search(path.name):
+        return None  # already a thumbnail
+    thumb = path.with_name(f"{path.name}.w{width}.jpg")
+    if thumb.exists():
+        return thumb
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        tmp = thumb.with_name(f".{thumb.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        img.save(tmp, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    os.replace(tmp, thumb)
+    return thumb
+
+
+def file_response(request: Request, path: Path, media_type: Optional[str] = None,
+                  st: Optional[os.stat_result] = None) -> Response:
+    """
+    Serve an immutable file with ETag/Cache-Control, honouring
+    If-None-Match, Range/If-Range and ``?w=`` thumbnails. Blocking (hashes
+    the file on first use): call from a sync route or a threadpool.
+    """
+    width = request.query_params.get("w")
+    if width and width.isdigit():
+        thumb = thumbnail(path, int(width))
+        if thumb is not None:
+            path, st, media_type = thumb, None, "image/jpeg"
+
+    st = st or path.stat()
+    etag = _etags.get(path, st)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, st.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            with open(path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+            return Response(
+                content=data,
+                status_code=206,
+                media_type=media_type or mimetypes.guess_type(str(path))[0] or "application/octet-stream",
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{st.st_size}"},
+            )
+
+    return FileResponse(str(path), media_type=media_type, headers=headers, stat_result=st)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles for immutable results: strong ETags, long max-age, ranges, thumbnails."""
+
+    def __init__(self, *args, on_access: Optional[Callable[[Path], None]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_access = on_access
+
+    async def get_response(self, path: str, scope) -> Response:
+        from starlette.concurrency import run_in_threadpool
+
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+        full_path, st = await run_in_threadpool(self.lookup_path, path)
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return await super().get_response(path, scope)
+        if self.on_access is not None:
+            self.on_access(Path(full_path))
+        return await run_in_threadpool(file_response, Request(scope), Path(full_path), None, st)
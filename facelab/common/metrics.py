@@ -0,0 +1,279 @@
+"""
+Minimal Prometheus metrics for FaceLab services.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text exposition format. ``install_metrics`` adds request metrics and a
+``/metrics`` endpoint to a FastAPI app; ``stage`` times a block of work
+(decode, inference, encode, ...) into the per-stage latency histogram
+and, inside a traced request, into its Server-Timing breakdown.
+
+Only the standard library is used so every service environment can
+import it.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from . import tracing
+
+# Seconds; covers sub-millisecond encodes up to multi-minute fits
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> str:
+        return f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.type_name}\n"
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> str:
+        lines = [self.header()]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(v)}\n")
+        return "".join(lines)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        """Sample ``fn()`` at scrape time (e.g. a queue's current depth)."""
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    def render(self) -> str:
+        lines = [self.header()]
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = float(fn())
+            except Exception:
+                continue
+        for key, v in sorted(values.items()):
+            lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(v)}\n")
+        return "".join(lines)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count], sum
+        self._counts: Dict[Tuple[str, ...], list] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[idx] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        lines = [self.header()]
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        for key, counts, total in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="%s"' % _fmt_value(bound)
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cumulative}\n")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(total)}\n")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {cumulative}\n")
+        return "".join(lines)
+
+
+class Registry:
+    """Holds metrics and renders them for scraping."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(m.render() for m in metrics)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "facelab_requests_total", "HTTP requests handled", ("service", "method", "route", "status"))
+IN_FLIGHT = REGISTRY.gauge(
+    "facelab_requests_in_flight", "HTTP requests currently being handled", ("service",))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "facelab_request_duration_seconds", "HTTP request latency", ("service", "route"))
+STAGE_SECONDS = REGISTRY.histogram(
+    "facelab_stage_duration_seconds", "Latency of a processing stage within a request", ("service", "stage"))
+MODEL_LOAD_SECONDS = REGISTRY.gauge(
+    "facelab_model_load_seconds", "Time taken to load a model", ("service", "model"))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "facelab_queue_depth", "Jobs waiting in a queue", ("service", "queue"))
+
+# Service name used by ``stage`` when none is passed (set by install_metrics)
+_service_name = "unknown"
+
+
+@contextmanager
+def stage(name: str, service: Optional[str] = None):
+    """Time a block of work into ``facelab_stage_duration_seconds`` and the request's timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start, service)
+
+
+def observe_stage(name: str, seconds: float, service: Optional[str] = None):
+    """Record a stage duration measured elsewhere."""
+    STAGE_SECONDS.observe(seconds, service=service or _service_name, stage=name)
+    tracing.record(name, seconds)
+
+
+@contextmanager
+def model_load(model: str, service: Optional[str] = None):
+    """Time a model load into ``facelab_model_load_seconds``."""
+    start = time.perf_counter()
+    yield
+    MODEL_LOAD_SECONDS.set(time.perf_counter() - start, service=service or _service_name, model=model)
+
+
+def _route_template(app, scope) -> str:
+    """Match the request against the app's routes to get a low-cardinality label."""
+    from starlette.routing import Match
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "unmatched"
+
+
+def install_metrics(app, service: str):
+    """Add request metrics middleware and a ``/metrics`` endpoint to ``app``."""
+    global _service_name
+    _service_name = service
+
+    from fastapi.responses import PlainTextResponse
+
+    @app.middleware("http")
+    async def _metrics_middleware(request, call_next):
+        if request.url.path == "/metrics":
+            return await call_next(request)
+        route = _route_template(app, request.scope)
+        IN_FLIGHT.inc(service=service)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            IN_FLIGHT.dec(service=service)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, service=service, route=route)
+            REQUESTS.inc(service=service, method=request.method, route=route, status=str(status))
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
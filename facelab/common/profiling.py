@@ -0,0 +1,285 @@
+"""
+On-demand profiling for running FaceLab services.
+
+``install_profiling`` adds admin endpoints (guarded by the
+``FACELAB_ADMIN_TOKEN`` environment variable, sent as the
+``X-Admin-Token`` header) that profile the live process:
+
+    POST /admin/profile/cpu?seconds=10      sample every thread for 10 s
+    POST /admin/profile/cpu?requests=20     ... until 20 more requests finish
+    GET  /admin/profile/memory              tracemalloc top sites, numpy/torch memory
+
+The CPU profiler samples ``sys._current_frames()`` from a background
+thread, so it sees the threadpool workers running sync routes and the
+HeadNeRF fit worker (cProfile only sees the thread that enabled it). The
+result is a collapsed-stack file ("a;b;c 42" per line) that speedscope
+or flamegraph.pl open directly. With no token configured the endpoints
+are disabled.
+"""
+
+import asyncio
+import gc
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+ADMIN_TOKEN_ENV = "FACELAB_ADMIN_TOKEN"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+DEFAULT_INTERVAL = 0.005  # seconds between samples
+MAX_PROFILE_SECONDS = 300.0
+TRACEMALLOC_FRAMES = 10
+
+# Leaf frames that mean "thread is parked", skipped unless idle=true
+_IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("selectors.py", "poll"),
+    ("thread.py", "_worker"),
+}
+
+
+class SamplingProfiler:
+    """Samples the stacks of every other thread at a fixed interval."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="facelab-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(f"thread:{names.get(ident, ident)}")
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Collapsed-stack text (speedscope / flamegraph.pl input)."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+# -----------------------------
+# Memory snapshot
+# -----------------------------
+def _rss() -> dict:
+    info = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    info[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return {"rss_bytes": info.get("VmRSS"), "peak_rss_bytes": info.get("VmHWM")}
+
+
+def _live_arrays():
+    """Yield numpy arrays and torch tensors reachable from GC-tracked containers (deduplicated)."""
+    np = sys.modules.get("numpy")
+    torch = sys.modules.get("torch")
+    types = tuple(t for t in (np and np.ndarray, torch and torch.Tensor) if t)
+    if not types:
+        return
+    seen = set()
+    for obj in gc.get_objects():
+        candidates = [obj] if isinstance(obj, types) else gc.get_referents(obj)
+        for ref in candidates:
+            if isinstance(ref, types) and id(ref) not in seen:
+                seen.add(id(ref))
+                yield ref
+
+
+def _array_summary(top: int) -> dict:
+    np = sys.modules.get("numpy")
+    torch = sys.modules.get("torch")
+    numpy_total, numpy_count = 0, 0
+    numpy_shapes: Counter = Counter()
+    tensor_bytes: Counter = Counter()
+    tensor_count: Counter = Counter()
+    for arr in _live_arrays():
+        if np is not None and isinstance(arr, np.ndarray):
+            if arr.base is not None:
+                continue  # views share their base's memory
+            numpy_total += arr.nbytes
+            numpy_count += 1
+            numpy_shapes[f"{arr.dtype}{list(arr.shape)}"] += arr.nbytes
+        elif torch is not None:
+            device = str(arr.device)
+            tensor_bytes[device] += arr.element_size() * arr.nelement()
+            tensor_count[device] += 1
+
+    summary = {}
+    if np is not None:
+        summary["numpy"] = {
+            "arrays": numpy_count,
+            "bytes": numpy_total,
+            "largest": [{"array": k, "bytes": v} for k, v in numpy_shapes.most_common(top)],
+        }
+    if torch is not None:
+        summary["torch"] = {
+            "tensors": {d: {"count": tensor_count[d], "bytes": b} for d, b in tensor_bytes.items()},
+        }
+        if torch.cuda.is_available():
+            summary["torch"]["cuda"] = [
+                {
+                    "device": i,
+                    "allocated_bytes": torch.cuda.memory_allocated(i),
+                    "reserved_bytes": torch.cuda.memory_reserved(i),
+                    "max_allocated_bytes": torch.cuda.max_memory_allocated(i),
+                }
+                for i in range(torch.cuda.device_count())
+            ]
+    return summary
+
+
+def memory_snapshot(top: int = 30) -> dict:
+    """RSS, tracemalloc top allocation sites and numpy/torch memory."""
+    snapshot = {"rss": _rss()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        snapshot["tracemalloc"] = {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {"site": str(s.traceback[0]), "bytes": s.size, "count": s.count}
+                for s in stats[:top]
+            ],
+        }
+    else:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshot["tracemalloc"] = {
+            "started": True,
+            "note": "tracing started now; request again to see allocations made since",
+        }
+    snapshot.update(_array_summary(top))
+    return snapshot
+
+
+# -----------------------------
+# FastAPI wiring
+# -----------------------------
+def install_profiling(app, service: str):
+    """Add the admin profiling endpoints (and a completed-request counter) to ``app``."""
+    from fastapi import Depends, Header, HTTPException, Query
+    from fastapi.responses import Response
+
+    state = {"busy": False, "completed": 0, "waiters": []}  # waiters: [(target, asyncio.Event)]
+
+    def require_admin(x_admin_token: Optional[str] = Header(None)):
+        token = os.environ.get(ADMIN_TOKEN_ENV)
+        if not token:
+            raise HTTPException(404, "Profiling is disabled (set FACELAB_ADMIN_TOKEN)")
+        if not x_admin_token or not hmac.compare_digest(x_admin_token, token):
+            raise HTTPException(403, "Invalid admin token")
+
+    @app.middleware("http")
+    async def _count_requests(request, call_next):
+        try:
+            return await call_next(request)
+        finally:
+            if state["waiters"] and not request.url.path.startswith("/admin/"):
+                state["completed"] += 1
+                for target, event in state["waiters"]:
+                    if state["completed"] >= target:
+                        event.set()
+
+    def _download(content, filename: str, media_type: str) -> Response:
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+
+    @app.post("/admin/profile/cpu", dependencies=[Depends(require_admin)], include_in_schema=False)
+    async def profile_cpu(
+        seconds: Optional[float] = Query(None, gt=0, le=MAX_PROFILE_SECONDS),
+        requests: Optional[int] = Query(None, ge=1),
+        interval_ms: float = Query(DEFAULT_INTERVAL * 1000, ge=1, le=1000),
+        idle: bool = False,
+    ):
+        """
+        Sample all threads for `seconds`, or until `requests` more requests
+        complete (bounded by 300 s). Returns a collapsed-stack file.
+        """
+        if seconds is None and requests is None:
+            seconds = 10.0
+        if state["busy"]:
+            raise HTTPException(409, "A CPU profile is already running")
+        state["busy"] = True
+
+        profiler = SamplingProfiler(interval=interval_ms / 1000, include_idle=idle)
+        waiter = None
+        profiler.start()
+        try:
+            if requests is not None:
+                waiter = (state["completed"] + requests, asyncio.Event())
+                state["waiters"].append(waiter)
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout=seconds or MAX_PROFILE_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(seconds)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+            if waiter is not None:
+                state["waiters"].remove(waiter)
+            state["busy"] = False
+
+        print(f"[profile] {service} cpu: {profiler.samples} samples over {profiler.duration:.1f}s")
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return _download(profiler.collapsed(), f"{service}-cpu-{stamp}.folded", "text/plain")
+
+    @app.get("/admin/profile/memory", dependencies=[Depends(require_admin)], include_in_schema=False)
+    def profile_memory(top: int = Query(30, ge=1, le=500), stop: bool = False):
+        """
+        Memory snapshot: RSS, tracemalloc top allocation sites (tracing
+        starts on the first call) and live numpy/torch memory. `stop=true`
+        turns tracemalloc off again after the snapshot.
+        """
+        snapshot = {"service": service, "time": time.time(), **memory_snapshot(top)}
+        if stop and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return _download(json.dumps(snapshot, indent=2, default=str),
+                         f"{service}-memory-{stamp}.json", "application/json")
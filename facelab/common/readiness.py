@@ -0,0 +1,159 @@
+"""
+Background model warmup and readiness probes.
+
+Services bind their port straight away and load models on a background
+thread. ``/health`` stays a liveness check (the process answers);
+``/ready`` returns 200 only once every required component is loaded, so
+the gateway (and any orchestrator) keeps traffic away from a replica that
+is still importing torch or reading checkpoints during a restart.
+
+    warmup = Warmup("background_removal")
+    warmup.add("u2net", load_u2net)
+    install_readiness(app, warmup)
+    ...
+    session = warmup.get("u2net")   # waits up to FACELAB_READY_WAIT seconds
+
+Loaders run one after another (so models don't compete for the GPU while
+loading). A component whose loader failed is retried inline by the next
+``get``; optional components don't block ``/ready``.
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+READY_WAIT_SECONDS = float(os.environ.get("FACELAB_READY_WAIT", "30"))
+RETRY_AFTER_SECONDS = 5
+
+PENDING, LOADING, READY, FAILED = "pending", "loading", "ready", "failed"
+
+
+class NotReady(Exception):
+    """A component is still loading; surfaced as 503 with Retry-After."""
+
+    def __init__(self, message: str, retry_after: int = RETRY_AFTER_SECONDS):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Component:
+    def __init__(self, name: str, loader: Callable[[], Any], required: bool):
+        self.name = name
+        self.loader = loader
+        self.required = required
+        self.state = PENDING
+        self.value: Any = None
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self.done = threading.Event()  # set once the first load attempt finished
+        self.lock = threading.Lock()
+
+    def info(self) -> dict:
+        info = {"state": self.state, "required": self.required}
+        if self.seconds is not None:
+            info["load_seconds"] = round(self.seconds, 3)
+        if self.error:
+            info["error"] = self.error
+        return info
+
+
+class Warmup:
+    """Named components loaded in the background, with blocking access."""
+
+    def __init__(self, service: str, wait: float = READY_WAIT_SECONDS):
+        self.service = service
+        self.wait = wait
+        self.started = time.time()
+        self._components: Dict[str, _Component] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, name: str, loader: Callable[[], Any], required: bool = True):
+        """Register a loader; its return value is what ``get(name)`` hands out."""
+        self._components[name] = _Component(name, loader, required)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"{self.service}-warmup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        for component in self._components.values():
+            try:
+                self._load(component)
+            except Exception as e:
+                print(f"[warmup] {self.service}: {component.name} failed to load: {e}")
+
+    def _load(self, component: _Component):
+        with component.lock:
+            if component.state == READY:
+                return
+            component.state = LOADING
+            started = time.perf_counter()
+            try:
+                component.value = component.loader()
+            except Exception as e:
+                component.state, component.error = FAILED, str(e)
+                raise
+            finally:
+                component.seconds = time.perf_counter() - started
+                component.done.set()
+            component.state, component.error = READY, None
+        print(f"[warmup] {self.service}: {component.name} ready in {component.seconds:.1f}s")
+
+    def get(self, name: str, timeout: Optional[float] = None):
+        """
+        The loaded component, waiting up to ``timeout`` (default
+        FACELAB_READY_WAIT) for the warmup thread. Raises ``NotReady`` if it
+        is still loading; a failed component is retried here.
+        """
+        component = self._components[name]
+        if component.state == READY:
+            return component.value
+        if self._thread is None:
+            self._load(component)  # warmup never started (scripts, tests): load inline
+            return component.value
+        if not component.done.wait(self.wait if timeout is None else timeout):
+            raise NotReady(f"{self.service}: {name} is still loading")
+        if component.state != READY:
+            self._load(component)
+        return component.value
+
+    def is_ready(self, name: Optional[str] = None) -> bool:
+        if name is not None:
+            return self._components[name].state == READY
+        return all(c.state == READY for c in self._components.values() if c.required)
+
+    def status(self) -> dict:
+        return {
+            "service": self.service,
+            "ready": self.is_ready(),
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "components": {name: c.info() for name, c in self._components.items()},
+        }
+
+
+def install_readiness(app, warmup: Warmup):
+    """Start ``warmup`` with the app, add ``/ready`` and map ``NotReady`` to 503."""
+    from fastapi.responses import JSONResponse
+    from .metrics import REGISTRY
+
+    ready = REGISTRY.gauge("facelab_component_ready", "1 once a model/component is loaded", ("service", "component"))
+
+    @app.on_event("startup")
+    def _start_warmup():
+        # Components are final by now (they may be added after this call)
+        for name in warmup._components:
+            ready.set_function(lambda n=name: float(warmup.is_ready(n)), service=warmup.service, component=name)
+        warmup.start()
+
+    @app.exception_handler(NotReady)
+    async def _not_ready(request, exc: NotReady):
+        return JSONResponse({"detail": str(exc)}, status_code=503,
+                            headers={"Retry-After": str(exc.retry_after)})
+
+    @app.get("/ready")
+    def readiness():
+        """Readiness probe: 200 once every required model is loaded, 503 before."""
+        status = warmup.status()
+        return JSONResponse(status, status_code=200 if status["ready"] else 503)
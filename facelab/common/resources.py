@@ -0,0 +1,219 @@
+"""
+CPU budgets for services that share a node.
+
+torch, onnxruntime, OpenCV and the BLAS behind numpy each size their
+thread pools to every core of the machine. With the gateway, SimSwap,
+background removal and HeadNeRF on the same node that is four (or more)
+full-size pools competing for the same cores, and throughput under
+concurrent load drops instead of rising. Each service instead gets a
+slice of the cores and splits it among its workers:
+
+    threads per worker = service cores // workers
+
+which becomes torch intra-op threads (inter-op 1), onnxruntime session
+threads, OpenCV threads and the OMP/MKL/OpenBLAS pools. With
+``FACELAB_CPU_AFFINITY=1`` the service is also pinned to its slice.
+
+Configuration (environment):
+    FACELAB_CPUS              cores shared by the co-located services (default: usable cores)
+    FACELAB_CPU_SHARES        relative weights, e.g. "gateway=1,simswap=3,background_removal=2,headnerf=2"
+    FACELAB_COLOCATED         services on this node (default: gateway,simswap,background_removal,headnerf)
+    FACELAB_<SERVICE>_CPUS    explicit core count for one service (overrides its share)
+    FACELAB_<SERVICE>_WORKERS worker count (the threads are split among them)
+    FACELAB_CPU_AFFINITY      1 to pin each service to its own cores
+    FACELAB_RESOURCES         0 to leave every library at its defaults
+
+Call ``apply_resources`` before numpy/cv2/torch are imported (thread pool
+sizes are read from the environment at import), and ``configure_torch``
+right after torch is imported. Explicitly set OMP_NUM_THREADS etc. win.
+"""
+
+import os
+import sys
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_SHARES = "gateway=1,simswap=3,background_removal=2,headnerf=2,difareli=1"
+DEFAULT_COLOCATED = "gateway,simswap,background_removal,headnerf"
+# OpenMP/BLAS pools, and OpenCV's default when cv2 is imported later
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                   "OPENCV_FOR_THREADS_NUM")
+
+_plan: Optional["ResourcePlan"] = None
+
+
+def usable_cpus() -> List[int]:
+    """Cores this process may run on (respects cgroup/taskset affinity)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _parse_shares(value: str) -> Dict[str, float]:
+    shares = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, weight = item.split("=", 1)
+            shares[name.strip()] = float(weight)
+    return shares
+
+
+def partition(cpus: List[int], shares: Dict[str, float], services: List[str]) -> Dict[str, List[int]]:
+    """
+    Split ``cpus`` into contiguous slices by weight (largest remainder, at
+    least one core each). With fewer cores than services the slices wrap
+    around and overlap.
+    """
+    services = [s for s in services if shares.get(s, 1.0) > 0] or services
+    weights = [shares.get(s, 1.0) for s in services]
+    total = sum(weights)
+    exact = [len(cpus) * w / total for w in weights]
+    counts = [max(1, int(x)) for x in exact]
+    by_remainder = sorted(range(len(services)), key=lambda i: exact[i] - int(exact[i]), reverse=True)
+    for i in by_remainder:
+        if sum(counts) >= len(cpus):
+            break
+        counts[i] += 1
+    slices, start = {}, 0
+    for name, count in zip(services, counts):
+        slices[name] = [cpus[(start + k) % len(cpus)] for k in range(count)]
+        start += count
+    return slices
+
+
+class ResourcePlan:
+    """Cores and per-library thread counts for one service process."""
+
+    def __init__(self, service: str, cpus: List[int], workers: int = 1, threads: Optional[int] = None,
+                 affinity: bool = False, enabled: bool = True):
+        self.service = service
+        self.cpus = list(cpus)
+        self.workers = max(1, workers)
+        self.threads = max(1, threads or len(self.cpus) // self.workers)
+        self.affinity = affinity
+        self.enabled = enabled
+
+    @classmethod
+    def from_env(cls, service: str, workers: int = 1, includes: Iterable[str] = ()) -> "ResourcePlan":
+        """``includes``: co-located services running inside this process (their share moves here)."""
+        key = service.upper()
+        workers = int(os.environ.get(f"FACELAB_{key}_WORKERS", workers))
+        enabled = os.environ.get("FACELAB_RESOURCES", "1") != "0"
+        affinity = os.environ.get("FACELAB_CPU_AFFINITY", "0") == "1"
+        cpus = usable_cpus()
+        if os.environ.get("FACELAB_CPUS"):
+            cpus = cpus[:max(1, int(os.environ["FACELAB_CPUS"]))]
+        shares = _parse_shares(os.environ.get("FACELAB_CPU_SHARES", DEFAULT_SHARES))
+        colocated = [s.strip() for s in os.environ.get("FACELAB_COLOCATED", DEFAULT_COLOCATED).split(",") if s.strip()]
+        if service not in colocated:
+            colocated.append(service)
+        for name in includes:
+            shares[service] = shares.get(service, 1.0) + shares.get(name, 1.0)
+            colocated = [s for s in colocated if s != name]
+        mine = partition(cpus, shares, colocated)[service]
+        if os.environ.get(f"FACELAB_{key}_CPUS"):
+            count = max(1, int(os.environ[f"FACELAB_{key}_CPUS"]))
+            start = cpus.index(mine[0]) if mine and mine[0] in cpus else 0
+            mine = [cpus[(start + k) % len(cpus)] for k in range(min(count, len(cpus)))]
+        return cls(service, mine, workers, affinity=affinity, enabled=enabled)
+
+    # -----------------------------
+    # Applying
+    # -----------------------------
+    def apply_env(self):
+        """Size the OpenMP/BLAS/OpenCV pools (read when numpy/torch/cv2 are imported)."""
+        for var in THREAD_ENV_VARS:
+            os.environ.setdefault(var, str(self.threads))
+
+    def pin(self):
+        """Restrict this process to its cores (threads started afterwards inherit the mask)."""
+        if self.affinity and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                print(f"[resources] {self.service}: could not pin to cores {self.cpus}: {e}")
+
+    def configure_torch(self):
+        import torch
+
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:  # only allowed before the first parallel op
+            pass
+
+    def configure_opencv(self):
+        import cv2
+
+        cv2.setNumThreads(self.threads)
+
+    def configure_loaded(self):
+        """Configure the libraries that are already imported."""
+        if "torch" in sys.modules:
+            self.configure_torch()
+        if "cv2" in sys.modules:
+            self.configure_opencv()
+
+    def ort_options(self):
+        """onnxruntime SessionOptions with this plan's threads (for sessions built here)."""
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = self.threads
+        opts.inter_op_num_threads = 1
+        return opts
+
+    def info(self) -> dict:
+        return {
+            "service": self.service,
+            "enabled": self.enabled,
+            "cpus": self.cpus,
+            "affinity": self.affinity,
+            "workers": self.workers,
+            "threads_per_worker": self.threads,
+            "torch": {"intra_op": self.threads, "inter_op": 1},
+            "onnxruntime": {"intra_op": self.threads, "inter_op": 1},
+            "opencv": self.threads,
+            "env": {var: os.environ.get(var) for var in THREAD_ENV_VARS},
+        }
+
+
+def apply_resources(service: str, workers: int = 1, includes: Iterable[str] = ()) -> ResourcePlan:
+    """Build this process's plan from the environment and apply it (once)."""
+    global _plan
+    if _plan is not None:
+        return _plan
+    plan = ResourcePlan.from_env(service, workers, includes)
+    if plan.enabled:
+        plan.apply_env()
+        plan.pin()
+        plan.configure_loaded()
+        print(f"[resources] {service}: {len(plan.cpus)} cores, {plan.workers} worker(s) x {plan.threads} thread(s)"
+              + (f", pinned to {plan.cpus}" if plan.affinity else ""))
+    _plan = plan
+    return plan
+
+
+def current_plan() -> Optional[ResourcePlan]:
+    return _plan
+
+
+def configure_torch():
+    """Call right after importing torch (model loaders); no-op without a plan."""
+    if _plan is not None and _plan.enabled:
+        _plan.configure_torch()
+
+
+def install_resources(app, plan: ResourcePlan):
+    """Add ``GET /resources`` and per-pool thread gauges."""
+    from .metrics import REGISTRY
+
+    threads = REGISTRY.gauge("facelab_threads", "Threads allocated to a library pool", ("service", "pool"))
+    if plan.enabled:
+        for pool in ("torch", "onnxruntime", "opencv", "openmp"):
+            threads.set(plan.threads, service=plan.service, pool=pool)
+        threads.set(plan.workers, service=plan.service, pool="workers")
+
+    @app.get("/resources")
+    def resources():
+        """CPU budget and thread allocation of this process."""
+        return plan.info()
@@ -0,0 +1,307 @@
+"""
+Worker runtime for model services.
+
+A model service is a FastAPI app around one or more models. The runtime
+builds that app with everything the services share, so a new model only
+brings its loader and its entry points:
+
+- metrics, tracing, profiling and upload limits (413) on the app
+- ``/health`` and ``/ready``, with models loaded by a background warmup
+- a bounded job queue in front of a pool of worker threads; a full queue
+  answers 503 with Retry-After instead of piling requests onto the GPU
+- per-job directories under ``shared_storage/outputs/<service>/<job>``,
+  evicted as one artefact by the storage sweeper
+- upload ingestion (rewind, byte cap, downscale, empty check) and
+  in-memory image responses
+- model errors mapped to 400 (``ValueError``) or 500
+
+    runtime = ServiceRuntime("difareli", "DiFaReLi Service")
+    runtime.add_model("difareli", load_relighter)
+    app = runtime.app
+
+    @app.post("/run")
+    def run(img: UploadFile = File(...)):
+        with runtime.job() as job:
+            img_path = job.save_upload(img, "img.png")
+            runtime.run(lambda: runtime.model("difareli").relight(img_path, job.output_dir))
+            return FileResponse(str(job.newest_output()))
+
+Worker counts and queue sizes default per service and can be overridden
+with ``FACELAB_<SERVICE>_WORKERS`` / ``FACELAB_<SERVICE>_QUEUE``; the
+service's CPU budget is split among the workers (``common.resources``).
+"""
+
+import asyncio
+import contextvars
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+
+from .metrics import QUEUE_DEPTH, install_metrics, observe_stage, stage
+from .profiling import install_profiling
+from .readiness import NotReady, Warmup, install_readiness
+from .resources import apply_resources, install_resources
+from .storage import StorageArea, StorageManager, install_storage
+from .tracing import install_tracing
+from .uploads import UploadTooLarge, ingest_bytes, ingest_file, install_upload_limits
+
+STORE = (Path(__file__).resolve().parent.parent / "shared_storage").resolve()
+_JOB_ID = re.compile(r"^[0-9a-f]{6,32}$")
+
+
+class QueueFull(NotReady):
+    """The job queue is at capacity; surfaced as 503 with Retry-After."""
+
+
+def _rewind(upload):
+    try:
+        upload.file.seek(0)
+    except Exception:
+        pass
+
+
+def read_upload(upload) -> bytes:
+    """An upload's bytes, ingested (byte cap, downscale); 400 when empty."""
+    _rewind(upload)
+    with stage("ingest"):
+        data = ingest_bytes(upload.file).data
+    if not data:
+        raise HTTPException(400, "Uploaded file is empty")
+    return data
+
+
+def save_upload(upload, path: Path) -> Path:
+    """Stream an upload to ``path`` (byte cap, downscale, original kept); 400 when empty."""
+    _rewind(upload)
+    with stage("ingest"):
+        ingested = ingest_file(upload.file, path)
+    if not ingested.nbytes:
+        Path(path).unlink(missing_ok=True)
+        raise HTTPException(400, "Uploaded file is empty")
+    return Path(path)
+
+
+def encode_image(image, fmt: str = "png") -> bytes:
+    """PIL image, BGR array (cv2) or encoded bytes -> encoded bytes."""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    with stage("encode"):
+        if hasattr(image, "save"):
+            buf = io.BytesIO()
+            image.save(buf, format=fmt.upper())
+            return buf.getvalue()
+        import cv2
+
+        ok, buf = cv2.imencode(f".{fmt.lower()}", image)
+        if not ok:
+            raise RuntimeError(f"{fmt} encoding failed")
+        return buf.tobytes()
+
+
+def image_response(image, fmt: str = "png") -> Response:
+    """Return an image from memory (no temp file)."""
+    return Response(encode_image(image, fmt), media_type=f"image/{fmt.lower()}")
+
+
+class WorkerPool:
+    """Worker threads fed by a bounded queue; calls run in the submitter's context (traces, stages)."""
+
+    def __init__(self, service: str, name: str = "inference", workers: int = 1, max_queue: int = 8):
+        self.service = service
+        self.name = name
+        self.workers = max(1, workers)
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_queue))
+        self._threads = []
+        self._lock = threading.Lock()
+        QUEUE_DEPTH.set_function(self.depth, service=service, queue=name)
+
+    def start(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                t = threading.Thread(target=self._worker, name=f"{self.service}-{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue ``fn(*args, **kwargs)``. Raises ``QueueFull`` when the backlog is at capacity."""
+        self.start()
+        future: Future = Future()
+        ctx = contextvars.copy_context()
+        try:
+            self._queue.put_nowait((future, ctx, time.perf_counter(), fn, args, kwargs))
+        except queue.Full:
+            raise QueueFull(f"{self.service}: {self.name} queue is full, try again later")
+        return future
+
+    def _worker(self):
+        while True:
+            future, ctx, queued, fn, args, kwargs = self._queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(ctx.run(self._call, queued, fn, args, kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _call(self, queued: float, fn: Callable, args, kwargs):
+        observe_stage(f"{self.name}_queue_wait", time.perf_counter() - queued, self.service)
+        return fn(*args, **kwargs)
+
+
+class Job:
+    """Per-job directory: ``inputs/`` for uploads, ``outputs/`` for results, ``job.json`` for parameters."""
+
+    def __init__(self, root: Path, job_id: Optional[str] = None):
+        if job_id is not None and not _JOB_ID.match(job_id):
+            raise HTTPException(400, "job_id must be 6-32 lowercase hex characters")
+        self.job_id = job_id or uuid.uuid4().hex[:10]
+        self.dir = Path(root) / self.job_id
+        self.input_dir = self.dir / "inputs"
+        self.output_dir = self.dir / "outputs"
+        self.input_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def save_upload(self, upload, name: str) -> Path:
+        return save_upload(upload, self.input_dir / name)
+
+    def latest_output(self) -> Optional[Path]:
+        return max((p for p in self.output_dir.iterdir() if p.is_file()),
+                   key=lambda p: p.stat().st_mtime, default=None)
+
+    def newest_output(self) -> Path:
+        """The most recently written result (500 if the model produced none)."""
+        out = self.latest_output()
+        if out is None:
+            raise HTTPException(500, "No output produced")
+        return out
+
+    def save_meta(self, meta: dict):
+        (self.dir / "job.json").write_text(json.dumps(meta))
+
+    def load_meta(self) -> dict:
+        try:
+            return json.loads((self.dir / "job.json").read_text())
+        except FileNotFoundError:
+            raise HTTPException(404, f"Job {self.job_id} has no stored parameters")
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class ServiceRuntime:
+    """The shared app, warmup, worker pool and storage of one model service."""
+
+    def __init__(self, service: str, title: str, workers: int = 1, max_queue: int = 8,
+                 outputs_mb: float = 1024, uploads_mb: Optional[float] = None, ttl_hours: float = 24,
+                 app: Optional[FastAPI] = None, areas: Iterable[StorageArea] = ()):
+        self.service = service
+        self.label = title.replace(" Service", "")
+        # Thread pools sized before any model library is imported
+        self.resources = apply_resources(service, workers)
+        self.app = app or FastAPI(title=title)
+        install_metrics(self.app, service)
+        install_tracing(self.app, service)
+        install_profiling(self.app, service)
+        install_upload_limits(self.app)
+
+        self.upload_dir = STORE / "uploads"
+        self.output_dir = STORE / "outputs" / service
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Each job directory is one artefact: evicted by age / LRU as a whole
+        # (``areas``: service-specific scratch/cache dirs, swept alongside)
+        swept = [StorageArea.from_env(f"outputs_{service}", self.output_dir, max_mb=outputs_mb, ttl_hours=ttl_hours)]
+        if uploads_mb:  # the service that owns the shared uploads dir
+            swept.insert(0, StorageArea.from_env("uploads", self.upload_dir, max_mb=uploads_mb, ttl_hours=ttl_hours))
+        self.storage = StorageManager(swept + list(areas))
+        install_storage(self.app, self.storage, service)
+
+        self.pool = WorkerPool(
+            service,
+            workers=self.resources.workers,
+            max_queue=int(os.environ.get(f"FACELAB_{service.upper()}_QUEUE", max_queue)),
+        )
+        install_resources(self.app, self.resources)
+        self.warmup = Warmup(service)
+        install_readiness(self.app, self.warmup)
+        self.app.add_event_handler("startup", self.pool.start)
+
+        @self.app.get("/health")
+        def health():
+            return {"status": "ok", "service": service}
+
+    # -----------------------------
+    # Models
+    # -----------------------------
+    def add_model(self, name: str, loader: Callable[[], Any], required: bool = True):
+        """Load ``loader()`` in the background at startup; ``/ready`` waits for required models."""
+        self.warmup.add(name, loader, required=required)
+
+    def model(self, name: str):
+        """A loaded model (503 while it is still loading)."""
+        return self.warmup.get(name)
+
+    # -----------------------------
+    # Jobs
+    # -----------------------------
+    @contextmanager
+    def job(self, job_id: Optional[str] = None):
+        """A per-job directory; removed if the request fails, kept (until evicted) otherwise."""
+        job = Job(self.output_dir, job_id)
+        try:
+            yield job
+        except BaseException:
+            job.discard()
+            raise
+
+    def open_job(self, job_id: str) -> Job:
+        """An earlier job's directory (404 once it has been evicted)."""
+        if not _JOB_ID.match(job_id) or not (self.output_dir / job_id).is_dir():
+            raise HTTPException(404, f"Unknown or expired job: {job_id}")
+        self.storage.touch(self.output_dir / job_id)
+        return Job(self.output_dir, job_id)
+
+    @contextmanager
+    def errors(self, label: Optional[str] = None):
+        """Map model failures onto HTTP errors (400 for ``ValueError``, else 500)."""
+        try:
+            yield
+        except (HTTPException, NotReady, UploadTooLarge):
+            raise
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+        except Exception as e:
+            traceback.print_exc()
+            raise HTTPException(500, f"{label or self.label} failed: {e}")
+
+    def run(self, fn: Callable, *args, label: Optional[str] = None, **kwargs):
+        """Run ``fn`` on the worker pool and wait for it (sync routes)."""
+        future = self.pool.submit(fn, *args, **kwargs)
+        with self.errors(label):
+            return future.result()
+
+    async def run_async(self, fn: Callable, *args, label: Optional[str] = None, **kwargs):
+        """Run ``fn`` on the worker pool without blocking the event loop (async routes)."""
+        future = self.pool.submit(fn, *args, **kwargs)
+        with self.errors(label):
+            return await asyncio.wrap_future(future)
@@ -0,0 +1,241 @@
+"""
+Size- and age-bounded storage for uploads, outputs and cached results.
+
+Each service registers the directories it writes artefacts into as
+``StorageArea``s. Every direct child of an area (a file, or a job
+directory such as ``temp_fitting/<job>``) is one artefact with a creation
+time and a last-access time. A background thread sweeps the areas
+periodically: artefacts past the area's TTL are deleted first, then the
+least recently used ones until the area is back under its byte quota.
+Artefacts younger than ``min_age`` are never evicted, so in-flight jobs
+keep their files.
+
+Serving code calls ``touch(path)`` so recently downloaded results count as
+recently used; otherwise the file's own atime/mtime is used.
+
+Quotas and TTLs can be overridden per area with
+``FACELAB_STORAGE_<AREA>_MAX_MB`` and ``FACELAB_STORAGE_<AREA>_TTL_HOURS``.
+"""
+
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_SWEEP_INTERVAL = float(os.environ.get("FACELAB_STORAGE_SWEEP_SECONDS", "300"))
+
+
+class StorageArea:
+    """One managed directory with a byte quota and a TTL."""
+
+    def __init__(self, name: str, path: Path, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None, min_age: float = 60.0,
+                 exclude: Iterable[str] = (".gitkeep",)):
+        self.name = name
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.min_age = min_age
+        self.exclude = set(exclude)
+        self.files = 0
+        self.bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+    @classmethod
+    def from_env(cls, name: str, path: Path, max_mb: Optional[float] = None,
+                 ttl_hours: Optional[float] = None, **kwargs) -> "StorageArea":
+        """Area whose quota/TTL defaults can be overridden from the environment."""
+        key = name.upper()
+        max_mb = float(os.environ.get(f"FACELAB_STORAGE_{key}_MAX_MB", max_mb or 0)) or None
+        ttl_hours = float(os.environ.get(f"FACELAB_STORAGE_{key}_TTL_HOURS", ttl_hours or 0)) or None
+        return cls(
+            name,
+            path,
+            max_bytes=int(max_mb * 2**20) if max_mb else None,
+            ttl=ttl_hours * 3600 if ttl_hours else None,
+            **kwargs,
+        )
+
+    def stats(self) -> dict:
+        return {
+            "path": str(self.path),
+            "files": self.files,
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+
+class _Artefact:
+    __slots__ = ("path", "size", "created", "accessed")
+
+    def __init__(self, path: Path, size: int, created: float, accessed: float):
+        self.path = path
+        self.size = size
+        self.created = created
+        self.accessed = accessed
+
+
+def _entry_size(entry: os.DirEntry) -> int:
+    if not entry.is_dir(follow_symlinks=False):
+        return entry.stat(follow_symlinks=False).st_size
+    total = 0
+    for root, _, files in os.walk(entry.path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class StorageManager:
+    """Tracks artefacts across areas and evicts by TTL, then LRU, in a background thread."""
+
+    def __init__(self, areas: List[StorageArea], interval: float = DEFAULT_SWEEP_INTERVAL):
+        self.areas: Dict[str, StorageArea] = {a.name: a for a in areas}
+        self.interval = interval
+        self._touched: Dict[str, float] = {}  # path -> last access recorded by touch()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_sweep: Optional[float] = None
+        self.last_sweep_seconds = 0.0
+        for area in areas:
+            area.path.mkdir(parents=True, exist_ok=True)
+
+    def touch(self, path):
+        """Record that an artefact was just served."""
+        with self._lock:
+            self._touched[str(path)] = time.time()
+
+    def _scan(self, area: StorageArea) -> List[_Artefact]:
+        artefacts = []
+        try:
+            entries = list(os.scandir(area.path))
+        except OSError:
+            return artefacts
+        with self._lock:
+            touched = dict(self._touched)
+        for entry in entries:
+            if entry.name in self.areas_excluded(area):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+                size = _entry_size(entry)
+            except OSError:
+                continue
+            accessed = max(st.st_mtime, st.st_atime, touched.get(entry.path, 0.0))
+            artefacts.append(_Artefact(Path(entry.path), size, st.st_mtime, accessed))
+        return artefacts
+
+    def areas_excluded(self, area: StorageArea) -> set:
+        """Names to skip: the area's excludes plus nested areas (managed on their own)."""
+        nested = {
+            other.path.name for other in self.areas.values()
+            if other is not area and other.path.parent == area.path
+        }
+        return area.exclude | nested
+
+    def _remove(self, area: StorageArea, artefact: _Artefact) -> bool:
+        try:
+            if artefact.path.is_dir() and not artefact.path.is_symlink():
+                shutil.rmtree(artefact.path)
+            else:
+                artefact.path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"[storage] could not evict {artefact.path}: {e}")
+            return False
+        area.evicted_files += 1
+        area.evicted_bytes += artefact.size
+        with self._lock:
+            self._touched.pop(str(artefact.path), None)
+        return True
+
+    def sweep_area(self, area: StorageArea) -> int:
+        """Enforce one area's TTL and quota. Returns the number of artefacts evicted."""
+        now = time.time()
+        artefacts = self._scan(area)
+        evictable = [a for a in artefacts if now - a.created >= area.min_age]
+        evicted = set()
+
+        if area.ttl is not None:
+            for a in evictable:
+                if now - a.created > area.ttl and self._remove(area, a):
+                    evicted.add(a.path)
+
+        total = sum(a.size for a in artefacts if a.path not in evicted)
+        if area.max_bytes is not None and total > area.max_bytes:
+            # LRU down to 90% of the quota so we don't evict on every sweep
+            target = int(area.max_bytes * 0.9)
+            for a in sorted((a for a in evictable if a.path not in evicted), key=lambda a: a.accessed):
+                if total <= target:
+                    break
+                if self._remove(area, a):
+                    evicted.add(a.path)
+                    total -= a.size
+
+        area.files = len(artefacts) - len(evicted)
+        area.bytes = total
+        return len(evicted)
+
+    def sweep(self) -> int:
+        started = time.perf_counter()
+        evicted = 0
+        for area in self.areas.values():
+            evicted += self.sweep_area(area)
+        self.last_sweep = time.time()
+        self.last_sweep_seconds = time.perf_counter() - started
+        if evicted:
+            print(f"[storage] evicted {evicted} artefacts in {self.last_sweep_seconds:.2f}s")
+        return evicted
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="storage-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[storage] sweep failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def stats(self) -> dict:
+        return {
+            "last_sweep": self.last_sweep,
+            "last_sweep_seconds": round(self.last_sweep_seconds, 3),
+            "sweep_interval": self.interval,
+            "areas": {name: area.stats() for name, area in self.areas.items()},
+        }
+
+
+def install_storage(app, manager: StorageManager, service: str):
+    """Start ``manager`` with the app, expose ``/storage`` stats and usage gauges."""
+    from .metrics import REGISTRY
+
+    usage = REGISTRY.gauge("facelab_storage_bytes", "Bytes held in a managed storage area", ("service", "area"))
+    for name, area in manager.areas.items():
+        usage.set_function(lambda a=area: a.bytes, service=service, area=name)
+
+    @app.on_event("startup")
+    def _start_storage_manager():
+        manager.start()
+
+    @app.get("/storage")
+    def storage_stats():
+        """Managed storage areas: usage, quotas, TTLs and eviction counters."""
+        return manager.stats()
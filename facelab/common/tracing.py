@@ -0,0 +1,189 @@
+"""
+Per-request timing and request ids for FaceLab services.
+
+``install_tracing`` gives every request an id (taken from the incoming
+``X-Request-ID`` header or generated) and a list of stage timings held in
+a context variable. ``common.metrics.stage`` appends to that list, so one
+``with stage("inference"):`` feeds both the Prometheus histogram and the
+request's breakdown. Responses carry ``X-Request-ID`` and a
+``Server-Timing`` header; recent breakdowns are kept in a ring buffer
+served at ``/debug/timings/{request_id}``, and requests slower than a
+threshold are logged (sampled) with their full breakdown.
+
+The gateway forwards the id to services and merges each service's
+``Server-Timing`` into its own with ``merge_upstream``, prefixed with
+the service name (``simswap.inference``).
+"""
+
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+SLOW_REQUEST_MS = float(os.environ.get("FACELAB_SLOW_REQUEST_MS", "2000"))
+SLOW_LOG_SAMPLE = float(os.environ.get("FACELAB_SLOW_LOG_SAMPLE", "1.0"))  # fraction of slow requests logged
+TIMINGS_BUFFER_SIZE = int(os.environ.get("FACELAB_TIMINGS_BUFFER", "512"))
+
+_VALID_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+class RequestTrace:
+    """Request id plus the stage timings recorded while handling it."""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.timings: List[Tuple[str, float]] = []  # (stage, seconds), in completion order
+
+    def add(self, name: str, seconds: float):
+        self.timings.append((name, seconds))
+
+    def merged(self) -> List[Tuple[str, float]]:
+        """Timings with repeated stages summed, in first-seen order."""
+        totals = OrderedDict()
+        for name, seconds in self.timings:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return list(totals.items())
+
+
+_current: ContextVar[Optional[RequestTrace]] = ContextVar("facelab_request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current.get()
+
+
+def current_request_id() -> Optional[str]:
+    trace = _current.get()
+    return trace.request_id if trace is not None else None
+
+
+def record(name: str, seconds: float):
+    """Add a stage timing to the current request (no-op outside a request)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def server_timing(timings: List[Tuple[str, float]], total: Optional[float] = None) -> str:
+    """Render ``(name, seconds)`` pairs as a Server-Timing header value."""
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def parse_server_timing(value: str) -> List[Tuple[str, float]]:
+    """Parse a Server-Timing header into ``(name, seconds)`` pairs (entries without dur are skipped)."""
+    result = []
+    for entry in value.split(","):
+        fields = [f.strip() for f in entry.split(";")]
+        if not fields[0]:
+            continue
+        for field in fields[1:]:
+            key, _, val = field.partition("=")
+            if key.strip() == "dur":
+                try:
+                    result.append((fields[0], float(val.strip('"')) / 1000))
+                except ValueError:
+                    pass
+                break
+    return result
+
+
+def merge_upstream(prefix: str, header: Optional[str]):
+    """Fold a service's Server-Timing header into the current request as ``prefix.stage``."""
+    if not header:
+        return
+    for name, seconds in parse_server_timing(header):
+        record(f"{prefix}.{name}", seconds)
+
+
+class TimingBuffer:
+    """Bounded map of request id -> timing breakdown (oldest evicted first)."""
+
+    def __init__(self, max_entries: int = TIMINGS_BUFFER_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, entry: dict):
+        with self._lock:
+            self._entries[entry["request_id"]] = entry
+            self._entries.move_to_end(entry["request_id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, request_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._entries.get(request_id)
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        with self._lock:
+            entries = list(self._entries.values())
+        return entries[-limit:][::-1]
+
+
+TIMINGS = TimingBuffer()
+
+
+def _breakdown(trace: RequestTrace, service: str, method: str, path: str,
+               status: int, total: float) -> dict:
+    return {
+        "request_id": trace.request_id,
+        "service": service,
+        "method": method,
+        "path": path,
+        "status": status,
+        "total_ms": round(total * 1000, 1),
+        "timings": [{"stage": n, "ms": round(s * 1000, 1)} for n, s in trace.merged()],
+    }
+
+
+def install_tracing(app, service: str):
+    """Add request-id/Server-Timing middleware and ``/debug/timings`` endpoints to ``app``."""
+    from fastapi import HTTPException
+
+    @app.middleware("http")
+    async def _tracing_middleware(request, call_next):
+        incoming = request.headers.get(REQUEST_ID_HEADER, "")
+        trace = RequestTrace(incoming if _VALID_ID.match(incoming) else uuid.uuid4().hex[:16])
+        token = _current.set(trace)
+        try:
+            response = await call_next(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - trace.start
+
+        response.headers[REQUEST_ID_HEADER] = trace.request_id
+        response.headers["Server-Timing"] = server_timing(trace.merged(), total)
+        response.headers["Timing-Allow-Origin"] = "*"
+
+        if not request.url.path.startswith(("/debug/timings", "/metrics")):
+            entry = _breakdown(trace, service, request.method, request.url.path,
+                               response.status_code, total)
+            TIMINGS.add(entry)
+            if total * 1000 >= SLOW_REQUEST_MS and random.random() < SLOW_LOG_SAMPLE:
+                stages = ", ".join(f"{t['stage']}={t['ms']:.0f}ms" for t in entry["timings"])
+                print(f"[slow] {service} {request.method} {request.url.path} "
+                      f"id={trace.request_id} status={response.status_code} "
+                      f"total={entry['total_ms']:.0f}ms {stages}")
+        return response
+
+    @app.get("/debug/timings", include_in_schema=False)
+    def recent_timings(limit: int = 50):
+        return TIMINGS.recent(max(1, min(limit, TIMINGS.max_entries)))
+
+    @app.get("/debug/timings/{request_id}", include_in_schema=False)
+    def request_timings(request_id: str):
+        entry = TIMINGS.get(request_id)
+        if entry is None:
+            raise HTTPException(404, f"No timings for request {request_id}")
+        return entry
@@ -0,0 +1,226 @@
+"""
+Bounded upload ingestion.
+
+Uploads are copied in chunks (to a file or into memory) with a byte cap,
+so a request can never hold more than ``FACELAB_MAX_UPLOAD_MB`` of image
+data. The image dimensions are read from the first bytes of the stream
+(PNG/JPEG/WebP/GIF/BMP headers, no decode). Images above
+``FACELAB_MAX_MEGAPIXELS`` are downscaled once, here, so inference and
+compositing never see a 50 MP photo; JPEGs are reduced in the DCT domain
+(``Image.draft``) and the full-size pixels are never decoded. The
+original is kept next to the downscaled file (or in memory) together
+with the scale, for callers that paste results back at full resolution.
+Images above ``FACELAB_MAX_DECODE_MEGAPIXELS`` are refused outright.
+
+Ordinary uploads (within the limits) are only copied: the header probe
+is the whole cost.
+"""
+
+import io
+import math
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get("FACELAB_MAX_UPLOAD_MB", "25")) * 2**20)
+MAX_MEGAPIXELS = float(os.environ.get("FACELAB_MAX_MEGAPIXELS", "12"))
+MAX_DECODE_MEGAPIXELS = float(os.environ.get("FACELAB_MAX_DECODE_MEGAPIXELS", "150"))
+CHUNK_SIZE = 1 << 20
+PROBE_BYTES = 256 * 1024  # JPEG SOF can sit behind a large EXIF block
+
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class UploadTooLarge(ValueError):
+    """Upload exceeds the byte or pixel limits (answered with 413)."""
+
+
+def _probe_jpeg(head: bytes) -> Optional[Tuple[int, int]]:
+    i = 2
+    while i + 9 <= len(head):
+        if head[i] != 0xFF:
+            return None
+        marker = head[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            h, w = struct.unpack(">HH", head[i + 5:i + 9])
+            return w, h
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # markers without a length
+            i += 2
+            continue
+        i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+    return None
+
+
+def probe_image_size(head: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from an image's leading bytes; None if unknown or more bytes are needed."""
+    try:
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:2] == b"\xff\xd8":
+            return _probe_jpeg(head)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            chunk = head[12:16]
+            if chunk == b"VP8X":
+                return 1 + int.from_bytes(head[24:27], "little"), 1 + int.from_bytes(head[27:30], "little")
+            if chunk == b"VP8 ":
+                w, h = struct.unpack("<HH", head[26:30])
+                return w & 0x3FFF, h & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head[:2] == b"BM":
+            w, h = struct.unpack("<ii", head[18:26])
+            return w, abs(h)
+    except struct.error:
+        return None
+    return None
+
+
+class Ingested:
+    """An accepted upload: where it is, its size, and how it was scaled."""
+
+    def __init__(self, nbytes: int, size: Optional[Tuple[int, int]], path: Optional[Path] = None,
+                 data: Optional[bytes] = None):
+        self.nbytes = nbytes
+        self.path = path
+        self.data = data
+        self.width, self.height = size or (None, None)
+        self.original_width, self.original_height = self.width, self.height
+        self.scale = 1.0
+        self.original_path: Optional[Path] = None
+        self.original_data: Optional[bytes] = None
+
+    @property
+    def downscaled(self) -> bool:
+        return self.scale < 1.0
+
+    def info(self) -> dict:
+        return {
+            "bytes": self.nbytes,
+            "width": self.width,
+            "height": self.height,
+            "original_width": self.original_width,
+            "original_height": self.original_height,
+            "scale": round(self.scale, 4),
+        }
+
+
+def _copy_limited(src: BinaryIO, write, max_bytes: int) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """Copy ``src`` in chunks through ``write``; probe the size from the first bytes."""
+    total, head, size = 0, b"", None
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadTooLarge(f"Upload exceeds the {max_bytes / 2**20:g} MB limit")
+        if size is None and len(head) < PROBE_BYTES:
+            head += chunk[:PROBE_BYTES - len(head)]
+            size = probe_image_size(head)
+            if size and size[0] * size[1] > MAX_DECODE_MEGAPIXELS * 1e6:
+                raise UploadTooLarge(f"Image is {size[0]}x{size[1]}, over {MAX_DECODE_MEGAPIXELS:g} MP")
+        write(chunk)
+    return total, size
+
+
+def _target_size(size: Optional[Tuple[int, int]], max_megapixels: float) -> Optional[Tuple[int, int]]:
+    if not size or not max_megapixels or size[0] * size[1] <= max_megapixels * 1e6:
+        return None
+    scale = math.sqrt(max_megapixels * 1e6 / (size[0] * size[1]))
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+
+def downscale(data: bytes, target: Tuple[int, int]) -> Tuple[bytes, Tuple[int, int]]:
+    """Re-encode ``data`` at ``target`` size in its own format (JPEG via draft mode)."""
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    fmt = img.format or "PNG"
+    if fmt == "JPEG":
+        img.draft("RGB", target)  # decode at 1/2, 1/4 or 1/8 scale directly
+    if img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    out = io.BytesIO()
+    if fmt == "JPEG":
+        img.save(out, format="JPEG", quality=95)
+    else:
+        if fmt not in ("PNG", "WEBP"):
+            fmt = "PNG"
+        img.save(out, format=fmt)
+    return out.getvalue(), img.size
+
+
+def _apply_policy(result: Ingested, data: bytes, max_megapixels: float) -> Optional[bytes]:
+    """Downscale ``data`` if it is over the pixel budget; returns the new bytes or None."""
+    target = _target_size((result.width, result.height) if result.width else None, max_megapixels)
+    if target is None:
+        return None
+    try:
+        small, size = downscale(data, target)
+    except Exception as e:  # not decodable here: leave it to the caller
+        print(f"[uploads] could not downscale {result.width}x{result.height} upload: {e}")
+        return None
+    result.scale = size[0] / result.original_width
+    result.width, result.height = size
+    return small
+
+
+def ingest_bytes(src: BinaryIO, max_bytes: int = MAX_UPLOAD_BYTES,
+                 max_megapixels: float = MAX_MEGAPIXELS, keep_original: bool = False) -> Ingested:
+    """Read an upload into memory with the byte cap and pixel policy applied."""
+    buf = io.BytesIO()
+    nbytes, size = _copy_limited(src, buf.write, max_bytes)
+    result = Ingested(nbytes, size, data=buf.getvalue())
+    small = _apply_policy(result, result.data, max_megapixels)
+    if small is not None:
+        if keep_original:
+            result.original_data = result.data
+        result.data = small
+    return result
+
+
+def ingest_file(src: BinaryIO, dest: Path, max_bytes: int = MAX_UPLOAD_BYTES,
+                max_megapixels: float = MAX_MEGAPIXELS, keep_original: bool = True) -> Ingested:
+    """
+    Stream an upload to ``dest`` with the byte cap and pixel policy applied.
+    When downscaled, the original stays at ``<stem>.orig<suffix>`` (if
+    ``keep_original``).
+    """
+    dest = Path(dest)
+    tmp = dest.with_name(f".{dest.name}.part")
+    try:
+        with open(tmp, "wb") as f:
+            nbytes, size = _copy_limited(src, f.write, max_bytes)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    result = Ingested(nbytes, size, path=dest)
+    target = _target_size(size, max_megapixels)
+    small = _apply_policy(result, tmp.read_bytes(), max_megapixels) if target else None
+    if small is None:
+        os.replace(tmp, dest)
+        return result
+    if keep_original:
+        result.original_path = dest.with_name(f"{dest.stem}.orig{dest.suffix}")
+        os.replace(tmp, result.original_path)
+    else:
+        tmp.unlink(missing_ok=True)
+    dest.write_bytes(small)
+    return result
+
+
+def install_upload_limits(app):
+    """Answer ``UploadTooLarge`` with 413."""
+    from fastapi.responses import JSONResponse
+
+    @app.exception_handler(UploadTooLarge)
+    async def _too_large(request, exc: UploadTooLarge):
+        return JSONResponse({"detail": str(exc)}, status_code=413)
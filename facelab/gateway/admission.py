@@ -0,0 +1,211 @@
+"""
+Admission control for gateway -> upstream traffic.
+
+Each upstream service gets a concurrency limit and a bounded wait queue.
+Requests carry a priority class; when a slot frees up the most urgent
+waiter gets it, and when the queue is full the least urgent request is
+turned away with 429 + Retry-After instead of piling up behind the
+backends.
+
+The slot granted to a request is reachable from its handler through
+``current_slot()``, so work that stops needing the upstream (a request
+waiting on an identical in-flight one) can hand it back early.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+# Priority classes (lower value = served first)
+INTERACTIVE = 0
+SINGLE = 1
+BATCH = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", SINGLE: "single", BATCH: "batch"}
+
+
+class AdmissionRejected(Exception):
+    """Request was not admitted; ``retry_after`` is a hint in seconds."""
+
+    def __init__(self, upstream: str, reason: str, retry_after: int):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class UpstreamLimiter:
+    """
+    Priority-aware concurrency limiter for one upstream.
+
+    ``class_limits`` caps how many slots a priority class may hold at once
+    (e.g. ``{BATCH: 1}`` keeps long fits from occupying every slot).
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int,
+                 max_wait: float = 30.0, class_limits: Optional[Dict[int, int]] = None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.class_limits = class_limits or {}
+        self.active = 0
+        self.active_by_class: Dict[int, int] = {}
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._service_time = 1.0  # EMA of seconds a slot is held
+        self.admitted = 0
+        self.rejected = 0
+
+    def _class_has_room(self, priority: int) -> bool:
+        limit = self.class_limits.get(priority)
+        return limit is None or self.active_by_class.get(priority, 0) < limit
+
+    def _take(self, priority: int):
+        self.active += 1
+        self.active_by_class[priority] = self.active_by_class.get(priority, 0) + 1
+        self.admitted += 1
+
+    def retry_after(self) -> int:
+        """Rough wait estimate: queued work spread over the available slots."""
+        backlog = len(self._waiters) + self.active
+        return max(1, math.ceil(self._service_time * backlog / max(1, self.max_concurrent)))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(self.name, reason, self.retry_after())
+
+    async def acquire(self, priority: int) -> float:
+        """Wait for a slot. Returns the monotonic time the slot was granted."""
+        if self.active < self.max_concurrent and not self._waiters and self._class_has_room(priority):
+            self._take(priority)
+            return time.monotonic()
+
+        if len(self._waiters) >= self.max_queue:
+            # Full: only admit if we can bump a less urgent waiter
+            worst = max(self._waiters)
+            if worst[0] <= priority:
+                raise self._reject("queue full")
+            self._waiters.remove(worst)
+            heapq.heapify(self._waiters)
+            worst[2].set_exception(self._reject("displaced by higher priority request"))
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        # Slots may be free while the queue only holds waiters blocked by
+        # their class cap; admit right away if this request can run
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                raise self._reject("timed out waiting for a slot")
+            # Granted right as we timed out: keep the slot
+        except asyncio.CancelledError:
+            # Client went away while queued; don't leak a slot granted meanwhile
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            elif fut.done() and not fut.exception():
+                self.release(priority, time.monotonic())
+            raise
+        return time.monotonic()
+
+    def release(self, priority: int, granted_at: float):
+        held = time.monotonic() - granted_at
+        self._service_time = 0.8 * self._service_time + 0.2 * held
+        self.active -= 1
+        self.active_by_class[priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to the most urgent waiters their class allows."""
+        skipped = []
+        while self._waiters and self.active < self.max_concurrent:
+            entry = heapq.heappop(self._waiters)
+            priority, _, fut = entry
+            if fut.done():
+                continue
+            if not self._class_has_room(priority):
+                skipped.append(entry)
+                continue
+            self._take(priority)
+            fut.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    def stats(self) -> dict:
+        waiting = {}
+        for priority, _, _ in self._waiters:
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            waiting[name] = waiting.get(name, 0) + 1
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": len(self._waiters),
+            "max_queue": self.max_queue,
+            "waiting_by_class": waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionSlot:
+    """A granted slot; released once, either early by the handler or when the request ends."""
+
+    def __init__(self, limiter: UpstreamLimiter, priority: int, granted_at: float):
+        self.limiter = limiter
+        self.priority = priority
+        self.granted_at = granted_at
+        self.released = False
+        self._loop = asyncio.get_running_loop()
+
+    def release(self):
+        """Give the slot back (event loop thread)."""
+        if not self.released:
+            self.released = True
+            self.limiter.release(self.priority, self.granted_at)
+
+    def release_threadsafe(self):
+        """Give the slot back from a handler running in the threadpool."""
+        self._loop.call_soon_threadsafe(self.release)
+
+
+admission_slot: contextvars.ContextVar = contextvars.ContextVar("admission_slot", default=None)
+
+
+def current_slot() -> Optional[AdmissionSlot]:
+    """The admission slot held by the current request, if its route is admission controlled."""
+    return admission_slot.get()
+
+
+def release_current_slot():
+    """Hand the current request's slot back while it keeps running (from any thread)."""
+    slot = current_slot()
+    if slot is not None:
+        slot.release_threadsafe()
+
+
+class AdmissionController:
+    """Maps gateway routes to ``(limiter, priority)``."""
+
+    def __init__(self, limiters: Dict[str, UpstreamLimiter], routes: Dict[str, Tuple[str, int]]):
+        self.limiters = limiters
+        # Longest route first so /api/simswap_multi_upload wins over /api/simswap
+        self.routes = sorted(routes.items(), key=lambda kv: len(kv[0]), reverse=True)
+
+    def policy_for(self, path: str) -> Optional[Tuple[UpstreamLimiter, int]]:
+        for route, (upstream, priority) in self.routes:
+            if path == route or path.startswith(route + "/"):
+                return self.limiters[upstream], priority
+        return None
+
+    def stats(self) -> dict:
+        return {name: lim.stats() for name, lim in self.limiters.items()}
@@ -1,36 +1,208 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import requests
 from pathlib import Path
+from contextlib import contextmanager
+import json
+import logging
+import os
+import re
+import sys
+import time
 import uuid
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))  # facelab/ for the shared `common` package
+from common.metrics import QUEUE_DEPTH, install_metrics, stage
+from common.tracing import REQUEST_ID_HEADER, install_tracing
+from common.profiling import install_profiling
+from common.storage import StorageArea, StorageManager, install_storage
+from common.http_cache import CachedStaticFiles
+from common.readiness import Warmup, install_readiness
+from common.resources import apply_resources, install_resources
+
+from upstreams import PoolMonitor, TracedSession, UpstreamPool, parse_replicas
+from engines import (BACKGROUND_MODES, EmbeddedBackgroundRemoval, EmbeddedSimSwap, EngineError, MemoryUpload,
+                     RemoteBackgroundRemoval, RemoteSimSwap, embedded_engines)
+from admission import (AdmissionController, AdmissionRejected, AdmissionSlot, UpstreamLimiter, INTERACTIVE, SINGLE,
+                       BATCH, admission_slot, release_current_slot)
+from coalescing import SingleFlight
+
+# Upstream pools report breaker trips and readiness changes through `logging`
+logging.basicConfig(level=os.environ.get("FACELAB_LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="FaceLab Hub")
 
+# ====== Config ======
+# Each upstream is a comma-separated list of replicas
+SIMSWAP_REPLICAS = os.environ.get("SIMSWAP_REPLICAS", "http://127.0.0.1:8001")  # SimSwap service (/run, /run_multi)
+BG_REMOVAL_REPLICAS = os.environ.get("BG_REMOVAL_REPLICAS", "http://127.0.0.1:8002")  # Background removal service (/run)
+HEADNERF_REPLICAS = os.environ.get("HEADNERF_REPLICAS", "http://127.0.0.1:8003")  # HeadNeRF service
+HEALTH_PROBE_INTERVAL = float(os.environ.get("UPSTREAM_PROBE_INTERVAL", "5"))
+PIPELINE_MAX_STEPS = int(os.environ.get("PIPELINE_MAX_STEPS", "4"))
+# Preview job ids (handed out by /api/simswap?preview=true, used by /api/simswap/upgrade)
+PREVIEW_JOB_ID = re.compile(r"^[0-9a-f]{10}$")
+# Identical requests in flight at the same time share one inference (0 to disable)
+COALESCE_REQUESTS = os.environ.get("FACELAB_COALESCE", "1") != "0"
+# Upstreams whose engines run inside the gateway (single-node installs), e.g. "all"
+EMBEDDED = embedded_engines(os.environ.get("FACELAB_EMBEDDED", ""))
+# CPU budget on a shared node; embedded engines bring their services' share
+# into this process (their models load later, on the warmup thread)
+RESOURCES = apply_resources("gateway", includes=EMBEDDED)
+
+UPSTREAMS = {
+    "simswap": UpstreamPool("simswap", parse_replicas(SIMSWAP_REPLICAS)),
+    "background_removal": UpstreamPool("background_removal", parse_replicas(BG_REMOVAL_REPLICAS)),
+    "headnerf": UpstreamPool("headnerf", parse_replicas(HEADNERF_REPLICAS)),
+}
+SIMSWAP = UPSTREAMS["simswap"]
+BG_REMOVAL = UPSTREAMS["background_removal"]
+HEADNERF = UPSTREAMS["headnerf"]
+upstream_monitor = PoolMonitor(
+    {name: pool for name, pool in UPSTREAMS.items() if name not in EMBEDDED},
+    interval=HEALTH_PROBE_INTERVAL,
+)
+# Upstream HTTP client: forwards the request id, merges service Server-Timing
+http = TracedSession(UPSTREAMS)
+
+# ====== Admission Control ======
+# upstream -> (max concurrent per replica, max queued, max wait seconds, per-class slot caps per replica)
+UPSTREAM_LIMITS = {
+    "simswap": (2, 16, 60.0, {BATCH: 1}),
+    "background_removal": (4, 32, 30.0, {}),
+    "headnerf": (4, 32, 30.0, {BATCH: 1}),
+}
+
+# route -> (upstream, priority class); sub-paths inherit their parent's policy
+ROUTE_ADMISSION = {
+    "/api/headnerf/render": ("headnerf", INTERACTIVE),
+    "/api/headnerf/set_source": ("headnerf", INTERACTIVE),
+    "/api/headnerf/set_target": ("headnerf", INTERACTIVE),
+    "/api/headnerf/current": ("headnerf", INTERACTIVE),
+    "/api/headnerf/samples": ("headnerf", INTERACTIVE),
+    "/api/headnerf/sweep": ("headnerf", BATCH),
+    "/api/headnerf/fit": ("headnerf", BATCH),
+    # Status polls of an async fit must not queue behind the fits (BATCH cap)
+    "/api/headnerf/fit/jobs": ("headnerf", INTERACTIVE),
+    "/api/simswap": ("simswap", SINGLE),
+    "/api/simswap_multi_detect": ("simswap", SINGLE),
+    "/api/simswap_multi_match": ("simswap", SINGLE),
+    "/api/simswap_multi_upload": ("simswap", BATCH),
+    "/api/background_removal": ("background_removal", SINGLE),
+}
+
+admission = AdmissionController(
+    {
+        name: UpstreamLimiter(
+            name,
+            conc * len(UPSTREAMS[name].replicas),
+            queue,
+            max_wait=wait,
+            class_limits={c: n * len(UPSTREAMS[name].replicas) for c, n in caps.items()},
+        )
+        for name, (conc, queue, wait, caps) in UPSTREAM_LIMITS.items()
+    },
+    ROUTE_ADMISSION,
+)
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """Queue requests per upstream by priority; shed load with 429 when full."""
+    policy = admission.policy_for(request.url.path)
+    if policy is None:
+        return await call_next(request)
+
+    limiter, priority = policy
+    try:
+        granted_at = await limiter.acquire(priority)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": f"{e.upstream} is busy ({e.reason}), retry later"},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    # Handlers reach the slot through the request context (see coalescing below)
+    slot = AdmissionSlot(limiter, priority, granted_at)
+    token = admission_slot.set(slot)
+    try:
+        return await call_next(request)
+    finally:
+        admission_slot.reset(token)
+        slot.release()
+
+
+for _name, _limiter in admission.limiters.items():
+    QUEUE_DEPTH.set_function(lambda lim=_limiter: lim.stats()["queued"], service="gateway", queue=_name)
+
+# Request counts / latency, measured outside admission so queueing time is included
+install_metrics(app, "gateway")
+# Request id + Server-Timing (gateway stages plus every service hop)
+install_tracing(app, "gateway")
+install_profiling(app, "gateway")
+install_resources(app, RESOURCES)
+
+
 # ====== CORS Middleware ======
+# Registered last so it is outermost and 429 responses carry CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://127.0.0.1:5173", "*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER, "Server-Timing", "X-Total-Count"],
 )
 
-# ====== Config ======
-SIMSWAP_URL = "http://127.0.0.1:8001/run"  # SimSwap service endpoint (single)
-SIMSWAP_MULTI_URL = "http://127.0.0.1:8001/run_multi"  # SimSwap service endpoint (multi)
-BG_REMOVAL_URL = "http://127.0.0.1:8002/run"  # Background removal service endpoint
-HEADNERF_URL = "http://127.0.0.1:8003"  # HeadNeRF service endpoint
-
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
 TEMPLATES_DIR = BASE_DIR / "templates"
 STATIC_DIR.mkdir(exist_ok=True)
 
-# Serve static files (for displaying results)
-app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+SHARED_UPLOAD_DIR = BASE_DIR.parent / "shared_storage" / "uploads"
+
+# Downloaded results (random names, never reused) are evicted by age / LRU
+storage_areas = [
+    StorageArea.from_env("static", STATIC_DIR, max_mb=2048, ttl_hours=24),
+    StorageArea.from_env("static_faces", STATIC_DIR / "faces", max_mb=512, ttl_hours=24),
+]
+if "simswap" in EMBEDDED:
+    # No SimSwap service is running to manage the uploads it would own
+    storage_areas.append(StorageArea.from_env("uploads", SHARED_UPLOAD_DIR, max_mb=4096, ttl_hours=24))
+storage = StorageManager(storage_areas)
+install_storage(app, storage, "gateway")
+
+# ====== Engines ======
+# Same interface in both modes: HTTP to service replicas, or in-process
+# (models load in the background; /ready waits for them)
+warmup = Warmup("gateway")
+simswap_engine = EmbeddedSimSwap(warmup, SHARED_UPLOAD_DIR) if "simswap" in EMBEDDED else RemoteSimSwap(SIMSWAP, http)
+bg_removal_engine = (
+    EmbeddedBackgroundRemoval(warmup) if "background_removal" in EMBEDDED
+    else RemoteBackgroundRemoval(BG_REMOVAL, http)
+)
+install_readiness(app, warmup)
+if EMBEDDED:
+    logger.info("Embedded engines: %s", ", ".join(sorted(EMBEDDED)))
+
+
+def engine_error(e: EngineError) -> JSONResponse:
+    return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+
+
+# ====== Request Coalescing ======
+# Duplicate swaps / background removals / renders (retries, demo bursts)
+# attach to the identical request already in flight instead of running again.
+# A follower gives its admission slot back while it waits, so a burst of
+# duplicates holds one upstream slot, not one per copy.
+coalescer = SingleFlight(COALESCE_REQUESTS, on_follow=release_current_slot)
+
+# Serve static files (for displaying results): immutable, ETag/Range/?w= thumbnails
+app.mount("/static", CachedStaticFiles(directory=str(STATIC_DIR), on_access=storage.touch), name="static")
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 
 
@@ -45,153 +217,138 @@ def health():
     return {"status": "ok", "service": "gateway"}
 
 
-@app.post("/api/simswap")
-def simswap(src: UploadFile = File(...), dst: UploadFile = File(...)):
-    try:
-        src.file.seek(0)
-    except Exception:
-        pass
-    try:
-        dst.file.seek(0)
-    except Exception:
-        pass
+@app.get("/admission")
+def admission_stats():
+    """Per-upstream concurrency, queue depth and admit/reject counters."""
+    return admission.stats()
+
+
+@app.get("/coalescing")
+def coalescing_stats():
+    """Single-flight coalescing: requests run vs. answered by an identical in-flight request."""
+    return coalescer.stats()
+
+
+@app.get("/upstreams")
+def upstream_stats():
+    """Replica health, breaker state and outstanding requests per upstream."""
+    return {name: pool.stats() for name, pool in UPSTREAMS.items()}
+
+
+@app.on_event("startup")
+def start_upstream_monitor():
+    upstream_monitor.start()
 
-    files = {
-        "src": (src.filename, src.file, src.content_type),
-        "dst": (dst.filename, dst.file, dst.content_type),
-    }
 
+def simswap_preview(srcs: list, dst, mapping=None):
+    """Quick JPEG preview; the job's inputs stay upstream for /api/simswap/upgrade/{job_id}."""
+    job_id = uuid.uuid4().hex[:10]
+    result_filename = f"simswap_preview_{job_id}.jpg"
     try:
-        r = requests.post(SIMSWAP_URL, files=files, timeout=600)
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"SimSwap service unreachable: {e}")
+        simswap_engine.preview(srcs, dst, mapping, job_id, STATIC_DIR / result_filename)
+    except EngineError as e:
+        return engine_error(e)
+    return {
+        "ok": True,
+        "preview": True,
+        "job_id": job_id,
+        "result_url": f"/static/{result_filename}",
+        "upgrade_url": f"/api/simswap/upgrade/{job_id}",
+    }
 
-    if r.status_code != 200:
-        # ส่ง error กลับให้หน้าเว็บอ่านได้
-        return JSONResponse(status_code=r.status_code, content={"detail": r.text})
 
+@app.post("/api/simswap")
+async def simswap(src: UploadFile = File(...), dst: UploadFile = File(...), preview: bool = Form(False)):
+    """preview=true: small JPEG from a shrunk target, upgradable to full resolution."""
+    return await coalescer.run("/api/simswap", lambda: run_in_threadpool(run_simswap, src, dst, preview),
+                               params={"preview": preview}, uploads=[src, dst])
+
+
+def run_simswap(src, dst, preview: bool):
+    if preview:
+        return simswap_preview([src], dst)
     # บันทึกผลลัพธ์เป็นไฟล์ static เพื่อให้ <img src=...> เรียกได้
     result_filename = f"simswap_{uuid.uuid4().hex[:8]}.png"
-    out_path = STATIC_DIR / result_filename
-    out_path.write_bytes(r.content)
+    try:
+        simswap_engine.swap(src, dst, STATIC_DIR / result_filename)
+    except EngineError as e:
+        # ส่ง error กลับให้หน้าเว็บอ่านได้
+        return engine_error(e)
 
     return {"ok": True, "result_url": f"/static/{result_filename}"}
 
 
+@app.post("/api/simswap/upgrade/{job_id}")
+def simswap_upgrade(job_id: str):
+    """Full-resolution swap of a previewed job, reusing the inputs uploaded with the preview."""
+    if not PREVIEW_JOB_ID.match(job_id):
+        raise HTTPException(400, "Invalid job_id")
+    result_filename = f"simswap_{job_id}.png"
+    out_path = STATIC_DIR / result_filename
+    if not out_path.is_file():
+        try:
+            simswap_engine.upgrade(job_id, out_path)
+        except EngineError as e:
+            return engine_error(e)
+    return {"ok": True, "job_id": job_id, "result_url": f"/static/{result_filename}"}
 
 
 @app.post("/api/simswap_multi_detect")
-async def simswap_multi_detect(dst: UploadFile = File(...)):
-    """Convert uploaded image to detected face crops via SimSwap service."""
-    # 1. Forward to SimSwap service
-    try:
-        files = {"dst": (dst.filename, dst.file, dst.content_type)}
-        # Reset file pointer just in case
-        dst.file.seek(0)
-        
-        r = requests.post(f"http://127.0.0.1:8001/detect_faces", files=files, timeout=60)
-    except Exception as e:
-         raise HTTPException(status_code=502, detail=f"Service unreachable: {e}")
-         
-    if r.status_code != 200:
-        return JSONResponse(status_code=r.status_code, content=r.json())
-        
-    data = r.json()
-    faces = data.get("faces", [])
-    job_id = data.get("job_id", "unknown")
-    
-    # 2. Download face crops to Gateway static
-    local_faces = []
+def simswap_multi_detect(dst: UploadFile = File(...)):
+    """Convert uploaded image to detected face crops (saved to gateway static)."""
     face_dir = STATIC_DIR / "faces"
     face_dir.mkdir(exist_ok=True)
-    
-    for face in faces:
-        remote_path = face["file_path"] # e.g. /uploads/xxx.png
-        # Download
-        try:
-            face_url = f"http://127.0.0.1:8001{remote_path}"
-            rr = requests.get(face_url, timeout=10)
-            if rr.status_code == 200:
-                fname = f"face_{job_id}_{face['index']}.png"
-                (face_dir / fname).write_bytes(rr.content)
-                local_faces.append({
-                    "index": face["index"],
-                    "url": f"/static/faces/{fname}"
-                })
-        except Exception as e:
-            print(f"Failed to fetch face {face}: {e}")
-            
+    try:
+        faces = simswap_engine.detect_faces(dst, face_dir, "face")
+    except EngineError as e:
+        return engine_error(e)
+
+    local_faces = [
+        {"index": f["index"], "url": f"/static/faces/{f['path'].name}", "box": f["box"], "score": f["score"]}
+        for f in faces
+    ]
     return {"ok": True, "faces": local_faces}
 
 
-@app.post("/api/simswap_multi_upload")
-async def simswap_multi_upload(src: list[UploadFile] = File(...), dst: UploadFile = File(...), mapping: str = Form("")):
-    """Accept explicit file uploads (List[UploadFile]) so Swagger UI shows inputs.
-    This endpoint mirrors the behavior of `/api/simswap_multi` but exposes typed params for the docs.
+@app.post("/api/simswap_multi_match")
+def simswap_multi_match(src: list[UploadFile] = File(...), dst: UploadFile = File(...),
+                        threshold: float = Form(None)):
+    """
+    Automatic face mapping: sources paired with the target's faces by
+    identity similarity. Returns the "target:source" mapping for
+    /api/simswap_multi_upload (which also accepts mapping=auto directly)
+    with per-pair scores and target boxes.
     """
-    # save into shared_storage/uploads and forward, similar to simswap_multi logic
-    shared_upload_dir = BASE_DIR.parent / 'shared_storage' / 'uploads'
-    shared_upload_dir.mkdir(parents=True, exist_ok=True)
-
-    job = __import__('uuid').uuid4().hex[:10]
-    saved_files = []
-    # save src files
-    for i, f in enumerate(src):
-        try:
-            await f.seek(0)
-        except Exception:
-            pass
-        suffix = Path(getattr(f, 'filename', f'src{i}')).suffix or '.jpg'
-        outp = shared_upload_dir / f"{job}_src{i}{suffix}"
-        data = await f.read()
-        outp.write_bytes(data)
-        saved_files.append(('src', outp))
-
-    # save dst
     try:
-        await dst.seek(0)
-    except Exception:
-        pass
-    suffix = Path(getattr(dst, 'filename', 'dst')).suffix or '.jpg'
-    outp = shared_upload_dir / f"{job}_dst{suffix}"
-    data = await dst.read()
-    outp.write_bytes(data)
-    saved_files.append(('dst', outp))
-
-    # open saved files for forwarding
-    opened_handles = []
-    files = []
-    for kind, p in saved_files:
-        fh = open(p, 'rb')
-        opened_handles.append(fh)
-        files.append((kind, (p.name, fh, 'application/octet-stream')))
-    
-    # Add mapping to payload
-    payload = {"mapping": mapping}
+        result = simswap_engine.match_faces(src, dst, threshold)
+    except EngineError as e:
+        return engine_error(e)
+    return {"ok": True, **result}
 
-    try:
-        r = requests.post(SIMSWAP_MULTI_URL, files=files, data=payload, timeout=600)
-    except requests.RequestException as e:
-        for fh in opened_handles:
-            try:
-                fh.close()
-            except Exception:
-                pass
-        raise HTTPException(status_code=502, detail=f"SimSwap service unreachable: {e}")
 
-    # close handles
-    for fh in opened_handles:
-        try:
-            fh.close()
-        except Exception:
-            pass
+@app.post("/api/simswap_multi_upload")
+async def simswap_multi_upload(src: list[UploadFile] = File(...), dst: UploadFile = File(...), mapping: str = Form(""),
+                         preview: bool = Form(False)):
+    """Accept explicit file uploads (List[UploadFile]) so Swagger UI shows inputs.
+    This endpoint mirrors the behavior of `/api/simswap_multi` but exposes typed params for the docs.
+    preview=true works as for /api/simswap.
+    """
+    return await coalescer.run(
+        "/api/simswap_multi_upload",
+        lambda: run_in_threadpool(run_simswap_multi, src, dst, mapping, preview),
+        params={"mapping": mapping, "preview": preview},
+        uploads=[*src, dst],
+    )
 
-    if r.status_code != 200:
-        return JSONResponse(status_code=r.status_code, content={"detail": r.text})
 
+def run_simswap_multi(src: list, dst, mapping: str, preview: bool):
+    if preview:
+        return simswap_preview(src, dst, mapping)
     result_filename = f"simswap_multi_{uuid.uuid4().hex[:8]}.png"
-    out_path = STATIC_DIR / result_filename
-    out_path.write_bytes(r.content)
+    try:
+        simswap_engine.swap_multi(src, dst, mapping, STATIC_DIR / result_filename)
+    except EngineError as e:
+        return engine_error(e)
 
     return {"ok": True, "result_url": f"/static/{result_filename}"}
 
@@ -201,160 +358,351 @@ async def background_removal(
     image: UploadFile = File(...),
     bg_image: UploadFile = File(None),
     colors: str = Form(None),
-    mode: str = Form("color")
+    mode: str = Form("color"),
+    full_res: bool = Form(False)
 ):
     """
     Gateway Endpoint for Background Removal
-    Supports: transparent, color, image
+    Supports: transparent, color, image, blur
+    full_res: uploads above FACELAB_MAX_MEGAPIXELS are processed downscaled;
+    with full_res the mask is pasted back onto the original resolution
     """
+    return await coalescer.run(
+        "/api/background_removal",
+        lambda: run_in_threadpool(run_background_removal, image, bg_image, colors, mode, full_res),
+        params={"colors": colors, "mode": mode, "full_res": full_res},
+        uploads=[image, bg_image],
+    )
+
+
+def run_background_removal(image, bg_image, colors: str, mode: str, full_res: bool):
+    job_id = uuid.uuid4().hex[:8]
     try:
-        # 1. เตรียม Files
-        image.file.seek(0)
-        files = {
-            "image": (image.filename, image.file, image.content_type),
-        }
-        
-        # ถ้ามีรูปพื้นหลังแนบมา (สำหรับโหมด image)
-        if bg_image:
-            bg_image.file.seek(0)
-            files["bg_image"] = (bg_image.filename, bg_image.file, bg_image.content_type)
+        result = bg_removal_engine.remove(image, bg_image, colors, mode, STATIC_DIR, job_id, full_res)
+    except EngineError as e:
+        return engine_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # 2. เตรียม Data
-        data = {"mode": mode}
-        if colors:
-            data["colors"] = colors
+    if not result["results"]:
+        return JSONResponse(status_code=500, content={"detail": "No results returned"})
 
-        # 3. ส่ง Request ไปยัง Service (Port 8002)
-        try:
-            r = requests.post(BG_REMOVAL_URL, files=files, data=data, timeout=600)
-        except requests.RequestException as e:
-            raise HTTPException(status_code=502, detail=f"Service unreachable: {e}")
+    return {
+        "ok": True,
+        "job_id": job_id,
+        "results": [f"/static/{p.name}" for p in result["results"]],
+        "colors_used": result["colors_used"]
+    }
 
-        if r.status_code != 200:
-            return JSONResponse(status_code=r.status_code, content={"detail": r.text})
 
-        # 4. Process Response และ Download รูปกลับมาเก็บที่ Gateway
-        resp_json = r.json()
-        results = []
-        job_id = resp_json.get("job_id", uuid.uuid4().hex[:8])
+# ====== Pipelines ======
+# Chains of steps run server-side: intermediate images stay in the gateway's
+# memory (or inside the gateway process in embedded mode) instead of going
+# back to the browser, and only the final result is written to static.
+
+PIPELINE_OPS = ("simswap", "background_removal")
 
-        for i, path in enumerate(resp_json.get("results", [])):
-            if path.startswith('http'):
-                src_url = path
-            else:
-                src_url = f"http://127.0.0.1:8002{path}"
 
+def parse_pipeline(steps: str, has_src: bool, has_bg: bool) -> list:
+    """Validate a steps JSON list (or {"steps": [...]}) before any work starts."""
+    try:
+        chain = json.loads(steps)
+    except ValueError:
+        raise HTTPException(400, "steps must be JSON, e.g. [{\"op\": \"simswap\"}]")
+    if isinstance(chain, dict):
+        chain = chain.get("steps")
+    if not isinstance(chain, list) or not chain:
+        raise HTTPException(400, "steps must be a non-empty list")
+    if len(chain) > PIPELINE_MAX_STEPS:
+        raise HTTPException(400, f"At most {PIPELINE_MAX_STEPS} steps per pipeline")
+
+    for i, step in enumerate(chain):
+        op = step.get("op") if isinstance(step, dict) else None
+        if op not in PIPELINE_OPS:
+            raise HTTPException(400, f"Step {i}: op must be one of {list(PIPELINE_OPS)}")
+        if op == "simswap" and not has_src:
+            raise HTTPException(400, f"Step {i}: simswap needs a 'src' face upload")
+        if op == "background_removal":
+            mode = step.setdefault("mode", "color")
+            if mode not in BACKGROUND_MODES:
+                raise HTTPException(400, f"Step {i}: mode must be one of {list(BACKGROUND_MODES)}")
+            if mode == "image" and not has_bg:
+                raise HTTPException(400, f"Step {i}: mode 'image' needs a 'bg_image' upload")
+            colors = step.get("colors")
             try:
-                rr = requests.get(src_url, timeout=60)
-                if rr.status_code == 200:
-                    out_name = f"bg_{job_id}_{i}.png"
-                    out_path = STATIC_DIR / out_name
-                    out_path.write_bytes(rr.content)
-                    results.append(f"/static/{out_name}")
-            except:
-                continue
-
-        if not results:
-            return JSONResponse(status_code=500, content={"detail": "No results returned"})
-
-        return {
-            "ok": True,
-            "job_id": job_id,
-            "results": results,
-            "colors_used": resp_json.get("colors_used", [])
-        }
+                if isinstance(colors, list):  # [[r, g, b], ...] as well as "r,g,b|r,g,b"
+                    step["colors"] = "|".join(",".join(str(int(c)) for c in rgb) for rgb in colors)
+                elif colors is not None and not isinstance(colors, str):
+                    raise TypeError
+            except (TypeError, ValueError):
+                raise HTTPException(400, f"Step {i}: colors must be 'r,g,b|...' or a list of [r, g, b]")
+    return chain
+
+
+def run_pipeline_step(step: dict, image, src, bg_image, final: bool, job_id: str):
+    """One step: in-memory bytes for intermediate steps, static result paths for the last one."""
+    op = step["op"]
+    with stage(f"pipeline_{op}"):
+        if op == "simswap":
+            if not final:
+                return simswap_engine.swap_bytes(src, image)
+            out_path = STATIC_DIR / f"pipeline_{job_id}.png"
+            simswap_engine.swap(src, image, out_path)
+            return [out_path]
+        if not final:
+            return bg_removal_engine.remove_bytes(image, bg_image, step.get("colors"), step["mode"],
+                                                  bool(step.get("full_res")))
+        result = bg_removal_engine.remove(image, bg_image, step.get("colors"), step["mode"], STATIC_DIR,
+                                          f"pipeline_{job_id}", bool(step.get("full_res")))
+        return result["results"]
+
+
+@app.post("/api/pipeline")
+async def pipeline(
+    image: UploadFile = File(...),
+    steps: str = Form(...),
+    src: UploadFile = File(None),
+    bg_image: UploadFile = File(None),
+):
+    """
+    Run a chain of edits in one call, e.g.
+    steps=[{"op": "simswap"}, {"op": "background_removal", "mode": "color", "colors": "255,255,255"}]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    `image` is the first step's input (the target photo for simswap), `src`
+    the face used by simswap steps and `bg_image` the background for
+    mode "image". Each step takes a slot from its upstream's admission
+    limiter while it runs.
+    """
+    chain = parse_pipeline(steps, src is not None, bg_image is not None)
+    job_id = uuid.uuid4().hex[:8]
+    current = image
+    timings = []
+
+    for i, step in enumerate(chain):
+        limiter = admission.limiters[step["op"]]
+        try:
+            granted_at = await limiter.acquire(SINGLE)
+        except AdmissionRejected as e:
+            return JSONResponse(
+                status_code=429,
+                content={"detail": f"{e.upstream} is busy ({e.reason}), retry later", "failed_step": i},
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        started = time.perf_counter()
+        try:
+            result = await run_in_threadpool(
+                run_pipeline_step, step, current, src, bg_image, i == len(chain) - 1, job_id)
+        except EngineError as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail, "failed_step": i})
+        finally:
+            limiter.release(SINGLE, granted_at)
+        timings.append({"op": step["op"], "ms": round((time.perf_counter() - started) * 1000, 1)})
+        if i < len(chain) - 1:
+            current = MemoryUpload(result, f"{job_id}_step{i}")
+
+    if not result:
+        return JSONResponse(status_code=500, content={"detail": "No results returned"})
+    urls = [f"/static/{p.name}" for p in result]
+    return {"ok": True, "job_id": job_id, "result_url": urls[0], "results": urls, "steps": timings}
 
 
 # ====== HeadNeRF Endpoints ======
+# HeadNeRF keeps per-session state (and fitted codes) on the replica, so
+# requests are routed by session id to keep a client on one replica.
+
+@contextmanager
+def headnerf_lease(session_id: str = None):
+    with HEADNERF.lease(affinity_key=session_id or "default") as replica, stage("upstream_transfer"):
+        yield replica
+
+
+def headnerf_json(r: requests.Response):
+    """Upstream JSON; errors keep their status and Retry-After (503 while HeadNeRF loads)."""
+    if r.status_code == 200:
+        return r.json()
+    try:
+        content = r.json()
+    except ValueError:
+        content = {"detail": r.text}
+    headers = {"Retry-After": r.headers["Retry-After"]} if "Retry-After" in r.headers else None
+    return JSONResponse(status_code=r.status_code, content=content, headers=headers)
+
 
 @app.get("/api/headnerf/samples")
-def headnerf_samples():
-    """Proxy to HeadNeRF service - list available samples."""
+def headnerf_samples(offset: int = 0, limit: int = None, session_id: str = None):
+    """Proxy to HeadNeRF service - list available samples (paginated)."""
     try:
-        r = requests.get(f"{HEADNERF_URL}/samples", timeout=10)
-        return r.json()
+        with headnerf_lease(session_id) as replica:
+            r = http.get(
+                f"{replica.url}/samples",
+                params={"offset": offset, "limit": limit},
+                timeout=10
+            )
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
+    samples = r.json()
+    if isinstance(samples, list):
+        for sample in samples:
+            if sample.get("preview_url"):
+                sample["preview_url"] = f"/api/headnerf{sample['preview_url']}"
+    headers = {}
+    if "X-Total-Count" in r.headers:
+        headers["X-Total-Count"] = r.headers["X-Total-Count"]
+    return JSONResponse(status_code=r.status_code, content=samples, headers=headers)
+
+
+@app.get("/api/headnerf/samples/{sample_name}/preview")
+def headnerf_sample_preview(sample_name: str, session_id: str = None):
+    """Proxy to HeadNeRF service - cached sample thumbnail."""
+    try:
+        with headnerf_lease(session_id) as replica:
+            r = http.get(f"{replica.url}/samples/{sample_name}/preview", timeout=30)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
+    if r.status_code != 200:
+        return JSONResponse(status_code=r.status_code, content={"detail": r.text})
+    return Response(content=r.content, media_type=r.headers.get("content-type", "image/jpeg"))
+
 
 @app.get("/api/headnerf/current")
-def headnerf_current():
+def headnerf_current(session_id: str = None):
     """Proxy to HeadNeRF service - get current source/target."""
     try:
-        r = requests.get(f"{HEADNERF_URL}/current", timeout=10)
+        with headnerf_lease(session_id) as replica:
+            r = http.get(f"{replica.url}/current", params={"session_id": session_id}, timeout=10)
         return r.json()
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
 
 @app.post("/api/headnerf/set_source")
-def headnerf_set_source(sample_name: str):
+def headnerf_set_source(sample_name: str, session_id: str = None):
     """Proxy to HeadNeRF service - set source sample."""
     try:
-        r = requests.post(f"{HEADNERF_URL}/set_source", params={"sample_name": sample_name}, timeout=30)
+        with headnerf_lease(session_id) as replica:
+            r = http.post(
+                f"{replica.url}/set_source",
+                params={"sample_name": sample_name, "session_id": session_id},
+                timeout=30
+            )
         return r.json()
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
 
 @app.post("/api/headnerf/set_target")
-def headnerf_set_target(sample_name: str):
+def headnerf_set_target(sample_name: str, session_id: str = None):
     """Proxy to HeadNeRF service - set target sample."""
     try:
-        r = requests.post(f"{HEADNERF_URL}/set_target", params={"sample_name": sample_name}, timeout=30)
+        with headnerf_lease(session_id) as replica:
+            r = http.post(
+                f"{replica.url}/set_target",
+                params={"sample_name": sample_name, "session_id": session_id},
+                timeout=30
+            )
         return r.json()
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
 
 @app.get("/api/headnerf/render")
-def headnerf_render(
+async def headnerf_render(
     identity: float = 0.0,
     expression: float = 0.0,
     albedo: float = 0.0,
     illumination: float = 0.0,
     pitch: float = 0.0,
     yaw: float = 0.0,
-    roll: float = 0.0
+    roll: float = 0.0,
+    session_id: str = None,
+    quality: str = None
 ):
     """
     Proxy to HeadNeRF service - render with parameters.
     Returns base64 image for real-time display.
+    quality: progressive-render level ('preview', 'full', 'auto', ...)
     """
+    params = {
+        "identity": identity,
+        "expression": expression,
+        "albedo": albedo,
+        "illumination": illumination,
+        "pitch": pitch,
+        "yaw": yaw,
+        "roll": roll,
+        "session_id": session_id,
+        "quality": quality
+    }
+    # Same session and sliders => same frame (the session's source/target live on its replica)
+    return await coalescer.run("/api/headnerf/render", lambda: run_in_threadpool(headnerf_render_quick, params),
+                               params=params)
+
+
+def headnerf_render_quick(params: dict):
     try:
-        r = requests.get(
-            f"{HEADNERF_URL}/render_quick",
-            params={
-                "identity": identity,
-                "expression": expression,
-                "albedo": albedo,
-                "illumination": illumination,
-                "pitch": pitch,
-                "yaw": yaw,
-                "roll": roll
-            },
-            timeout=30
-        )
-        return r.json()
+        with headnerf_lease(params["session_id"]) as replica:
+            r = http.get(f"{replica.url}/render_quick", params=params, timeout=30)
+        return headnerf_json(r)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
+
+
+@app.get("/api/headnerf/quality_levels")
+def headnerf_quality_levels(session_id: str = None):
+    """Proxy to HeadNeRF service - progressive render levels."""
+    try:
+        with headnerf_lease(session_id) as replica:
+            r = http.get(f"{replica.url}/quality_levels", timeout=10)
+        return headnerf_json(r)
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
 
+@app.post("/api/headnerf/sweep")
+async def headnerf_sweep(request: Request, session_id: str = None):
+    """
+    Proxy to HeadNeRF service - render a keyframed parameter sweep
+    (turntable / expression blend) as WebP, MP4 or a frame zip.
+    """
+    body = await request.body()
+    try:
+        with headnerf_lease(session_id) as replica:
+            r = await run_in_threadpool(
+                http.post,
+                f"{replica.url}/render_sweep",
+                data=body,
+                params={"session_id": session_id},
+                headers={"Content-Type": "application/json"},
+                timeout=600
+            )
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
+
+    if r.status_code != 200:
+        return JSONResponse(status_code=r.status_code, content={"detail": r.text})
+
+    headers = {
+        k: v for k, v in r.headers.items()
+        if k in ("Content-Disposition", "X-Frame-Count", "X-Render-FPS", "X-Total-Seconds")
+    }
+    return Response(content=r.content, media_type=r.headers.get("content-type"), headers=headers)
+
+
 @app.post("/api/headnerf/fit")
-async def headnerf_fit(image: UploadFile = File(...)):
+def headnerf_fit(image: UploadFile = File(...), wait: bool = True, session_id: str = None):
     """
     Proxy to HeadNeRF service - fit an image to get latent code.
     This runs the full pipeline: mask generation, landmark detection, 3DMM fitting, HeadNeRF fitting.
+    With wait=false the service returns a job_id to poll via /api/headnerf/fit/jobs/{job_id}.
     """
     try:
         image.file.seek(0)
         files = {"image": (image.filename, image.file, image.content_type)}
         
-        # This is a long-running operation
-        r = requests.post(f"{HEADNERF_URL}/fit", files=files, timeout=600)
+        # This is a long-running operation (sync route, so it runs in the threadpool)
+        with headnerf_lease(session_id) as replica:
+            r = http.post(f"{replica.url}/fit", files=files, params={"wait": wait}, timeout=600)
         
         if r.status_code != 200:
             return JSONResponse(status_code=r.status_code, content={"detail": r.text})
@@ -363,3 +711,13 @@ async def headnerf_fit(image: UploadFile = File(...)):
     except requests.RequestException as e:
         raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
 
+
+@app.get("/api/headnerf/fit/jobs/{job_id}")
+def headnerf_fit_job(job_id: str, session_id: str = None):
+    """Proxy to HeadNeRF service - fit job status and stage timings."""
+    try:
+        with headnerf_lease(session_id) as replica:
+            r = http.get(f"{replica.url}/fit/jobs/{job_id}", timeout=10)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"HeadNeRF service unreachable: {e}")
+    return JSONResponse(status_code=r.status_code, content=r.json())
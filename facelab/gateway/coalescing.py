@@ -0,0 +1,123 @@
+"""
+Single-flight coalescing of identical in-flight requests.
+
+During demos, and whenever the frontend retries, the same swap, background
+removal or render often reaches the gateway several times at once. Each
+request is keyed by a hash of its route, parameters and upload bytes; the
+first one with a given key (the leader) runs, and the others (followers)
+wait for it and answer with a copy of its response. A duplicate burst
+costs one inference.
+
+Only in-flight work is shared: the key is dropped as soon as the leader
+finishes, so a later identical request runs again. Errors are shared too
+(a follower re-raises the leader's exception or returns its error
+response). Responses must be JSON-able values or in-memory ``Response``
+objects (not streamed files).
+
+Coalescing happens on the event loop: the leader's work runs as a task
+(shielded, so a leader whose client disconnects still finishes for its
+followers) and followers await it without holding a threadpool thread,
+so a burst of duplicates cannot starve unrelated sync routes.
+
+A follower calls ``on_follow`` before it starts waiting; the gateway uses
+it to hand back the follower's admission slot, so duplicates don't hold
+upstream capacity the leader is already using.
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from common.metrics import REGISTRY, stage
+
+COALESCING = REGISTRY.counter(
+    "facelab_coalescing_requests_total",
+    "Requests seen by single-flight coalescing (leader = ran, follower = shared a leader's result)",
+    ("route", "role"),
+)
+
+_CHUNK = 1 << 20
+
+
+def _upload_digest(upload) -> bytes:
+    """sha256 of an upload's bytes, read in chunks; the file is rewound for the route."""
+    h = hashlib.sha256()
+    f = upload.file
+    f.seek(0)
+    while True:
+        chunk = f.read(_CHUNK)
+        if not chunk:
+            break
+        h.update(chunk)
+    f.seek(0)
+    return h.digest()
+
+
+def request_key(route: str, params: Optional[dict] = None, uploads: Iterable = ()) -> str:
+    """Input hash: route + parameters + the bytes of each upload, in order (``None`` for a missing one)."""
+    h = hashlib.sha256(route.encode())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    for upload in uploads:
+        h.update(b"-" if upload is None else _upload_digest(upload))
+    return h.hexdigest()
+
+
+def _copy_result(result: Any) -> Any:
+    """A follower's own copy (middlewares add headers to the response they are given)."""
+    if hasattr(result, "body") and hasattr(result, "status_code"):
+        from starlette.responses import Response
+
+        headers = {k: v for k, v in result.headers.items() if k.lower() != "content-length"}
+        return Response(result.body, status_code=result.status_code, headers=headers, media_type=result.media_type)
+    return copy.deepcopy(result)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers with the same key share its result."""
+
+    def __init__(self, enabled: bool = True, on_follow: Optional[Callable[[], None]] = None):
+        self.enabled = enabled
+        self.on_follow = on_follow
+        self._calls: Dict[str, asyncio.Task] = {}  # touched on the event loop only
+        self._routes: Dict[str, None] = {}
+
+    async def run(self, route: str, fn: Callable[[], Awaitable[Any]], params: Optional[dict] = None,
+                  uploads: Iterable = ()) -> Any:
+        """``await fn()``, or a copy of the result of an identical call already in flight."""
+        if not self.enabled:
+            return await fn()
+        with stage("coalesce_key"):
+            # Upload files may be spooled to disk: hash them off the event loop
+            key = await asyncio.to_thread(request_key, route, params, list(uploads))
+
+        self._routes[route] = None
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t, key=key: self._calls.pop(key) if self._calls.get(key) is t else None)
+        COALESCING.inc(route=route, role="leader" if leader else "follower")
+
+        if leader:
+            # Followers copy the untouched original; the leader answers with a copy too
+            return _copy_result(await asyncio.shield(task))
+        if self.on_follow is not None:
+            self.on_follow()
+        with stage("coalesced_wait"):
+            return _copy_result(await asyncio.shield(task))
+
+    def stats(self) -> dict:
+        routes = list(self._routes)
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "routes": {
+                route: {
+                    "leaders": int(COALESCING.value(route=route, role="leader")),
+                    "coalesced": int(COALESCING.value(route=route, role="follower")),
+                }
+                for route in routes
+            },
+        }
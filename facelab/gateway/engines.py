@@ -0,0 +1,501 @@
+"""
+Engines behind the gateway's image endpoints.
+
+Each upstream that takes images has two implementations with the same
+methods:
+
+- ``Remote*``: the split deployment. Uploads are forwarded to a service
+  replica over HTTP and the results downloaded into the gateway's static
+  directory.
+- ``Embedded*``: the single-process deployment. The service's engine
+  module (``swap_engine``, ``removal_engine``) is loaded into the gateway
+  and called with the uploaded bytes / decoded images, and results are
+  written straight into the static directory. This skips the multipart
+  re-encode, the loopback hop, the service-side disk write and the
+  download.
+
+``FACELAB_EMBEDDED`` selects what runs in-process ("simswap",
+"background_removal", a comma-separated list, or "all"); the default is
+the split deployment. HeadNeRF always stays remote: it keeps per-session
+state, runs its fit worker from its own working tree and exchanges small
+JSON payloads, so there is little transport cost to remove.
+
+Errors surface as ``EngineError(status_code, detail)`` so the endpoints
+answer the same way in both modes. Upload limits (``common.uploads``) apply
+in both: remote engines refuse oversized uploads before forwarding them
+(the service downscales), embedded engines ingest them like the service.
+The ``*_bytes`` variants return a step's image in memory for pipelines
+(see ``MemoryUpload``).
+"""
+
+import base64
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import requests
+
+from common.metrics import stage
+from common.readiness import NotReady, Warmup
+from common.uploads import MAX_UPLOAD_BYTES, Ingested, UploadTooLarge, ingest_bytes, ingest_file
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent / "Service"
+EMBEDDABLE = ("simswap", "background_removal")
+BACKGROUND_MODES = ("transparent", "color", "image", "blur")
+
+
+def embedded_engines(value: Optional[str] = None) -> set:
+    """Parse FACELAB_EMBEDDED into the set of upstreams to run in-process."""
+    value = os.environ.get("FACELAB_EMBEDDED", "") if value is None else value
+    names = {v.strip() for v in value.split(",") if v.strip()}
+    if "all" in names:
+        return set(EMBEDDABLE)
+    unknown = names - set(EMBEDDABLE)
+    if unknown:
+        raise ValueError(f"FACELAB_EMBEDDED: cannot embed {sorted(unknown)}, expected {list(EMBEDDABLE)} or 'all'")
+    return names
+
+
+class EngineError(Exception):
+    """An engine call failed; ``status_code``/``detail`` go back to the client."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class MemoryUpload:
+    """Upload-like wrapper (filename, content_type, file) for an image held in memory."""
+
+    def __init__(self, data: bytes, filename: str = "intermediate"):
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            self.content_type, suffix = "image/png", ".png"
+        elif data[:3] == b"\xff\xd8\xff":
+            self.content_type, suffix = "image/jpeg", ".jpg"
+        else:
+            self.content_type, suffix = "application/octet-stream", ""
+        self.filename = filename + suffix
+        self.file = io.BytesIO(data)
+
+
+def _rewind(upload):
+    try:
+        upload.file.seek(0)
+    except Exception:
+        pass
+
+
+def _ingest(upload, keep_original: bool = False) -> Ingested:
+    _rewind(upload)
+    try:
+        with stage("ingest"):
+            ingested = ingest_bytes(upload.file, keep_original=keep_original)
+    except UploadTooLarge as e:
+        raise EngineError(413, str(e))
+    if not ingested.data:
+        raise EngineError(400, "Uploaded file is empty")
+    return ingested
+
+
+def _read(upload) -> bytes:
+    return _ingest(upload).data
+
+
+def _check_size(fileobj):
+    """Refuse an upload over the byte cap before forwarding it (Starlette already spooled it)."""
+    try:
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(0)
+    except Exception:
+        return
+    if size > MAX_UPLOAD_BYTES:
+        raise EngineError(413, f"Upload exceeds the {MAX_UPLOAD_BYTES / 2**20:g} MB limit")
+
+
+@contextmanager
+def _embedded_call(name: str):
+    """Map in-process failures onto the status codes the services would return."""
+    try:
+        yield
+    except EngineError:
+        raise
+    except NotReady as e:
+        raise EngineError(503, str(e))
+    except ValueError as e:
+        raise EngineError(400, str(e))
+    except Exception as e:
+        traceback.print_exc()
+        raise EngineError(500, f"{name} failed: {e}")
+
+
+class _RemoteEngine:
+    def __init__(self, pool, http, label: str):
+        self.pool = pool
+        self.http = http
+        self.label = label
+
+    def _post(self, path: str, affinity_key: Optional[str] = None, **kwargs):
+        """POST to the least-loaded replica (or the ``affinity_key``'s); returns (replica, response)."""
+        files = kwargs.get("files") or {}
+        for _, (_, fileobj, _) in (files.items() if isinstance(files, dict) else files):
+            _check_size(fileobj)
+        try:
+            with self.pool.lease(affinity_key) as replica, stage("upstream_transfer"):
+                r = self.http.post(f"{replica.url}{path}", **kwargs)
+        except requests.RequestException as e:
+            raise EngineError(502, f"{self.label} service unreachable: {e}")
+        if r.status_code != 200:
+            raise EngineError(r.status_code, r.text)
+        return replica, r
+
+    def _download(self, url: str, out_path: Path, timeout: float) -> bool:
+        with stage("result_download"):
+            rr = self.http.get(url, timeout=timeout)
+        if rr.status_code != 200:
+            return False
+        with stage("disk_write"):
+            out_path.write_bytes(rr.content)
+        return True
+
+
+# ====== SimSwap ======
+class RemoteSimSwap(_RemoteEngine):
+    def __init__(self, pool, http):
+        super().__init__(pool, http, "SimSwap")
+
+    def swap_bytes(self, src, dst) -> bytes:
+        _rewind(src)
+        _rewind(dst)
+        files = {
+            "src": (src.filename, src.file, src.content_type),
+            "dst": (dst.filename, dst.file, dst.content_type),
+        }
+        _, r = self._post("/run", files=files, timeout=600)
+        return r.content
+
+    def swap(self, src, dst, out_path: Path):
+        data = self.swap_bytes(src, dst)
+        with stage("disk_write"):
+            out_path.write_bytes(data)
+
+    def _multi_files(self, srcs: list, dst) -> list:
+        files = []
+        for f in srcs:
+            _rewind(f)
+            files.append(("src", (f.filename, f.file, f.content_type)))
+        _rewind(dst)
+        files.append(("dst", (dst.filename, dst.file, dst.content_type)))
+        return files
+
+    def swap_multi(self, srcs: list, dst, mapping: str, out_path: Path):
+        _, r = self._post("/run_multi", files=self._multi_files(srcs, dst), data={"mapping": mapping}, timeout=600)
+        with stage("disk_write"):
+            out_path.write_bytes(r.content)
+
+    def preview(self, srcs: list, dst, mapping: Optional[str], job_id: str, out_path: Path):
+        """Small JPEG swap on a shrunk target; the replica keeps the inputs under ``job_id``."""
+        data = {"preview": "true", "job_id": job_id}
+        if mapping is None:
+            _rewind(srcs[0])
+            _rewind(dst)
+            files = {
+                "src": (srcs[0].filename, srcs[0].file, srcs[0].content_type),
+                "dst": (dst.filename, dst.file, dst.content_type),
+            }
+            _, r = self._post("/run", affinity_key=job_id, files=files, data=data, timeout=600)
+        else:
+            data["mapping"] = mapping
+            _, r = self._post("/run_multi", affinity_key=job_id, files=self._multi_files(srcs, dst),
+                              data=data, timeout=600)
+        with stage("disk_write"):
+            out_path.write_bytes(r.content)
+
+    def match_faces(self, srcs: list, dst, threshold: Optional[float] = None) -> dict:
+        """Identity mapping of sources onto the target's faces (see the service's /match_faces)."""
+        data = {} if threshold is None else {"threshold": str(threshold)}
+        _, r = self._post("/match_faces", files=self._multi_files(srcs, dst), data=data, timeout=120)
+        return r.json()
+
+    def upgrade(self, job_id: str, out_path: Path):
+        """Full-resolution result of a previewed job (same replica as the preview)."""
+        _, r = self._post(f"/upgrade/{job_id}", affinity_key=job_id, timeout=600)
+        with stage("disk_write"):
+            out_path.write_bytes(r.content)
+
+    def detect_faces(self, dst, out_dir: Path, prefix: str) -> List[dict]:
+        """Face crops saved as ``<prefix>_<job>_<index>.png``: [{"index", "path", "box", "score"}]."""
+        _rewind(dst)
+        files = {"dst": (dst.filename, dst.file, dst.content_type)}
+        # Crops come back inline, in this one response
+        replica, r = self._post("/detect_faces", files=files, data={"inline": "true"}, timeout=60)
+        data = r.json()
+        job_id = data.get("job_id", "unknown")
+        faces = []
+        for face in data.get("faces", []):
+            out_path = out_dir / f"{prefix}_{job_id}_{face['index']}.png"
+            try:
+                if "image" in face:
+                    with stage("disk_write"):
+                        out_path.write_bytes(base64.b64decode(face["image"]))
+                # replica without inline support: fetch the saved crop
+                elif not self._download(f"{replica.url}{face['file_path']}", out_path, timeout=10):
+                    continue
+            except Exception as e:
+                print(f"Failed to fetch face {face.get('index')}: {e}")
+                continue
+            faces.append({"index": face["index"], "path": out_path,
+                          "box": face.get("box"), "score": face.get("score")})
+        return faces
+
+
+class EmbeddedSimSwap:
+    """SimSwap running in the gateway process (the service's swap_engine)."""
+
+    def __init__(self, warmup: Warmup, upload_dir: Path):
+        root = SERVICE_DIR / "simswap_service"
+        simswap_root = root / "SimSwap"
+        sys.path[:0] = [str(root), str(simswap_root)]
+        from swap_engine import MATCH_THRESHOLD, decode_bgr, load_face_detector, load_matcher, load_swapper
+
+        # swap_engine hands SimSwap absolute model paths: the gateway's cwd stays as it is
+        self.warmup = warmup
+        self.upload_dir = upload_dir
+        self._decode = decode_bgr
+        self.match_threshold = MATCH_THRESHOLD
+        warmup.add("simswap", lambda: load_swapper(simswap_root))
+        warmup.add("face_detector", lambda: load_face_detector(simswap_root), required=False)
+        warmup.add("matcher", lambda: load_matcher(simswap_root), required=False)
+
+    def _save_inputs(self, job: str, srcs: list, dst) -> Tuple[List[Path], Path]:
+        # The swap scripts read files, so inputs are written once (no copy in a service)
+        src_paths = [self._save(f, self.upload_dir / f"{job}_src{i}.png") for i, f in enumerate(srcs)]
+        dst_path = self._save(dst, self.upload_dir / f"{job}_dst.png")
+        return src_paths, dst_path
+
+    def _save(self, upload, path: Path) -> Path:
+        _rewind(upload)
+        try:
+            with stage("ingest"):
+                ingested = ingest_file(upload.file, path)
+        except UploadTooLarge as e:
+            raise EngineError(413, str(e))
+        if not ingested.nbytes:
+            path.unlink(missing_ok=True)
+            raise EngineError(400, "Uploaded file is empty")
+        return path
+
+    def _run(self, name: str, fn, out_path: Optional[Path], *args, **kwargs) -> Optional[bytes]:
+        """Run a swap; move its result to ``out_path``, or return its bytes when None (previews return bytes)."""
+        # Per-job output dir: the scripts write fixed file names
+        work_dir = Path(tempfile.mkdtemp(prefix=".swap_", dir=self.upload_dir))
+        try:
+            with _embedded_call(name):
+                result = fn(*args, work_dir, **kwargs)
+            if out_path is None:
+                return result if isinstance(result, bytes) else Path(result).read_bytes()
+            shutil.move(str(result), str(out_path))
+            return None
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    @staticmethod
+    def _discard(paths: List[Path]):
+        for p in paths:
+            p.unlink(missing_ok=True)
+
+    def swap(self, src, dst, out_path: Optional[Path]):
+        job = os.urandom(5).hex()
+        (src_path,), dst_path = self._save_inputs(job, [src], dst)
+        try:
+            with _embedded_call("SimSwap"):
+                swapper = self.warmup.get("simswap")
+            return self._run("SimSwap", swapper.swap, out_path, src_path, dst_path)
+        finally:
+            self._discard([src_path, dst_path])
+
+    def swap_bytes(self, src, dst) -> bytes:
+        return self.swap(src, dst, None)
+
+    def _match(self, src_paths: List[Path], dst_path: Path, threshold: Optional[float] = None) -> dict:
+        import cv2
+
+        with _embedded_call("Face matching"):
+            detector = self.warmup.get("face_detector")
+            matcher = self.warmup.get("matcher")
+            sources = [cv2.imread(str(p), cv2.IMREAD_COLOR) for p in src_paths]
+            target = cv2.imread(str(dst_path), cv2.IMREAD_COLOR)
+            if target is None or any(img is None for img in sources):
+                raise ValueError("Could not read image")
+            return matcher.match_images(detector, sources, target,
+                                        self.match_threshold if threshold is None else threshold)
+
+    def _resolve_mapping(self, mapping: Optional[str], src_paths: List[Path], dst_path: Path) -> Optional[str]:
+        """mapping="auto": pair sources with target faces by identity."""
+        if mapping is None or mapping.strip().lower() != "auto":
+            return mapping
+        mapping = self._match(src_paths, dst_path)["mapping"]
+        if not mapping:
+            raise EngineError(422, "No source matched a face in the target")
+        return mapping
+
+    def match_faces(self, srcs: list, dst, threshold: Optional[float] = None) -> dict:
+        job = os.urandom(5).hex()
+        src_paths, dst_path = self._save_inputs(job, srcs, dst)
+        try:
+            return self._match(src_paths, dst_path, threshold)
+        finally:
+            self._discard(src_paths + [dst_path])
+
+    def swap_multi(self, srcs: list, dst, mapping: str, out_path: Path):
+        job = os.urandom(5).hex()
+        src_paths, dst_path = self._save_inputs(job, srcs, dst)
+        try:
+            mapping = self._resolve_mapping(mapping, src_paths, dst_path)
+            with _embedded_call("SimSwap (multi)"):
+                swapper = self.warmup.get("simswap")
+            self._run("SimSwap (multi)", swapper.swap_multi, out_path, src_paths, dst_path, mapping=mapping)
+        finally:
+            self._discard(src_paths + [dst_path])
+
+    def preview(self, srcs: list, dst, mapping: Optional[str], job_id: str, out_path: Path):
+        """Small JPEG swap on a shrunk target; inputs stay in the uploads dir for ``upgrade``."""
+        src_paths, dst_path = self._save_inputs(job_id, srcs, dst)
+        multi = mapping is not None
+        mapping = self._resolve_mapping(mapping, src_paths, dst_path)
+        meta = {"src": [p.name for p in src_paths], "dst": dst_path.name, "multi": multi, "mapping": mapping or ""}
+        (self.upload_dir / f"{job_id}_job.json").write_text(json.dumps(meta))
+        with _embedded_call("SimSwap (preview)"):
+            swapper = self.warmup.get("simswap")
+        data = self._run("SimSwap (preview)", swapper.preview, None, src_paths, dst_path,
+                         multi=multi, mapping=mapping or "")
+        with stage("disk_write"):
+            out_path.write_bytes(data)
+
+    def upgrade(self, job_id: str, out_path: Path):
+        try:
+            meta = json.loads((self.upload_dir / f"{job_id}_job.json").read_text())
+        except FileNotFoundError:
+            raise EngineError(404, f"Unknown or expired job: {job_id}")
+        with _embedded_call("SimSwap"):
+            swapper = self.warmup.get("simswap")
+        self._run("SimSwap", swapper.run, out_path, [self.upload_dir / n for n in meta["src"]],
+                  self.upload_dir / meta["dst"], multi=meta["multi"], mapping=meta["mapping"])
+
+    def detect_faces(self, dst, out_dir: Path, prefix: str) -> List[dict]:
+        import cv2
+
+        data = _read(dst)
+        job_id = os.urandom(5).hex()
+        with _embedded_call("Face detection"):
+            detector = self.warmup.get("face_detector")
+            img = self._decode(data)
+            if img is None:
+                raise ValueError("Could not read image")
+            detected = detector.faces(img)
+        faces = []
+        for i, face in enumerate(detected):
+            out_path = out_dir / f"{prefix}_{job_id}_{i}.png"
+            with stage("encode_write"):
+                cv2.imwrite(str(out_path), face["crop"])
+            faces.append({"index": i, "path": out_path, "box": face["box"], "score": face["score"]})
+        return faces
+
+
+# ====== Background removal ======
+class RemoteBackgroundRemoval(_RemoteEngine):
+    def __init__(self, pool, http):
+        super().__init__(pool, http, "Background removal")
+
+    def _run(self, image, bg_image, colors: Optional[str], mode: str, full_res: bool = False):
+        _rewind(image)
+        files = {"image": (image.filename, image.file, image.content_type)}
+        # ถ้ามีรูปพื้นหลังแนบมา (สำหรับโหมด image)
+        if bg_image:
+            _rewind(bg_image)
+            files["bg_image"] = (bg_image.filename, bg_image.file, bg_image.content_type)
+        data = {"mode": mode}
+        if full_res:
+            data["full_res"] = "true"
+        if colors:
+            data["colors"] = colors
+
+        replica, r = self._post("/run", files=files, data=data, timeout=600)
+        resp_json = r.json()
+        urls = [path if path.startswith("http") else f"{replica.url}{path}" for path in resp_json.get("results", [])]
+        return urls, resp_json.get("colors_used", [])
+
+    def remove(self, image, bg_image, colors: Optional[str], mode: str, out_dir: Path, job_id: str,
+               full_res: bool = False) -> dict:
+        """Run one removal; results saved as ``bg_<job>_<i>.png``: {"results": [Path], "colors_used"}."""
+        urls, colors_used = self._run(image, bg_image, colors, mode, full_res)
+        results = []
+        # Download รูปกลับมาเก็บที่ Gateway
+        for i, src_url in enumerate(urls):
+            out_path = out_dir / f"bg_{job_id}_{i}.png"
+            try:
+                if self._download(src_url, out_path, timeout=60):
+                    results.append(out_path)
+            except Exception:
+                continue
+        return {"results": results, "colors_used": colors_used}
+
+    def remove_bytes(self, image, bg_image, colors: Optional[str], mode: str, full_res: bool = False) -> bytes:
+        """First result of a removal, in memory."""
+        urls, _ = self._run(image, bg_image, colors, mode, full_res)
+        if not urls:
+            raise EngineError(500, "No results returned")
+        try:
+            with stage("result_download"):
+                rr = self.http.get(urls[0], timeout=60)
+        except requests.RequestException as e:
+            raise EngineError(502, f"{self.label} service unreachable: {e}")
+        if rr.status_code != 200:
+            raise EngineError(rr.status_code, rr.text)
+        return rr.content
+
+
+class EmbeddedBackgroundRemoval:
+    """rembg + compositing in the gateway process (the service's removal_engine)."""
+
+    def __init__(self, warmup: Warmup):
+        sys.path.insert(0, str(SERVICE_DIR / "background_removal_service"))
+        from removal_engine import load_remover
+
+        self.warmup = warmup
+        warmup.add("u2net", load_remover)
+
+    def _run(self, image, bg_image, colors: Optional[str], mode: str, full_res: bool = False):
+        if image.content_type and not image.content_type.startswith("image/"):
+            raise EngineError(400, "File must be an image")
+        upload = _ingest(image, keep_original=full_res)
+        bg_bytes = _read(bg_image) if bg_image else None
+        with _embedded_call("Background removal"):
+            remover = self.warmup.get("u2net")
+            return remover.run(upload.data, mode, colors, bg_bytes, upload.original_data)
+
+    def remove_bytes(self, image, bg_image, colors: Optional[str], mode: str, full_res: bool = False) -> bytes:
+        """First result of a removal, PNG-encoded in memory."""
+        outputs, _ = self._run(image, bg_image, colors, mode, full_res)
+        buf = io.BytesIO()
+        with stage("encode"):
+            outputs[0][1].save(buf, format="PNG")
+        return buf.getvalue()
+
+    def remove(self, image, bg_image, colors: Optional[str], mode: str, out_dir: Path, job_id: str,
+               full_res: bool = False) -> dict:
+        outputs, colors_used = self._run(image, bg_image, colors, mode, full_res)
+        results = []
+        for i, (_, result_image) in enumerate(outputs):
+            out_path = out_dir / f"bg_{job_id}_{i}.png"
+            with stage("encode_write"):
+                result_image.save(out_path, format="PNG")
+            results.append(out_path)
+        return {"results": results, "colors_used": colors_used}
@@ -0,0 +1,248 @@
+"""
+Replica pools for gateway upstreams.
+
+Every upstream service is a pool of one or more replicas. Requests go to
+the replica with the fewest outstanding requests, replicas that fail
+repeatedly (connection errors, timeouts or 5xx answers) are taken out of
+rotation for a cooldown (circuit breaker), and a background monitor probes
+each replica's readiness endpoint (``/ready``: 200 only once its models
+are loaded, so a restarting replica gets no traffic until it is warm;
+services without one fall back to ``/health``). Services that keep
+per-client state (HeadNeRF sessions) route by an affinity key so a client
+keeps hitting the same replica while it is available.
+
+``TracedSession`` is the HTTP client for upstream calls: it forwards the
+gateway's request id and folds each service's Server-Timing breakdown
+into the gateway's own.
+"""
+
+import contextvars
+import hashlib
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import requests
+
+from common.tracing import REQUEST_ID_HEADER, current_request_id, merge_upstream
+
+logger = logging.getLogger(__name__)
+
+# Lease of the current request: upstream calls made through TracedSession
+# inside ``UpstreamPool.lease`` report their status code here
+_lease: contextvars.ContextVar = contextvars.ContextVar("upstream_lease", default=None)
+
+
+class _Lease:
+    def __init__(self, replica: "Replica"):
+        self.replica = replica
+        self.server_error = False
+
+
+class NoReplicaAvailable(requests.RequestException):
+    """Every replica in the pool is unhealthy or has its breaker open."""
+
+
+class Replica:
+    """One service instance."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.probe_path: Optional[str] = None  # readiness path that answered (None until probed)
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # breaker open while time.monotonic() < open_until
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.open_until
+
+    def info(self) -> dict:
+        now = time.monotonic()
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "probe": self.probe_path,
+            "breaker_open": now < self.open_until,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class UpstreamPool:
+    """Least-outstanding-requests pool with health probing and circuit breaking."""
+
+    def __init__(self, name: str, urls: List[str], health_path: str = "/ready",
+                 fallback_health_path: Optional[str] = "/health",
+                 failure_threshold: int = 3, cooldown: float = 30.0):
+        if not urls:
+            raise ValueError(f"Upstream '{name}' has no replicas")
+        self.name = name
+        self.replicas = [Replica(u) for u in urls]
+        self.health_path = health_path
+        self.fallback_health_path = fallback_health_path
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """First replica's URL (for logs and single-replica setups)."""
+        return self.replicas[0].url
+
+    def _candidates(self) -> List[Replica]:
+        now = time.monotonic()
+        live = [r for r in self.replicas if r.available(now)]
+        if live:
+            return live
+        # Everything is marked down: let a replica whose cooldown expired try again
+        return [r for r in self.replicas if now >= r.open_until]
+
+    def choose(self, affinity_key: Optional[str] = None) -> Replica:
+        with self._lock:
+            candidates = self._candidates()
+            if not candidates:
+                raise NoReplicaAvailable(f"{self.name}: no healthy replicas")
+            if affinity_key is not None and len(candidates) > 1:
+                # Rendezvous hashing: stable per key, minimal movement when a replica drops out
+                return max(
+                    candidates,
+                    key=lambda r: hashlib.md5(f"{affinity_key}|{r.url}".encode()).digest()
+                )
+            return min(candidates, key=lambda r: r.outstanding)
+
+    @contextmanager
+    def lease(self, affinity_key: Optional[str] = None):
+        """
+        Pick a replica and track the request against it. Connection errors,
+        timeouts and 5xx responses (seen by ``TracedSession``) count as failures.
+        """
+        replica = self.choose(affinity_key)
+        with self._lock:
+            replica.outstanding += 1
+            replica.requests += 1
+        lease = _Lease(replica)
+        token = _lease.set(lease)
+        try:
+            yield replica
+        except (requests.ConnectionError, requests.Timeout):
+            self.mark_failure(replica)
+            raise
+        else:
+            if lease.server_error:
+                self.mark_failure(replica)
+            else:
+                self.mark_success(replica)
+        finally:
+            _lease.reset(token)
+            with self._lock:
+                replica.outstanding -= 1
+
+    def mark_failure(self, replica: Replica):
+        with self._lock:
+            replica.failures += 1
+            replica.consecutive_failures += 1
+            if replica.consecutive_failures >= self.failure_threshold:
+                replica.open_until = time.monotonic() + self.cooldown
+                logger.warning("[%s] circuit open for %s (%.0fs)", self.name, replica.url, self.cooldown)
+
+    def mark_success(self, replica: Replica):
+        with self._lock:
+            replica.consecutive_failures = 0
+            replica.open_until = 0.0
+
+    def _probe_replica(self, replica: Replica, timeout: float) -> bool:
+        path = replica.probe_path or self.health_path
+        r = requests.get(f"{replica.url}{path}", timeout=timeout)
+        if r.status_code == 404 and path == self.health_path and self.fallback_health_path:
+            # Service predates /ready: liveness is the best signal it has
+            path = self.fallback_health_path
+            r = requests.get(f"{replica.url}{path}", timeout=timeout)
+        replica.probe_path = path
+        return r.status_code == 200
+
+    def probe(self, timeout: float = 2.0):
+        """Check every replica's readiness endpoint once."""
+        for replica in self.replicas:
+            try:
+                ok = self._probe_replica(replica, timeout)
+            except requests.RequestException:
+                ok = False
+                replica.probe_path = None  # restarted replicas may have gained /ready
+            was_healthy = replica.healthy
+            replica.healthy = ok
+            if ok and not was_healthy:
+                self.mark_success(replica)
+                logger.info("[%s] %s is ready again", self.name, replica.url)
+            elif not ok and was_healthy:
+                logger.warning("[%s] %s failed readiness check", self.name, replica.url)
+
+    def stats(self) -> dict:
+        return {"replicas": [r.info() for r in self.replicas]}
+
+
+class TracedSession(requests.Session):
+    """
+    ``requests.Session`` for upstream calls. Forwards the current request
+    id and merges the response's Server-Timing as ``<pool name>.<stage>``.
+    """
+
+    def __init__(self, pools: Dict[str, UpstreamPool]):
+        super().__init__()
+        self.pools = pools
+
+    def _pool_name(self, url: str) -> Optional[str]:
+        for name, pool in self.pools.items():
+            if any(url.startswith(r.url + "/") for r in pool.replicas):
+                return name
+        return None
+
+    def request(self, method, url, **kwargs):
+        request_id = current_request_id()
+        if request_id is not None:
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers.setdefault(REQUEST_ID_HEADER, request_id)
+            kwargs["headers"] = headers
+        response = super().request(method, url, **kwargs)
+        lease = _lease.get()
+        if lease is not None and url.startswith(lease.replica.url + "/"):
+            # A crashed or still-loading replica answers 5xx: a breaker failure, not a success
+            lease.server_error = response.status_code >= 500
+        name = self._pool_name(url)
+        if name is not None:
+            merge_upstream(name, response.headers.get("Server-Timing"))
+        return response
+
+
+class PoolMonitor:
+    """Background thread that probes every pool periodically."""
+
+    def __init__(self, pools: Dict[str, UpstreamPool], interval: float = 5.0):
+        self.pools = pools
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="upstream-monitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            for pool in self.pools.values():
+                pool.probe()
+            self._stop.wait(self.interval)
+
+
+def parse_replicas(value: str) -> List[str]:
+    """Split a comma-separated replica list."""
+    return [u.strip() for u in value.split(",") if u.strip()]
@@ -0,0 +1,79 @@
+import asyncio
+import contextvars
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "gateway"))
+from admission import (BATCH, INTERACTIVE, SINGLE, AdmissionController, AdmissionSlot, UpstreamLimiter,
+                       admission_slot, release_current_slot)
+
+
+def test_interactive_admitted_past_batch_waiter_at_class_cap():
+    async def scenario():
+        limiter = UpstreamLimiter("headnerf", 4, 8, max_wait=1.0, class_limits={BATCH: 1})
+        running_fit = await limiter.acquire(BATCH)
+        queued_fit = asyncio.ensure_future(limiter.acquire(BATCH))
+        await asyncio.sleep(0)
+        assert limiter.stats()["queued"] == 1
+
+        # Three slots are free: a render must not wait behind the capped fit
+        render = await asyncio.wait_for(limiter.acquire(INTERACTIVE), timeout=0.1)
+        assert limiter.active == 2
+        assert not queued_fit.done()
+
+        limiter.release(INTERACTIVE, render)
+        limiter.release(BATCH, running_fit)
+        await asyncio.wait_for(queued_fit, timeout=0.1)
+        assert limiter.active_by_class[BATCH] == 1
+        assert limiter.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiters_served_by_priority_when_full():
+    async def scenario():
+        limiter = UpstreamLimiter("simswap", 1, 8, max_wait=1.0)
+        held = await limiter.acquire(BATCH)
+        batch = asyncio.ensure_future(limiter.acquire(BATCH))
+        interactive = asyncio.ensure_future(limiter.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        assert not batch.done() and not interactive.done()
+
+        limiter.release(BATCH, held)
+        await asyncio.wait_for(interactive, timeout=0.1)
+        assert not batch.done()
+        limiter.release(INTERACTIVE, interactive.result())
+        await asyncio.wait_for(batch, timeout=0.1)
+
+    asyncio.run(scenario())
+
+
+def test_slot_released_early_is_released_once():
+    async def scenario():
+        limiter = UpstreamLimiter("simswap", 1, 8, max_wait=1.0)
+        slot = AdmissionSlot(limiter, SINGLE, await limiter.acquire(SINGLE))
+        waiter = asyncio.ensure_future(limiter.acquire(SINGLE))
+        await asyncio.sleep(0)
+
+        token = admission_slot.set(slot)
+        try:
+            # A coalesced follower hands its slot back from the threadpool (context copied, as in starlette)
+            await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, release_current_slot)
+        finally:
+            admission_slot.reset(token)
+        await asyncio.wait_for(waiter, timeout=0.5)
+        slot.release()  # end of the request: already released, no double count
+        assert limiter.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_route_policy_longest_prefix_wins():
+    limiters = {"headnerf": UpstreamLimiter("headnerf", 4, 8)}
+    controller = AdmissionController(limiters, {
+        "/api/headnerf/fit": ("headnerf", BATCH),
+        "/api/headnerf/fit/jobs": ("headnerf", INTERACTIVE),
+    })
+    assert controller.policy_for("/api/headnerf/fit")[1] == BATCH
+    assert controller.policy_for("/api/headnerf/fit/jobs/abc123")[1] == INTERACTIVE
+    assert controller.policy_for("/api/headnerf/fitting") is None
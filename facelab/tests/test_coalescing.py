@@ -0,0 +1,114 @@
+import asyncio
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "gateway"))
+from coalescing import SingleFlight, request_key
+
+
+class Upload:
+    def __init__(self, data: bytes):
+        self.file = io.BytesIO(data)
+
+
+def slow_call(calls: list, result, delay: float = 0.05):
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return {"ok": True, "value": result}
+    return fn
+
+
+def test_followers_share_the_leader_result():
+    async def scenario():
+        followed = []
+        flight = SingleFlight(on_follow=lambda: followed.append(1))
+        calls = []
+        results = await asyncio.gather(*[
+            flight.run("/api/simswap", slow_call(calls, "a"), {"preview": False}, [Upload(b"src"), Upload(b"dst")])
+            for _ in range(5)
+        ])
+        assert len(calls) == 1
+        assert len(followed) == 4
+        assert all(r == {"ok": True, "value": "a"} for r in results)
+        # Every caller gets its own copy
+        results[0]["value"] = "changed"
+        assert results[1]["value"] == "a"
+        stats = flight.stats()
+        assert stats["in_flight"] == 0
+        assert stats["routes"]["/api/simswap"]["coalesced"] >= 4
+
+    asyncio.run(scenario())
+
+
+def test_different_inputs_run_separately():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        await asyncio.gather(
+            flight.run("/api/background_removal", slow_call(calls, 1), {"mode": "color"}, [Upload(b"x")]),
+            flight.run("/api/background_removal", slow_call(calls, 2), {"mode": "color"}, [Upload(b"y")]),
+            flight.run("/api/background_removal", slow_call(calls, 3), {"mode": "blur"}, [Upload(b"x")]),
+        )
+        assert len(calls) == 3
+
+    asyncio.run(scenario())
+
+
+def test_leader_error_reaches_followers():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        results = await asyncio.gather(
+            *[flight.run("/api/simswap", slow_call(calls, ValueError("boom")), {}, [Upload(b"z")]) for _ in range(3)],
+            return_exceptions=True,
+        )
+        assert len(calls) == 1
+        assert all(isinstance(r, ValueError) and str(r) == "boom" for r in results)
+
+    asyncio.run(scenario())
+
+
+def test_key_dropped_after_completion():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        await flight.run("/api/headnerf/render", slow_call(calls, "x", delay=0), {"yaw": 0.5})
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 0
+        await flight.run("/api/headnerf/render", slow_call(calls, "x", delay=0), {"yaw": 0.5})
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_still_serves_followers():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        leader = asyncio.ensure_future(flight.run("/api/simswap", slow_call(calls, "a", delay=0.1), {}, [Upload(b"q")]))
+        await asyncio.sleep(0.02)
+        follower = asyncio.ensure_future(flight.run("/api/simswap", slow_call(calls, "b"), {}, [Upload(b"q")]))
+        await asyncio.sleep(0.02)
+        leader.cancel()
+        assert (await follower)["value"] == "a"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_request_key_rewinds_uploads():
+    upload = Upload(b"image bytes")
+    upload.file.read()
+    key = request_key("/api/simswap", {"preview": True}, [upload, None])
+    assert upload.file.tell() == 0
+    assert key == request_key("/api/simswap", {"preview": True}, [Upload(b"image bytes"), None])
+    assert key != request_key("/api/simswap", {"preview": False}, [Upload(b"image bytes"), None])
@@ -0,0 +1,115 @@
+import hashlib
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("starlette")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from starlette.requests import Request
+
+from common.http_cache import CACHE_CONTROL, _etag_matches, _parse_range, file_response
+
+DATA = bytes(range(256)) * 4  # 1024 bytes
+
+
+def make_request(headers: dict = None, query: str = "") -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/outputs/result.png",
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    })
+
+
+@pytest.fixture
+def result_file(tmp_path):
+    path = tmp_path / "result.png"
+    path.write_bytes(DATA)
+    return path
+
+
+def etag_of(data: bytes) -> str:
+    return f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+
+
+def test_parse_range_explicit_and_open_ended():
+    assert _parse_range("bytes=0-99", 1024) == (0, 99)
+    assert _parse_range("bytes=1000-", 1024) == (1000, 1023)
+    assert _parse_range("bytes=1000-5000", 1024) == (1000, 1023)  # end clamped to the file
+
+
+def test_parse_range_suffix():
+    assert _parse_range("bytes=-100", 1024) == (924, 1023)
+    assert _parse_range("bytes=-5000", 1024) == (0, 1023)  # longer than the file: all of it
+
+
+def test_parse_range_unsatisfiable():
+    with pytest.raises(ValueError):
+        _parse_range("bytes=-0", 1024)
+    with pytest.raises(ValueError):
+        _parse_range("bytes=1024-", 1024)
+    with pytest.raises(ValueError):
+        _parse_range("bytes=500-100", 1024)
+
+
+def test_parse_range_ignored():
+    # Multiple or malformed ranges fall back to the full file
+    assert _parse_range("bytes=0-10,20-30", 1024) is None
+    assert _parse_range("bytes=-", 1024) is None
+    assert _parse_range("items=0-10", 1024) is None
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert _etag_matches('"abc"', etag)
+    assert _etag_matches('W/"abc"', etag)
+    assert _etag_matches('"xyz", W/"abc"', etag)
+    assert _etag_matches(" * ", etag)
+    assert not _etag_matches('"xyz", W/"abd"', etag)
+    assert not _etag_matches('abc', etag)
+
+
+def test_file_response_not_modified(result_file):
+    etag = etag_of(DATA)
+    response = file_response(make_request({"If-None-Match": f'"stale", W/{etag}'}), result_file)
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.headers["cache-control"] == CACHE_CONTROL
+    assert response.body == b""
+
+
+def test_file_response_full_file_without_conditions(result_file):
+    response = file_response(make_request(), result_file)
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag_of(DATA)
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_file_response_partial_content(result_file):
+    response = file_response(make_request({"Range": "bytes=-24"}), result_file)
+    assert response.status_code == 206
+    assert response.body == DATA[-24:]
+    assert response.headers["content-range"] == "bytes 1000-1023/1024"
+
+
+def test_file_response_range_with_if_range(result_file):
+    etag = etag_of(DATA)
+    response = file_response(make_request({"Range": "bytes=0-9", "If-Range": etag}), result_file)
+    assert response.status_code == 206
+    assert response.body == DATA[:10]
+    # A stale If-Range gets the whole (changed) file instead
+    response = file_response(make_request({"Range": "bytes=0-9", "If-Range": '"old"'}), result_file)
+    assert response.status_code == 200
+
+
+def test_file_response_multi_range_serves_whole_file(result_file):
+    response = file_response(make_request({"Range": "bytes=0-9,20-29"}), result_file)
+    assert response.status_code == 200
+
+
+def test_file_response_unsatisfiable_range(result_file):
+    response = file_response(make_request({"Range": "bytes=-0"}), result_file)
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */1024"
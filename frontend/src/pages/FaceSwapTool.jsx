@@ -1,11 +1,11 @@
-import { useState, useCallback, useEffect } from 'react';
+import { useState, useCallback, useEffect, useRef } from 'react';
 import { useLocation } from 'react-router-dom';
 import ImageUploader from '../components/ImageUploader';
 import GenerationProgress from '../components/GenerationProgress';
 import ResultDisplay from '../components/ResultDisplay';
 import ColorEditor from '../components/ColorEditor';
 import FaceMapper from '../components/FaceMapper';
-import { runSimSwap, runSimSwapMultiWithMapping, getResultImageUrl } from '../services/api';
+import { runSimSwap, runSimSwapMultiWithMapping, upgradeSimSwap, getResultImageUrl } from '../services/api';
 import './FaceSwapTool.css';
 import './HeadNeRFTool.css';
 
@@ -51,6 +51,7 @@ function FaceSwapTool() {
     const [resultUrl, setResultUrl] = useState(null);
     const [error, setError] = useState(null);
     const [faceMapping, setFaceMapping] = useState(null);  // Face mapping for multi mode
+    const previewJobRef = useRef(null);  // preview job whose full-resolution result is still coming
 
     // Handlers
     const handleToolChange = (toolId) => {
@@ -120,14 +121,24 @@ function FaceSwapTool() {
 
             try {
                 let result;
+                // Quick preview first; the full-resolution result replaces it when ready
                 if (isMultiMode) {
                     // Multi face swap with mapping
-                    result = await runSimSwapMultiWithMapping(sourceFiles, targetFile, mapping);
+                    result = await runSimSwapMultiWithMapping(sourceFiles, targetFile, mapping, { preview: true });
                 } else {
                     // Single face swap
-                    result = await runSimSwap(sourceFile, targetFile, null);
+                    result = await runSimSwap(sourceFile, targetFile, null, { preview: true });
                 }
                 resultImageUrl = getResultImageUrl(result.result_url);
+                if (result.preview && result.job_id) {
+                    const jobId = result.job_id;
+                    previewJobRef.current = jobId;
+                    upgradeSimSwap(jobId)
+                        .then(full => {
+                            if (previewJobRef.current === jobId) setResultUrl(getResultImageUrl(full.result_url));
+                        })
+                        .catch(e => console.warn('Full-resolution upgrade failed:', e.message));
+                }
             } catch (apiError) {
                 console.warn('Backend not available, using mock mode:', apiError.message);
                 setStatus('โหมดทดสอบ (Backend ไม่พร้อม)...');
@@ -159,6 +170,7 @@ function FaceSwapTool() {
     };
 
     const handleReset = () => {
+        previewJobRef.current = null;
         setSourceFile(null);
         setSourceFiles([]);
         setTargetFile(null);
@@ -23,6 +23,9 @@ const VIEW_SLIDERS = [
 ];
 
 const DEBOUNCE_MS = 100;
+// Progressive rendering: cheap preview while dragging, full quality once idle
+const PREVIEW_QUALITY = 'preview';
+const REFINE_MS = 400;
 
 function HeadNeRFTool() {
     const [samples, setSamples] = useState([]);
@@ -50,6 +53,12 @@ function HeadNeRFTool() {
     const [fitStatus, setFitStatus] = useState('');
 
     const renderTimeoutRef = useRef(null);
+    const refineTimeoutRef = useRef(null);
+    // Latest slider values for renders fired from timers (state in a closure lags a move behind)
+    const sliderValuesRef = useRef(sliderValues);
+    // Render requests are numbered; a response older than the one on screen is dropped
+    const renderSeqRef = useRef(0);
+    const shownSeqRef = useRef(0);
     const dragRef = useRef(null);
 
     useEffect(() => {
@@ -85,29 +94,42 @@ function HeadNeRFTool() {
         }
     };
 
-    const doRender = useCallback(async () => {
+    const doRender = useCallback(async (quality) => {
+        const seq = ++renderSeqRef.current;
         try {
             setIsRendering(true);
-            const result = await renderHeadNeRF(sliderValues);
+            const result = await renderHeadNeRF(
+                sliderValuesRef.current,
+                typeof quality === 'string' ? quality : null
+            );
+            if (seq < shownSeqRef.current) return;  // a newer frame is already shown
             if (result.ok && result.image) {
-                setOutputImage(`data:image/png;base64,${result.image}`);
+                shownSeqRef.current = seq;
+                const mime = result.format === 'jpg' ? 'image/jpeg' : 'image/png';
+                setOutputImage(`data:${mime};base64,${result.image}`);
             }
         } catch (err) {
             console.error('Render error:', err);
         } finally {
-            setIsRendering(false);
+            if (seq === renderSeqRef.current) setIsRendering(false);
         }
-    }, [sliderValues]);
+    }, []);
 
     const debouncedRender = useCallback(() => {
         if (renderTimeoutRef.current) {
             clearTimeout(renderTimeoutRef.current);
         }
-        renderTimeoutRef.current = setTimeout(doRender, DEBOUNCE_MS);
+        if (refineTimeoutRef.current) {
+            clearTimeout(refineTimeoutRef.current);
+        }
+        renderTimeoutRef.current = setTimeout(() => doRender(PREVIEW_QUALITY), DEBOUNCE_MS);
+        refineTimeoutRef.current = setTimeout(() => doRender(), REFINE_MS);
     }, [doRender]);
 
     const handleSliderChange = (id, value) => {
-        setSliderValues(prev => ({ ...prev, [id]: parseFloat(value) }));
+        const next = { ...sliderValuesRef.current, [id]: parseFloat(value) };
+        sliderValuesRef.current = next;
+        setSliderValues(next);
         debouncedRender();
     };
 
@@ -140,11 +162,13 @@ function HeadNeRFTool() {
     };
 
     const handleReset = () => {
-        setSliderValues({
+        const zero = {
             identity: 0, expression: 0, albedo: 0, illumination: 0,
             pitch: 0, yaw: 0, roll: 0
-        });
-        setTimeout(doRender, 50);
+        };
+        sliderValuesRef.current = zero;
+        setSliderValues(zero);
+        doRender();
     };
 
     const handleExport = () => {
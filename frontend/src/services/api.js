@@ -8,8 +8,9 @@ import { compressImage, compressImages } from '../utils/imageUtils';
  * @param {File} srcFile - Source face image
  * @param {File} dstFile - Target/destination image
  * @param {string} regionId - Selected region ID (optional, for future use)
+ * @param {Object} options - { preview: true } for a quick low-res JPEG (upgrade with upgradeSimSwap)
  */
-export async function runSimSwap(srcFile, dstFile, regionId = null) {
+export async function runSimSwap(srcFile, dstFile, regionId = null, { preview = false } = {}) {
   // Compress images before upload
   const [compressedSrc, compressedDst] = await Promise.all([
     compressImage(srcFile),
@@ -19,6 +20,7 @@ export async function runSimSwap(srcFile, dstFile, regionId = null) {
   const formData = new FormData();
   formData.append('src', compressedSrc);
   formData.append('dst', compressedDst);
+  if (preview) formData.append('preview', 'true');
 
   const response = await fetch(`${API_BASE_URL}/api/simswap`, {
     method: 'POST',
@@ -153,11 +155,13 @@ export async function detectTargetFaces(dstFile) {
  * @param {File[]} srcFiles - Source face images
  * @param {File} dstFile - Target image
  * @param {Object} mapping - Face mapping { targetIdx: sourceIdx }
+ * @param {Object} options - { preview: true } for a quick low-res JPEG (upgrade with upgradeSimSwap)
  */
-export async function runSimSwapMultiWithMapping(srcFiles, dstFile, mapping = null) {
+export async function runSimSwapMultiWithMapping(srcFiles, dstFile, mapping = null, { preview = false } = {}) {
   const formData = new FormData();
   srcFiles.forEach(file => formData.append('src', file));
   formData.append('dst', dstFile);
+  if (preview) formData.append('preview', 'true');
 
   if (mapping && Object.keys(mapping).length > 0) {
     const mapStr = Object.entries(mapping)
@@ -180,15 +184,46 @@ export async function runSimSwapMultiWithMapping(srcFiles, dstFile, mapping = nu
   return response.json();
 }
 
+/**
+ * Full-resolution result of a preview swap (the server reuses the preview's inputs)
+ * @param {string} jobId - job_id returned by a preview=true swap
+ */
+export async function upgradeSimSwap(jobId) {
+  const response = await fetch(`${API_BASE_URL}/api/simswap/upgrade/${jobId}`, {
+    method: 'POST',
+  });
+
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({ detail: 'Unknown error' }));
+    throw new Error(error.detail || 'SimSwap upgrade failed');
+  }
+
+  return response.json();
+}
+
 // =============================================
 // HEADNERF API
 // =============================================
 
+/**
+ * Per-tab HeadNeRF session id so concurrent users keep their own source/target
+ */
+function getHeadNeRFSessionId() {
+  let id = sessionStorage.getItem('headnerfSessionId');
+  if (!id) {
+    id = (crypto.randomUUID && crypto.randomUUID()) || `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+    sessionStorage.setItem('headnerfSessionId', id);
+  }
+  return id;
+}
+
 /**
  * Get available HeadNeRF samples
  */
 export async function getHeadNeRFSamples() {
-  const response = await fetch(`${API_BASE_URL}/api/headnerf/samples`);
+  const response = await fetch(
+    `${API_BASE_URL}/api/headnerf/samples?session_id=${encodeURIComponent(getHeadNeRFSessionId())}`
+  );
   if (!response.ok) {
     throw new Error('Failed to fetch HeadNeRF samples');
   }
@@ -199,7 +234,9 @@ export async function getHeadNeRFSamples() {
  * Get current HeadNeRF state
  */
 export async function getHeadNeRFCurrent() {
-  const response = await fetch(`${API_BASE_URL}/api/headnerf/current`);
+  const response = await fetch(
+    `${API_BASE_URL}/api/headnerf/current?session_id=${encodeURIComponent(getHeadNeRFSessionId())}`
+  );
   if (!response.ok) {
     throw new Error('Failed to get current state');
   }
@@ -212,7 +249,7 @@ export async function getHeadNeRFCurrent() {
  */
 export async function setHeadNeRFSource(sampleName) {
   const response = await fetch(
-    `${API_BASE_URL}/api/headnerf/set_source?sample_name=${encodeURIComponent(sampleName)}`,
+    `${API_BASE_URL}/api/headnerf/set_source?sample_name=${encodeURIComponent(sampleName)}&session_id=${encodeURIComponent(getHeadNeRFSessionId())}`,
     { method: 'POST' }
   );
   if (!response.ok) {
@@ -227,7 +264,7 @@ export async function setHeadNeRFSource(sampleName) {
  */
 export async function setHeadNeRFTarget(sampleName) {
   const response = await fetch(
-    `${API_BASE_URL}/api/headnerf/set_target?sample_name=${encodeURIComponent(sampleName)}`,
+    `${API_BASE_URL}/api/headnerf/set_target?sample_name=${encodeURIComponent(sampleName)}&session_id=${encodeURIComponent(getHeadNeRFSessionId())}`,
     { method: 'POST' }
   );
   if (!response.ok) {
@@ -239,9 +276,11 @@ export async function setHeadNeRFTarget(sampleName) {
 /**
  * Render HeadNeRF with current parameters
  * @param {Object} params - { identity, expression, albedo, illumination, pitch, yaw, roll }
+ * @param {string} quality - Progressive render level ('preview', 'full', 'auto'); null for default
  */
-export async function renderHeadNeRF(params) {
-  const queryParams = new URLSearchParams(params);
+export async function renderHeadNeRF(params, quality = null) {
+  const queryParams = new URLSearchParams({ ...params, session_id: getHeadNeRFSessionId() });
+  if (quality) queryParams.set('quality', quality);
   const response = await fetch(`${API_BASE_URL}/api/headnerf/render?${queryParams}`);
 
   if (!response.ok) {
@@ -258,10 +297,10 @@ export async function fitHeadNeRF(imageFile) {
   const formData = new FormData();
   formData.append('image', imageFile);
 
-  const response = await fetch(`${API_BASE_URL}/api/headnerf/fit`, {
-    method: 'POST',
-    body: formData,
-  });
+  const response = await fetch(
+    `${API_BASE_URL}/api/headnerf/fit?session_id=${encodeURIComponent(getHeadNeRFSessionId())}`,
+    { method: 'POST', body: formData }
+  );
 
   if (!response.ok) {
     const error = await response.json().catch(() => ({ detail: 'Unknown error' }));